@@ -1,20 +1,40 @@
+import gc
+import hmac
+import ipaddress
 import os
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-import stripe
-from werkzeug.utils import secure_filename
-from werkzeug.exceptions import BadRequest, NotFound, InternalServerError
+import time
+import threading
+from flask import (
+    Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context,
+    after_this_request
+)
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import BadRequest, NotFound, Forbidden, InternalServerError, TooManyRequests
 from datetime import datetime
-from apscheduler.schedulers.background import BackgroundScheduler
 from functools import wraps
 
 # Import moduli locali
 from config import *
 from database import *
-from email_service import  send_booking_confirmation_with_pdf
+from email_outbox import enqueue_booking_confirmation, workers as email_workers
+from payments import construct_event as construct_stripe_event, handle_event as handle_stripe_event
+from http_client import get_stripe, stripe_call, CircuitOpenError
 from auth import login_required, check_admin_credentials
 from booking_service import *
-from pdf_generator import generate_email_ticket_pdf, generate_tickets_summary_pdf
+from occupancy import SEAT_LAYOUT
+from seat_updates import stream_seat_updates, broadcaster as seat_broadcaster
+from hold_expiry import engine as hold_expiry
+from job_runner import runner as job_runner
+from event_cache import cache as event_cache
+from waiting_room import room as waiting_room, QUEUE_TOKEN_SECONDS
+from rate_limit import limiter
+from poster_service import save_poster_upload, poster_sources, is_immutable_poster
+from ticket_export import start_event_tickets_zip, get_export_progress
+from transaction_export import (
+    stream_csv, stream_xlsx, xlsx_available, parse_columns, STATUS_LABELS, EXPORT_FORMATS
+)
+import metrics
 
 # Configurazione logging
 logging.basicConfig(
@@ -25,10 +45,82 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
+# IP e schema del client dagli header del reverse proxy (limiti per client, cookie secure)
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file upload
 
-# Configurazione Stripe
-stripe.api_key = STRIPE_SECRET_KEY
+# Job periodici (archiviazione prenotazioni scadute, pulizia registro posti):
+# li esegue un solo processo, il leader del lease nel database
+job_runner.add_job(archive_released_bookings, seconds=600)
+job_runner.add_job(prune_seat_changes, seconds=600)
+job_runner.add_job(limiter.prune, seconds=600, name='prune_rate_limits')
+
+# ---------- AVVIO ----------
+# L'import del modulo non apre il database e non avvia thread: con gunicorn
+# --preload il master carica l'applicazione (create_app, warm_up) e ogni worker
+# avvia i propri thread dopo il fork (start_background_services).
+
+_services_pid = None
+_services_lock = threading.Lock()
+_db_ready = False
+
+
+def _prepare_database():
+    """Schema aggiornato all'ultima migrazione (una volta per processo)"""
+    global _db_ready
+    if _db_ready:
+        return
+    init_db()
+    # Nessuna connessione aperta da ereditare in un fork
+    close_db()
+    _db_ready = True
+
+
+def create_app():
+    """Applicazione pronta a servire, senza thread in background (sicura prima del fork)"""
+    _prepare_database()
+    return app
+
+
+def start_background_services():
+    """Avvia i thread del processo corrente (idempotente, ripetuto dopo un fork)"""
+    global _services_pid
+    if _services_pid == os.getpid():
+        return
+    with _services_lock:
+        if _services_pid == os.getpid():
+            return
+        _prepare_database()
+        metrics.registry.start()
+        # Scadenza precisa delle prenotazioni in attesa di pagamento
+        hold_expiry.start(release_expired_holds, get_next_hold_expiry)
+        job_runner.start()
+        # Worker che svuotano la coda email
+        email_workers.start()
+        _services_pid = os.getpid()
+
+
+def warm_up():
+    """
+    Prepara nel processo master lo stato di sola lettura condiviso dai worker
+    dopo il fork (la pianta della sala è già compilata all'import): template
+    compilati, moduli PDF/email/Stripe, font e logo dei biglietti.
+    Non apre il database e non avvia thread.
+    """
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    from reportlab.pdfbase import pdfmetrics
+    from apscheduler.schedulers.background import BackgroundScheduler  # noqa: F401
+    import email_service  # noqa: F401 (importa anche pdf_generator e ticket_template)
+    import pdf_assets
+    for font in ('Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique'):
+        pdfmetrics.getFont(font)
+    pdf_assets.get_logo()
+    get_stripe()
+    # Oggetti del master esclusi dal garbage collector: i worker non ne
+    # riscrivono le pagine (copy-on-write) durante le raccolte
+    gc.freeze()
 
 # Error handlers
 @app.errorhandler(404)
@@ -40,6 +132,11 @@ def internal_error(error):
     logger.error(f"Internal server error: {error}")
     return render_template('500.html'), 500
 
+@app.errorhandler(TooManyRequests)
+def too_many_requests_error(error):
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+    return render_template('429.html', retry_after=error.retry_after), 429, headers
+
 @app.errorhandler(BadRequest)
 def bad_request_error(error):
     flash('Richiesta non valida', 'error')
@@ -50,26 +147,84 @@ def bad_request_error(error):
 def inject_now():
     return {'now': datetime.now}
 
-# Scheduler per reset transazioni scadute
-scheduler = BackgroundScheduler()
-scheduler.add_job(reset_transazioni_scadute, 'interval', seconds=300)
-scheduler.start()
+# Varianti responsive delle locandine (usate anche dalle macro)
+app.jinja_env.globals['poster_sources'] = poster_sources
+
+@app.template_filter('format_date')
+def format_date(value):
+    """Data evento ISO nel formato di visualizzazione gg/mm/aaaa"""
+    return format_event_date(value)
+
+@app.template_filter('format_timestamp')
+def format_timestamp(value):
+    """created_at ISO nel formato di visualizzazione gg-mm-aaaa hh:mm:ss"""
+    try:
+        return datetime.strptime(value, TIMESTAMP_FORMAT).strftime('%d-%m-%Y %H:%M:%S')
+    except (TypeError, ValueError):
+        return value
+
+# Metriche: latenza e query SQL per endpoint
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+    # Server avviato senza gunicorn.conf.py (flask run, app:app): thread alla prima richiesta
+    start_background_services()
+
+@app.after_request
+def record_request_metrics(response):
+    metrics.finish_request(request.endpoint, request.method, response.status_code)
+    return response
+
+# Cache permanente per le varianti delle locandine: il nome cambia se cambia il contenuto
+@app.after_request
+def poster_cache_headers(response):
+    if request.path.startswith('/static/posters/') and is_immutable_poster(request.path.rsplit('/', 1)[-1]):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 # ---------- ROUTE PRINCIPALI ----------
 
+def _is_loopback(address):
+    # remote_addr è già quello del client dietro il reverse proxy (ProxyFix)
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Metriche Prometheus aggregate da tutti i processi. Con METRICS_TOKEN
+    serve il bearer token; senza, sono accessibili solo da localhost.
+    """
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+            raise Forbidden()
+    elif not _is_loopback(request.remote_addr):
+        raise Forbidden()
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
-    """Homepage con lista eventi visibili"""
+    """Homepage con lista eventi in programma (pagina in cache, GET condizionali)"""
     try:
-        events = get_all_events()
-        logger.info(f"Caricati {len(events)} eventi visibili per homepage")
-        return render_template('index.html', events=events)
+        if '_flashes' in session:
+            # Messaggi da mostrare una sola volta: pagina non riutilizzabile
+            return render_template('index.html', events=event_cache.get().events)
+        page = event_cache.page(lambda events: render_template('index.html', events=events))
+        response = Response(page.body, mimetype='text/html')
+        response.set_etag(page.etag)
+        response.last_modified = page.last_modified
+        # Il browser deve rivalidare ogni volta: le visite ripetute costano un 304
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"Errore nel caricamento eventi: {e}")
         flash('Errore nel caricamento degli eventi', 'error')
         return render_template('index.html', events=[])
 
 @app.route('/admin', methods=['GET', 'POST'])
+@limiter.limit('login', methods=('POST',))
 def admin():
     """Login admin con validazione migliorata"""
     if request.method == 'GET':
@@ -115,36 +270,23 @@ def dashboard():
     """Dashboard admin con statistiche eventi"""
     try:
         events = get_all_events_admin()
+        all_stats = get_all_event_stats()
+        empty_stats = {'pending': 0, 'sold': 0, 'validated': 0}
         event_list = []
         
         for event in events:
-            try:
-                stats = get_event_stats(event['id'])
-                event_list.append({
-                    'id': event['id'],
-                    'title': event['title'],
-                    'date': event['date'],
-                    'time': event['time'],
-                    'price': event['price'],
-                    'sold': stats['sold'],
-                    'validated': stats['validated'],
-                    'pending': stats['pending'],
-                    'visible': event['visible'],
-                })
-            except Exception as e:
-                logger.error(f"Errore calcolo statistiche evento {event['id']}: {e}")
-                # Aggiungi evento senza statistiche
-                event_list.append({
-                    'id': event['id'],
-                    'title': event['title'],
-                    'date': event['date'],
-                    'time': event['time'],
-                    'price': event['price'],
-                    'sold': 0,
-                    'validated': 0,
-                    'pending': 0,
-                    'visible': event['visible'],
-                })
+            stats = all_stats.get(event['id'], empty_stats)
+            event_list.append({
+                'id': event['id'],
+                'title': event['title'],
+                'date': event['date'],
+                'time': event['time'],
+                'price': event['price'],
+                'sold': stats['sold'],
+                'validated': stats['validated'],
+                'pending': stats['pending'],
+                'visible': event['visible'],
+            })
         
         logger.info(f"Dashboard caricata con {len(event_list)} eventi")
         return render_template('dashboard.html', events=event_list)
@@ -167,15 +309,15 @@ def add_event():
         price = request.form['price']
         poster_url = None
         
-        # Gestione upload poster
+        # Gestione upload poster (varianti ridimensionate + originale per la stampa)
         poster = request.files.get('poster')
         if poster and allowed_file(poster.filename):
-            filename = secure_filename(poster.filename)
-            poster.save(os.path.join(UPLOAD_FOLDER, filename))
-            poster_url = f'/static/posters/{filename}'
+            poster_url = save_poster_upload(poster)
+            if not poster_url:
+                flash('La locandina caricata non è un\'immagine valida.', 'warning')
         
-        # Formatta data
-        dt = datetime.strptime(date, '%Y-%m-%d').strftime('%d/%m/%Y')
+        # Data ISO (ordinabile): il formato gg/mm/aaaa è solo per la visualizzazione
+        dt = datetime.strptime(date, EVENT_DATE_FORMAT).strftime(EVENT_DATE_FORMAT)
         
         create_event(title, dt, time, price, poster_url)
         flash('Evento aggiunto con successo!')
@@ -199,15 +341,17 @@ def edit_event(event_id):
         price = request.form['price']
         poster_url = event['poster_url']
         
-        # Gestione upload nuovo poster
+        # Gestione upload nuovo poster (varianti ridimensionate + originale per la stampa)
         poster = request.files.get('poster')
         if poster and allowed_file(poster.filename):
-            filename = secure_filename(poster.filename)
-            poster.save(os.path.join(UPLOAD_FOLDER, filename))
-            poster_url = f'/static/posters/{filename}'
+            new_poster_url = save_poster_upload(poster)
+            if new_poster_url:
+                poster_url = new_poster_url
+            else:
+                flash('La locandina caricata non è un\'immagine valida.', 'warning')
         
-        # Formatta data
-        dt = datetime.strptime(date, '%Y-%m-%d').strftime('%d/%m/%Y')
+        # Data ISO (ordinabile): il formato gg/mm/aaaa è solo per la visualizzazione
+        dt = datetime.strptime(date, EVENT_DATE_FORMAT).strftime(EVENT_DATE_FORMAT)
         
         update_event(event_id, title, dt, time, price, poster_url, event['visible'])
         flash('Evento modificato con successo!')
@@ -235,7 +379,29 @@ def show_event_route(event_id):
 
 # ---------- PRENOTAZIONI UTENTE ----------
 
+def render_seat_map(template, event, booked_seats):
+    """Renderizza una pagina con la piantina dei posti (layout precompilato)"""
+    return render_template(
+        template,
+        event=event,
+        seat_layout=SEAT_LAYOUT,
+        booked_seats=booked_seats
+    )
+
+def _set_waiting_room_cookie(response, name, token, max_age):
+    response.set_cookie(name, token, max_age=max_age, httponly=True, samesite='Lax', secure=request.is_secure)
+
+def _admit(response, event_id, ticket):
+    """Consegna l'ammissione alla selezione posti e scarta il biglietto di coda"""
+    _set_waiting_room_cookie(
+        response, waiting_room.admission_cookie(event_id),
+        waiting_room.admission_token(event_id, ticket), WAITING_ROOM_ADMISSION_SECONDS
+    )
+    response.delete_cookie(waiting_room.queue_cookie(event_id))
+    return response
+
 @app.route('/select_seats/<int:event_id>', methods=['GET', 'POST'])
+@limiter.limit('booking', methods=('POST',))
 def select_seats(event_id):
     """Selezione posti per prenotazione utente"""
     event = get_event_by_id(event_id)
@@ -243,6 +409,22 @@ def select_seats(event_id):
         flash("Evento non trovato.")
         return redirect(url_for('index'))
 
+    # Sala d'attesa: senza ammissione valida si prende un biglietto di coda (gli admin passano sempre)
+    admission = request.cookies.get(waiting_room.admission_cookie(event_id))
+    if not session.get('logged_in') and not waiting_room.is_admitted(event_id, admission):
+        if request.method == 'POST':
+            flash('La tua ammissione alla scelta dei posti è scaduta: riprova dalla sala d\'attesa.')
+            return redirect(url_for('waiting_room_queue', event_id=event_id))
+        status = waiting_room.enter(event_id)
+        if status.position:
+            response = redirect(url_for('waiting_room_queue', event_id=event_id))
+            _set_waiting_room_cookie(
+                response, waiting_room.queue_cookie(event_id),
+                waiting_room.queue_token(event_id, status.ticket), QUEUE_TOKEN_SECONDS
+            )
+            return response
+        after_this_request(lambda response: _admit(response, event_id, status.ticket))
+
     booked_seats = get_booked_seats(event_id)
 
     if request.method == 'POST':
@@ -256,39 +438,62 @@ def select_seats(event_id):
         )
         if not is_valid:
             flash(error_msg)
-            return render_template(
-                'select_seats.html',
-                event=event,
-                row_letters=ROW_LETTERS,
-                cols=COLS,
-                booked_seats=booked_seats,
-                unavailable=UNAVAILABLE_SEATS
-            )
+            return render_seat_map('select_seats.html', event, booked_seats)
         
         # Verifica concorrenza finale
         if not check_seats_available(event_id, selected_seats):
             flash('Alcuni posti sono appena stati prenotati da un altro utente. Riprova!')
-            return render_template(
-                'select_seats.html',
-                event=event,
-                row_letters=ROW_LETTERS,
-                cols=COLS,
-                booked_seats=booked_seats,
-                unavailable=UNAVAILABLE_SEATS
-            )
+            return render_seat_map('select_seats.html', event, booked_seats)
         
-        # Crea prenotazione
+        # Crea prenotazione (il vincolo UNIQUE sui posti impedisce doppie prenotazioni)
         seats_str = ','.join(selected_seats)
         booking_id = create_booking(event_id, name, email, seats_str, status=1)
+        if booking_id is None:
+            flash('Alcuni posti sono appena stati prenotati da un altro utente. Riprova!')
+            return render_seat_map('select_seats.html', event, get_booked_seats(event_id))
         return redirect(url_for('createcheckoutsession', booking_id=booking_id))
 
-    return render_template(
-        'select_seats.html',
-        event=event,
-        row_letters=ROW_LETTERS,
-        cols=COLS,
-        booked_seats=booked_seats,
-        unavailable=UNAVAILABLE_SEATS
+    return render_seat_map('select_seats.html', event, booked_seats)
+
+@app.route('/queue/<int:event_id>')
+def waiting_room_queue(event_id):
+    """Sala d'attesa: posizione in coda, poi ammissione alla selezione posti"""
+    event = get_event_by_id(event_id)
+    if not event:
+        flash("Evento non trovato.")
+        return redirect(url_for('index'))
+    if session.get('logged_in') or waiting_room.is_admitted(
+        event_id, request.cookies.get(waiting_room.admission_cookie(event_id))
+    ):
+        return redirect(url_for('select_seats', event_id=event_id))
+
+    ticket = waiting_room.read_queue_token(event_id, request.cookies.get(waiting_room.queue_cookie(event_id)))
+    status = waiting_room.enter(event_id) if ticket is None else waiting_room.status(event_id, ticket)
+    if not status.position:
+        return _admit(redirect(url_for('select_seats', event_id=event_id)), event_id, status.ticket)
+
+    response = Response(render_template('waiting_room.html', event=event, status=status))
+    response.headers['Refresh'] = str(status.refresh)
+    response.headers['Cache-Control'] = 'no-store'
+    if ticket is None:
+        _set_waiting_room_cookie(
+            response, waiting_room.queue_cookie(event_id),
+            waiting_room.queue_token(event_id, status.ticket), QUEUE_TOKEN_SECONDS
+        )
+    return response
+
+@app.route('/select_seats/<int:event_id>/stream')
+def seat_updates_stream(event_id):
+    """Stream SSE delle variazioni dei posti per aggiornare la piantina in tempo reale"""
+    if not get_event_by_id(event_id):
+        raise NotFound()
+    # Ogni stream occupa un thread del worker: oltre il limite il browser riprova più tardi
+    if seat_broadcaster.at_capacity():
+        return Response(status=503, headers={'Retry-After': '30', 'Cache-Control': 'no-cache'})
+    return Response(
+        stream_with_context(stream_seat_updates(event_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
     )
 
 # ---------- PRENOTAZIONI ADMIN ----------
@@ -315,97 +520,155 @@ def admin_book_seats(event_id):
         )
         if not is_valid:
             flash(error_msg)
-            return render_template(
-                'admin_book_seats.html',
-                event=event,
-                row_letters=ROW_LETTERS,
-                cols=COLS,
-                booked_seats=booked_seats,
-                unavailable=UNAVAILABLE_SEATS
-            )
+            return render_seat_map('admin_book_seats.html', event, booked_seats)
         
         # Verifica concorrenza finale
         if not check_seats_available(event_id, selected_seats):
             flash('Alcuni posti sono appena stati prenotati da un altro utente. Riprova!')
-            return render_template(
-                'admin_book_seats.html',
-                event=event,
-                row_letters=ROW_LETTERS,
-                cols=COLS,
-                booked_seats=booked_seats,
-                unavailable=UNAVAILABLE_SEATS
-            )
+            return render_seat_map('admin_book_seats.html', event, booked_seats)
         
         # Crea prenotazione con status 3 (cassa)
         seats_str = ','.join(selected_seats)
         booking_id = create_booking(event_id, name, email, seats_str, status=3)
+        if booking_id is None:
+            flash('Alcuni posti sono appena stati prenotati da un altro utente. Riprova!')
+            return render_seat_map('admin_book_seats.html', event, get_booked_seats(event_id))
         flash('Prenotazione registrata con successo!', 'success')
         return redirect(url_for('dashboard'))
 
-    return render_template(
-        'admin_book_seats.html',
-        event=event,
-        row_letters=ROW_LETTERS,
-        cols=COLS,
-        booked_seats=booked_seats,
-        unavailable=UNAVAILABLE_SEATS
-    )
+    return render_seat_map('admin_book_seats.html', event, booked_seats)
+
+@app.route('/event/<int:event_id>/best_seats')
+def best_seats(event_id):
+    """Miglior blocco di posti contigui liberi per ?count=N (JSON)"""
+    if not get_event_by_id(event_id):
+        return jsonify({'error': 'Evento non trovato'}), 404
+    count = parse_party_size(request.args.get('count'))
+    if count is None:
+        return jsonify({'error': 'Numero di posti non valido'}), 400
+    seats = find_best_seats(event_id, count)
+    if seats is None:
+        return jsonify({'error': f'Nessun blocco di {count} posti vicini disponibile'}), 409
+    return jsonify({'seats': seats})
+
+@app.route('/event/<int:event_id>/quick_sale', methods=['POST'])
+@login_required
+def admin_quick_sale(event_id):
+    """Vendita rapida in cassa: i migliori posti vicini assegnati automaticamente"""
+    event = get_event_by_id(event_id)
+    if not event:
+        flash("Evento non trovato.")
+        return redirect(url_for('dashboard'))
+
+    name = request.form.get('name', '').strip()
+    email = request.form.get('email')
+    count = parse_party_size(request.form.get('count'))
+    if not name:
+        flash('Inserisci il nome del cliente!')
+        return redirect(url_for('admin_book_seats', event_id=event_id))
+    if count is None:
+        flash('Numero di posti non valido (da 1 a 10).')
+        return redirect(url_for('admin_book_seats', event_id=event_id))
+
+    booking_id, seats = quick_sale(event_id, name, email, count)
+    if booking_id is None:
+        flash(f'Nessun blocco di {count} posti vicini disponibile: selezionali sulla piantina.', 'warning')
+        return redirect(url_for('admin_book_seats', event_id=event_id))
+    flash(f"Vendita registrata: posti {', '.join(seats)}", 'success')
+    return redirect(url_for('admin_book_seats', event_id=event_id))
 
 # ---------- PAGAMENTI STRIPE ----------
 
 @app.route('/createcheckoutsession', methods=['GET'])
+@limiter.limit('checkout')
 def createcheckoutsession():
     """Crea sessione checkout Stripe"""
     booking_id = int(request.args['booking_id'])
     booking = get_booking_by_id(booking_id)
+    if booking is None or booking['status'] != 1:
+        flash("Prenotazione non trovata o scaduta. Riprova.", "danger")
+        return redirect(url_for('index'))
+    # Ricarica o pulsante indietro: si riusa la sessione già creata
+    if booking['stripe_checkout_url']:
+        return redirect(booking['stripe_checkout_url'], code=303)
     event = get_event_by_id(booking['event_id'])
+    # Posti riservati finché la sessione è pagabile: un pagamento non arriva mai per posti rivenduti
+    session_expires_at = int(time.time()) + STRIPE_SESSION_TTL
+    if not extend_booking_hold(booking_id, session_expires_at + STRIPE_HOLD_MARGIN):
+        flash("Prenotazione non trovata o scaduta. Riprova.", "danger")
+        return redirect(url_for('select_seats', event_id=booking['event_id']))
 
     # Prepara dati prodotto
     product_data = {
-        'name': f"{event['title']} : {event['date']}:  {event['time']}",
+        'name': f"{event['title']} : {format_event_date(event['date'])}:  {event['time']}",
         'description': f"Posti: {booking['seats']} TICKET N: {booking_id}",
     }
 
-    session_stripe = stripe.checkout.Session.create(
-        payment_method_types=['card'],
-        mode='payment',
-        customer_email=booking['email'],
-        line_items=[{
-            'price_data': {
-                'currency': 'eur',
-                'unit_amount': int(event['price'] * 100),
-                'product_data': product_data
-            },
-            'quantity': len(booking['seats'].split(','))
-        }],
-        metadata={'booking_id': booking_id},
-        success_url=STRIPE_SUCCESS_URL,
-        cancel_url=STRIPE_CANCEL_URL
-    )
+    stripe = get_stripe()
+    try:
+        session_stripe = stripe_call(
+            stripe.checkout.Session.create,
+            payment_method_types=['card'],
+            mode='payment',
+            customer_email=booking['email'],
+            line_items=[{
+                'price_data': {
+                    'currency': 'eur',
+                    'unit_amount': int(event['price'] * 100),
+                    'product_data': product_data
+                },
+                'quantity': len(booking['seats'].split(','))
+            }],
+            metadata={'booking_id': booking_id},
+            client_reference_id=str(booking_id),
+            # Durata minima consentita da Stripe: alla scadenza arriva checkout.session.expired
+            expires_at=session_expires_at,
+            success_url=STRIPE_SUCCESS_URL,
+            cancel_url=STRIPE_CANCEL_URL
+        )
+    except (CircuitOpenError, stripe.error.StripeError) as e:
+        logger.error(f"Creazione checkout Stripe fallita per prenotazione {booking_id}: {e}")
+        # I posti tornano subito liberi, il cliente può riprovare
+        delete_booking(booking_id)
+        flash("Servizio di pagamento momentaneamente non disponibile. Riprova tra qualche minuto.", "danger")
+        return redirect(url_for('select_seats', event_id=booking['event_id']))
+    set_booking_stripe_session(booking_id, session_stripe.id, session_stripe.url)
 
     return redirect(session_stripe.url, code=303)
 
+@app.route('/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    """Eventi Stripe firmati: conferma o libera le prenotazioni"""
+    try:
+        event = construct_stripe_event(request.get_data(), request.headers.get('Stripe-Signature'))
+    except ValueError as e:
+        logger.warning(f"Webhook Stripe rifiutato: {e}")
+        return jsonify({'error': 'Firma non valida'}), 400
+
+    handle_stripe_event(event)
+    return jsonify({'received': True})
+
 @app.route('/payment/success')
 def payment_success():
-    """Gestione pagamento riuscito"""
+    """Pagina di ritorno dal checkout: mostra lo stato locale della prenotazione"""
     session_id = request.args.get('session_id')
     if not session_id:
         flash("Errore: sessione non trovata", "danger")
         return redirect(url_for('index'))
 
-    session_stripe = stripe.checkout.Session.retrieve(session_id)
-    booking_id = int(session_stripe.metadata['booking_id'])
-
-    booking = get_booking_by_id(booking_id)
+    # La conferma arriva dal webhook: qui nessuna chiamata a Stripe
+    booking = get_booking_by_stripe_session(session_id)
+    if booking is None:
+        flash("Prenotazione non trovata", "danger")
+        return redirect(url_for('index'))
     event = get_event_by_id(booking['event_id'])
-    
-    if booking and booking['status'] == 1:
-        update_booking_status(booking_id, 2)  # Status 2 = pagato
-        send_booking_confirmation_with_pdf(booking_id)
-    else:
-        flash("Prenotazione non trovata o già pagata", "danger")
 
-    return render_template('payment_success.html', event=event, booking=booking)
+    if booking['status'] == 0:
+        flash("La prenotazione è scaduta prima della conferma del pagamento: contatta il teatro.", "danger")
+
+    return render_template(
+        'payment_success.html', event=event, booking=booking, pending=booking['status'] == 1
+    )
 
 @app.route('/payment/cancel')
 def payment_cancel():
@@ -415,9 +678,9 @@ def payment_cancel():
         flash("Errore: sessione non trovata", "danger")
         return redirect(url_for('index'))
 
-    session_stripe = stripe.checkout.Session.retrieve(session_id)
-    booking_id = int(session_stripe.metadata['booking_id'])
-    delete_booking(booking_id)
+    booking = get_booking_by_stripe_session(session_id)
+    if booking is not None and booking['status'] == 1:
+        delete_booking(booking['id'])
     
     return render_template('payment_cancel.html')
 
@@ -428,13 +691,30 @@ def payment_cancel():
 def event_transactions(event_id):
     """Lista transazioni per evento"""
     event = get_event_by_id(event_id)
-    transactions = get_bookings_by_event(event_id)
-    
+    status = request.args.get('status', type=int)
+    search = request.args.get('q', '').strip()
+
+    # Chiave di paginazione "created_at|id" dell'ultima riga della pagina precedente
+    after = None
+    cursor = request.args.get('after', '')
+    if '|' in cursor:
+        created_at, _, last_id = cursor.rpartition('|')
+        if last_id.isdigit():
+            after = (created_at, int(last_id))
+
+    transactions, next_key = get_event_transactions_page(
+        event_id, status=status, search=search or None, after=after
+    )
+
     return render_template(
         'event_transactions.html',
         event_id=event_id,
         event_title=event['title'] if event else 'Evento sconosciuto',
-        transactions=transactions
+        transactions=transactions,
+        status=status,
+        search=search,
+        first_page=after is None,
+        next_cursor=f'{next_key[0]}|{next_key[1]}' if next_key else None
     )
 
 @app.route('/resend_ticket/<int:booking_id>', methods=['POST'])
@@ -450,8 +730,8 @@ def resend_ticket(booking_id):
         flash('Solo le prenotazioni pagate o validate possono ricevere il biglietto.', 'warning')
         return redirect(request.referrer or url_for('dashboard'))
     
-    send_booking_confirmation_with_pdf(booking_id)
-    flash('Biglietto inviato nuovamente a ' + booking['email'], 'success')
+    enqueue_booking_confirmation(booking_id)
+    flash('Biglietto in invio a ' + booking['email'], 'success')
     return redirect(request.referrer or url_for('dashboard'))
 
 @app.route('/delete_transaction/<int:booking_id>', methods=['POST'])
@@ -490,6 +770,7 @@ def generate_ticket_pdf_route(booking_id):
             return redirect(url_for('dashboard'))
         
         # Genera PDF
+        from pdf_generator import generate_email_ticket_pdf
         pdf_data = generate_email_ticket_pdf(booking, event)
         
         # Prepara nome file
@@ -518,15 +799,13 @@ def generate_event_summary_pdf_route(event_id):
             flash('Evento non trovato.', 'error')
             return redirect(url_for('dashboard'))
         
-        # Ottieni tutte le transazioni dell'evento
-        bookings = get_event_transactions(event_id)
-        
-        if not bookings:
+        if not count_event_bookings(event_id, ACTIVE_STATUSES):
             flash('Nessuna prenotazione trovata per questo evento.', 'warning')
             return redirect(url_for('event_transactions', event_id=event_id))
         
-        # Genera PDF riassuntivo
-        pdf_data = generate_tickets_summary_pdf(bookings, event)
+        # Genera PDF riassuntivo leggendo le prenotazioni dal cursore
+        from pdf_generator import generate_tickets_summary_pdf
+        pdf_data = generate_tickets_summary_pdf(iter_event_bookings(event_id, ACTIVE_STATUSES), event)
         
         # Prepara nome file
         filename = f"riepilogo_{event['title'].replace(' ', '_')}.pdf"
@@ -544,9 +823,96 @@ def generate_event_summary_pdf_route(event_id):
         flash('Errore durante la generazione del PDF riepilogo.', 'error')
         return redirect(url_for('dashboard'))
 
+@app.route('/event/<int:event_id>/transactions/export')
+@login_required
+def export_event_transactions(event_id):
+    """Esporta le transazioni in CSV/XLSX con filtri su stato, date e colonne"""
+    event = get_event_by_id(event_id)
+    if not event:
+        flash('Evento non trovato.', 'error')
+        return redirect(url_for('dashboard'))
+
+    export_format = request.args.get('format', 'csv')
+    columns = parse_columns(request.args.get('columns'))
+    statuses = [s for s in request.args.getlist('status', type=int) if s in STATUS_LABELS]
+    date_from = request.args.get('from') or None
+    date_to = request.args.get('to') or None
+
+    if export_format not in EXPORT_FORMATS or columns is None:
+        flash('Parametri di esportazione non validi.', 'error')
+        return redirect(url_for('event_transactions', event_id=event_id))
+    try:
+        for value in (date_from, date_to):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        flash('Date di esportazione non valide.', 'error')
+        return redirect(url_for('event_transactions', event_id=event_id))
+    if export_format == 'xlsx' and not xlsx_available():
+        flash('Esportazione XLSX non disponibile (openpyxl non installato).', 'error')
+        return redirect(url_for('event_transactions', event_id=event_id))
+
+    filters = dict(columns=columns, statuses=statuses, date_from=date_from, date_to=date_to)
+    filename = f"transazioni_{event['title'].replace(' ', '_')}.{export_format}"
+    if export_format == 'xlsx':
+        body = stream_xlsx(event_id, **filters)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body = stream_csv(event_id, **filters)
+        # Werkzeug aggiunge charset=utf-8 ai tipi text/*
+        mimetype = 'text/csv'
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/event/<int:event_id>/tickets_export')
+@login_required
+def export_event_tickets_route(event_id):
+    """Scarica in un unico ZIP tutti i biglietti pagati o cassa di un evento"""
+    event = get_event_by_id(event_id)
+    if not event:
+        flash('Evento non trovato.', 'error')
+        return redirect(url_for('dashboard'))
+
+    body = start_event_tickets_zip(event)
+    if body is None:
+        flash("Un'altra esportazione dei biglietti è in corso: riprova tra qualche minuto.", 'warning')
+        return redirect(url_for('dashboard'))
+
+    filename = f"biglietti_{event['title'].replace(' ', '_')}.zip"
+    return Response(
+        stream_with_context(body),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/event/<int:event_id>/tickets_export/progress')
+@login_required
+def export_event_tickets_progress(event_id):
+    """Avanzamento dell'esportazione ZIP dei biglietti (condiviso tra i worker)"""
+    progress = get_export_progress(event_id)
+    if progress is None:
+        return jsonify({'error': 'Nessuna esportazione avviata'}), 404
+    return jsonify(progress)
+
+@app.route('/admin/jobs')
+@login_required
+def admin_jobs():
+    """Leader dei job periodici e ultime esecuzioni"""
+    lease = get_job_lease(job_runner.lease_name)
+    return jsonify({
+        'leader': dict(lease) if lease else None,
+        'this_process': {'holder': job_runner.holder, 'is_leader': job_runner.is_leader},
+        'runs': get_recent_job_runs(),
+    })
+
 # ---------- AVVIO APPLICAZIONE ----------
 
 def run():
+    create_app()
+    start_background_services()
     app.run(debug=True)
 
 if __name__ == '__main__':
@@ -1,5 +1,10 @@
 import re
-from database import get_bookings_by_event
+from database import count_taken_seats, create_booking
+from occupancy import engine as occupancy
+from seat_allocator import allocator as seat_allocator, MAX_PARTY_SIZE
+
+# Tentativi di vendita rapida se il blocco scelto viene occupato nel frattempo
+QUICK_SALE_ATTEMPTS = 3
 
 def allowed_file(filename):
     """Verifica se il file ha estensione consentita"""
@@ -11,19 +16,45 @@ def check_seats_available(event_id, seats_to_check):
     Restituisce True se tutti i posti sono ancora disponibili per l'evento, 
     False se almeno uno è già prenotato.
     """
-    bookings = get_bookings_by_event(event_id, statuses=[1, 2, 3])
-    booked_seats = set()
-    for b in bookings:
-        booked_seats.update(b['seats'].split(','))
-    return all(seat not in booked_seats for seat in seats_to_check)
+    return count_taken_seats(event_id, list(seats_to_check)) == 0
 
 def get_booked_seats(event_id):
-    """Ottieni set dei posti già prenotati per un evento"""
-    bookings = get_bookings_by_event(event_id, statuses=[1, 2, 3])
-    booked_seats = set()
-    for b in bookings:
-        booked_seats.update(b['seats'].split(','))
-    return booked_seats
+    """
+    Ottieni i posti già prenotati per un evento dalla mappa in memoria.
+    Ritorna uno SeatSnapshot (supporta `seat in ...`) senza accessi al database.
+    """
+    return occupancy.snapshot(event_id)
+
+def find_best_seats(event_id, count):
+    """
+    Miglior blocco di count posti contigui liberi (più vicino al centro del
+    palcoscenico) come lista di nomi, oppure None se non ce n'è uno
+    """
+    return seat_allocator.best_block(event_id, count)
+
+def quick_sale(event_id, name, email, count, status=3):
+    """
+    Vendita rapida in cassa: assegna il miglior blocco libero e lo prenota.
+    Ritorna (booking_id, posti) oppure (None, None) se non c'è un blocco libero.
+    """
+    for _ in range(QUICK_SALE_ATTEMPTS):
+        seats = find_best_seats(event_id, count)
+        if seats is None:
+            return None, None
+        # Conflitto (mappa di un altro worker non ancora vista): create_booking
+        # ricarica la mappa e si riprova con il blocco successivo
+        booking_id = create_booking(event_id, name, email, ','.join(seats), status=status)
+        if booking_id is not None:
+            return booking_id, seats
+    return None, None
+
+def parse_party_size(value):
+    """Numero di posti richiesto (1..MAX_PARTY_SIZE) oppure None se non valido"""
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        return None
+    return count if 1 <= count <= MAX_PARTY_SIZE else None
 
 def validate_email(email):
     """Valida formato email"""
@@ -11,7 +11,7 @@ load_dotenv(env_path)
 # Percorsi
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(BASE_DIR, 'config.json')
-DB_PATH = os.path.join(BASE_DIR, 'data', 'cinema.db')
+DB_PATH = os.getenv('DB_PATH', os.path.join(BASE_DIR, 'data', 'cinema.db'))
 IMG_PATH = os.path.join(BASE_DIR, 'static', 'img')
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'posters')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
@@ -33,10 +33,15 @@ STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY')
 STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SUCCESS_URL = os.getenv('STRIPE_SUCCESS_URL')
 STRIPE_CANCEL_URL = os.getenv('STRIPE_CANCEL_URL')
-print(f"STRIPE_SUCCESS_URL: {STRIPE_SUCCESS_URL}")
-print(f"STRIPE_CANCEL_URL: {STRIPE_CANCEL_URL}")
-print(f"STRIPE_SECRET_KEY: {STRIPE_SECRET_KEY}")
-print(f"STRIPE_PUBLISHABLE_KEY: {STRIPE_PUBLISHABLE_KEY}")
+# Segreto di firma dell'endpoint webhook (whsec_...)
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+# Durata delle sessioni di checkout (minimo consentito da Stripe: 30 minuti)
+STRIPE_SESSION_TTL = 1800
+# La prenotazione resta riservata fino alla scadenza della sessione più questo
+# margine (secondi), per il ritardo del webhook di pagamento
+STRIPE_HOLD_MARGIN = 120
+# Endpoint API alternativo (solo per prove con un server Stripe finto locale)
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
 
 
 
@@ -46,8 +51,49 @@ print(f"STRIPE_PUBLISHABLE_KEY: {STRIPE_PUBLISHABLE_KEY}")
 # Configurazioni Email da variabili d'ambiente
 EMAIL_SENDER = 'booking@tsrbooking.it'
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
-SMTP_SERVER = 'smtp.ionos.it'
-SMTP_PORT = 587
+SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.ionos.it')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+# Disattivabili per server SMTP locali di prova (es. aiosmtpd)
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', '1') == '1'
+SMTP_LOGIN = os.getenv('SMTP_LOGIN', '1') == '1'
+
+# Durata in secondi di una prenotazione in attesa di pagamento prima che i posti tornino liberi
+BOOKING_HOLD_SECONDS = int(os.getenv('BOOKING_HOLD_SECONDS', '300'))
+
+# Coda email (outbox): numero di thread che la svuotano in ogni processo
+EMAIL_WORKERS = int(os.getenv('EMAIL_WORKERS', '2'))
+
+# Esportazione massiva biglietti: processi di rendering e memoria massima per processo
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', str(os.cpu_count() or 1)))
+EXPORT_WORKER_MEMORY_MB = int(os.getenv('EXPORT_WORKER_MEMORY_MB', '1024'))
+# Esportazioni contemporanee sull'intero host (ognuna avvia EXPORT_WORKERS processi)
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', '1'))
+
+# Piantina live (SSE): stream aperti al massimo per processo (ognuno occupa un thread
+# del worker gthread) e durata massima di uno stream prima della riconnessione del browser
+SEAT_STREAM_LIMIT = int(os.getenv('SEAT_STREAM_LIMIT', '16'))
+SEAT_STREAM_MAX_SECONDS = int(os.getenv('SEAT_STREAM_MAX_SECONDS', '300'))
+
+# Metriche Prometheus: cartella condivisa dai processi e token per /metrics
+# (senza token /metrics risponde solo alle richieste da localhost)
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(BASE_DIR, 'data', 'metrics'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Sala d'attesa per la selezione posti: acquirenti ammessi al secondo (0 = dalla capacità
+# di scrittura misurata), ingressi immediati a coda vuota e durata di un'ammissione
+WAITING_ROOM_ENABLED = os.getenv('WAITING_ROOM_ENABLED', '1') == '1'
+WAITING_ROOM_RATE = float(os.getenv('WAITING_ROOM_RATE', '0'))
+WAITING_ROOM_BURST = int(os.getenv('WAITING_ROOM_BURST', '20'))
+WAITING_ROOM_ADMISSION_SECONDS = int(os.getenv('WAITING_ROOM_ADMISSION_SECONDS', '900'))
+
+# Limiti di frequenza per client (prenotazione, checkout, login): backend 'sqlite'
+# (condiviso dai worker gunicorn) oppure 'memory' (un solo processo)
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'sqlite')
+# Reverse proxy davanti all'applicazione (nginx): quanti X-Forwarded-For sono affidabili.
+# 0 se gunicorn è esposto direttamente (gli header del client verrebbero accettati)
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '1'))
+RATE_LIMIT_DB_PATH = os.getenv('RATE_LIMIT_DB_PATH', os.path.join(BASE_DIR, 'data', 'rate_limits.db'))
 
 # Configurazioni Teatro dal JSON
 UNAVAILABLE_SEATS = set(CONFIG['unavailable_seats'])
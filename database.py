@@ -1,184 +1,1072 @@
+import os
+import logging
+import math
 import sqlite3
-from datetime import datetime, timedelta
-from config import DB_PATH
-#peppe
-def get_db():
-    """Ottieni connessione al database"""
-    conn = sqlite3.connect(DB_PATH)
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from config import DB_PATH, BOOKING_HOLD_SECONDS
+from occupancy import engine as occupancy
+from hold_expiry import engine as hold_expiry
+from event_cache import cache as event_cache
+from waiting_room import capacity as write_capacity
+from metrics import SQLConnection
+
+logger = logging.getLogger(__name__)
+
+# Stati di una prenotazione che occupano i posti
+ACTIVE_STATUSES = (1, 2, 3)
+
+# Formato di created_at: ISO, ordinabile e confrontabile come testo
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Formato della data degli eventi: ISO nel database, gg/mm/aaaa a video
+EVENT_DATE_FORMAT = '%Y-%m-%d'
+EVENT_DATE_DISPLAY_FORMAT = '%d/%m/%Y'
+# Transazioni per pagina nella lista admin
+TRANSACTIONS_PAGE_SIZE = 50
+# Le prenotazioni scadute restano visibili per questo tempo, poi vanno in archivio
+RELEASED_RETENTION_SECONDS = 7 * 24 * 3600
+ARCHIVE_BATCH_SIZE = 500
+
+# Dimensione della cache degli statement preparati per connessione
+CACHED_STATEMENTS = 256
+
+# PRAGMA applicati una sola volta, all'apertura di ogni connessione
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA mmap_size = 67108864',
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Connessioni riutilizzate per thread: una di scrittura e una di sola lettura
+_pool = threading.local()
+
+def _connect(readonly=False):
+    """Apre una nuova connessione configurata (WAL, pragma, cache statement, query misurate)"""
+    if readonly:
+        conn = sqlite3.connect(
+            f'file:{DB_PATH}?mode=ro', uri=True, cached_statements=CACHED_STATEMENTS, factory=SQLConnection
+        )
+    else:
+        conn = sqlite3.connect(DB_PATH, cached_statements=CACHED_STATEMENTS, factory=SQLConnection)
+        # Con WAL i lettori non attendono lo scrittore (impostazione persistente nel file)
+        conn.execute('PRAGMA journal_mode = WAL')
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
-def reset_transazioni_scadute():
-    """Reset delle transazioni scadute (chiamata dal scheduler)"""
-    conn = get_db() 
-    cur = conn.cursor()
+def _pooled(kind, readonly):
+    # Dopo un fork (gunicorn) le connessioni del processo padre non vanno riusate
+    pid = os.getpid()
+    if getattr(_pool, 'pid', None) != pid:
+        _pool.__dict__.clear()
+        _pool.pid = pid
+    conn = getattr(_pool, kind, None)
+    if conn is None:
+        conn = _connect(readonly)
+        setattr(_pool, kind, conn)
+    return conn
 
-    # Calcolo soglia temporale (ora - 5 minuti)
-    limite = datetime.now() - timedelta(minutes=5)
-    cur.execute("""
-        UPDATE bookings
-        SET status = 0
-        WHERE status = 1 AND created_at <= ?
-    """, (limite.strftime("%d-%m-%Y %H:%M:%S"),))
+#peppe
+def get_db():
+    """Ottieni la connessione di scrittura del thread corrente"""
+    return _pooled('writer', readonly=False)
+
+def get_read_db():
+    """Ottieni la connessione di sola lettura del thread corrente"""
+    try:
+        return _pooled('reader', readonly=True)
+    except sqlite3.OperationalError:
+        # Database non ancora creato: ripiega sulla connessione di scrittura
+        return get_db()
+
+def close_db():
+    """Chiude le connessioni del thread corrente"""
+    for kind in ('writer', 'reader'):
+        conn = _pool.__dict__.pop(kind, None)
+        if conn is not None:
+            conn.close()
 
+@contextmanager
+def write_transaction():
+    """Transazione di scrittura (BEGIN IMMEDIATE) con commit o rollback automatico"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    # Durata di possesso del lock di scrittura: capacità usata dalla sala d'attesa
+    locked_at = time.perf_counter()
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
     conn.commit()
-    conn.close()
+    write_capacity.observe(time.perf_counter() - locked_at)
+
+# ---------- SCHEMA E MIGRAZIONI ----------
+
+def _migration_base_schema(conn):
+    """Tabelle originali eventi e prenotazioni"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            price REAL NOT NULL,
+            poster_url TEXT,
+            visible INTEGER DEFAULT 1
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL,
+            seats TEXT NOT NULL,          -- posti separati da ,
+            status REAL DEFAULT 0 , -- 0=libero, 1=pending ,2 = acquistato , 3 = validato
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(event_id) REFERENCES events(id)
+        )
+    """)
+
+def _migration_booking_seats(conn):
+    """Tabella dei singoli posti occupati, con vincolo UNIQUE (event_id, seat)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS booking_seats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL,
+            event_id INTEGER NOT NULL,
+            seat TEXT NOT NULL,
+            status INTEGER NOT NULL,      -- 1=pending, 2=acquistato, 3=validato
+            FOREIGN KEY(booking_id) REFERENCES bookings(id),
+            FOREIGN KEY(event_id) REFERENCES events(id)
+        )
+    """)
+    conn.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_booking_seats_event_seat '
+        'ON booking_seats(event_id, seat)'
+    )
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_booking_seats_booking '
+        'ON booking_seats(booking_id)'
+    )
+
+    # Backfill dalle prenotazioni attive esistenti (la prima prenotazione vince)
+    placeholders = ','.join(['?'] * len(ACTIVE_STATUSES))
+    bookings = conn.execute(
+        f'SELECT id, event_id, seats, status FROM bookings WHERE status IN ({placeholders}) ORDER BY id',
+        ACTIVE_STATUSES
+    ).fetchall()
+    conflicts = 0
+    for b in bookings:
+        for seat in b['seats'].split(','):
+            cur = conn.execute(
+                'INSERT OR IGNORE INTO booking_seats (booking_id, event_id, seat, status) VALUES (?, ?, ?, ?)',
+                (b['id'], b['event_id'], seat, int(b['status']))
+            )
+            if cur.rowcount == 0:
+                conflicts += 1
+    if conflicts:
+        logger.warning(f"Backfill booking_seats: {conflicts} posti già occupati da altre prenotazioni")
+
+def _migration_event_stats(conn):
+    """Contatori posti per evento aggiornati da trigger su booking_seats"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_stats (
+            event_id INTEGER PRIMARY KEY,
+            pending INTEGER NOT NULL DEFAULT 0,    -- posti con status 1
+            sold INTEGER NOT NULL DEFAULT 0,       -- posti con status 2
+            validated INTEGER NOT NULL DEFAULT 0   -- posti con status 3
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_booking_seats_stats_insert
+        AFTER INSERT ON booking_seats
+        BEGIN
+            INSERT OR IGNORE INTO event_stats (event_id) VALUES (NEW.event_id);
+            UPDATE event_stats SET
+                pending = pending + (NEW.status = 1),
+                sold = sold + (NEW.status = 2),
+                validated = validated + (NEW.status = 3)
+            WHERE event_id = NEW.event_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_booking_seats_stats_delete
+        AFTER DELETE ON booking_seats
+        BEGIN
+            UPDATE event_stats SET
+                pending = pending - (OLD.status = 1),
+                sold = sold - (OLD.status = 2),
+                validated = validated - (OLD.status = 3)
+            WHERE event_id = OLD.event_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_booking_seats_stats_update
+        AFTER UPDATE OF status ON booking_seats
+        WHEN OLD.status != NEW.status
+        BEGIN
+            UPDATE event_stats SET
+                pending = pending - (OLD.status = 1) + (NEW.status = 1),
+                sold = sold - (OLD.status = 2) + (NEW.status = 2),
+                validated = validated - (OLD.status = 3) + (NEW.status = 3)
+            WHERE event_id = NEW.event_id;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_events_stats_delete
+        AFTER DELETE ON events
+        BEGIN
+            DELETE FROM event_stats WHERE event_id = OLD.id;
+        END
+    """)
+
+    # Backfill dai posti già presenti
+    conn.execute("""
+        INSERT OR REPLACE INTO event_stats (event_id, pending, sold, validated)
+        SELECT event_id, SUM(status = 1), SUM(status = 2), SUM(status = 3)
+        FROM booking_seats
+        GROUP BY event_id
+    """)
+
+def _migration_seat_changes(conn):
+    """Registro delle variazioni dei posti, letto dagli stream live della piantina"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS seat_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            seat TEXT NOT NULL,
+            status INTEGER NOT NULL,       -- 0 = liberato, altrimenti status del posto
+            changed_at INTEGER NOT NULL    -- epoch in secondi
+        )
+    """)
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_seat_changes_changed_at ON seat_changes(changed_at)'
+    )
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_booking_seats_changes_insert
+        AFTER INSERT ON booking_seats
+        BEGIN
+            INSERT INTO seat_changes (event_id, seat, status, changed_at)
+            VALUES (NEW.event_id, NEW.seat, NEW.status, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_booking_seats_changes_update
+        AFTER UPDATE OF status ON booking_seats
+        WHEN OLD.status != NEW.status
+        BEGIN
+            INSERT INTO seat_changes (event_id, seat, status, changed_at)
+            VALUES (NEW.event_id, NEW.seat, NEW.status, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_booking_seats_changes_delete
+        AFTER DELETE ON booking_seats
+        BEGIN
+            INSERT INTO seat_changes (event_id, seat, status, changed_at)
+            VALUES (OLD.event_id, OLD.seat, 0, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    """)
+
+def _migration_email_outbox(conn):
+    """Coda persistente delle email da inviare"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,                      -- tipo di email (es. booking_confirmation)
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending, sending, sent, failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,        -- epoch in secondi
+            locked_at INTEGER,
+            last_error TEXT,
+            created_at INTEGER NOT NULL,
+            sent_at INTEGER
+        )
+    """)
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_email_outbox_status_next '
+        'ON email_outbox(status, next_attempt_at)'
+    )
+
+def _migration_iso_timestamps(conn):
+    """
+    created_at delle prenotazioni da 'gg-mm-aaaa hh:mm:ss' a 'aaaa-mm-gg hh:mm:ss'
+    (ordinabile come testo) e indice per le liste per evento in ordine di data
+    """
+    conn.execute("""
+        UPDATE bookings
+        SET created_at = substr(created_at, 7, 4) || '-' || substr(created_at, 4, 2) || '-'
+                         || substr(created_at, 1, 2) || substr(created_at, 11)
+        WHERE created_at GLOB '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9]*'
+    """)
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_bookings_event_created '
+        'ON bookings(event_id, created_at)'
+    )
+
+def _migration_hold_expiry(conn):
+    """
+    Scadenza delle prenotazioni in attesa (expires_at, epoch) con indice per
+    stato, e tabella di archivio delle prenotazioni scadute
+    """
+    conn.execute('ALTER TABLE bookings ADD COLUMN expires_at INTEGER')
+    # Anche le prenotazioni già scadute, per poterle archiviare
+    holds = conn.execute('SELECT id, created_at FROM bookings WHERE status IN (0, 1)').fetchall()
+    now = int(time.time())
+    expiries = []
+    for row in holds:
+        try:
+            expires_at = int(datetime.strptime(row['created_at'], TIMESTAMP_FORMAT).timestamp()) + BOOKING_HOLD_SECONDS
+        except (TypeError, ValueError):
+            # Data non riconosciuta: la prenotazione scade subito invece di bloccare l'avvio
+            logger.warning(f"Prenotazione {row['id']}: created_at non valido {row['created_at']!r}, scade subito")
+            expires_at = now
+        expiries.append((expires_at, row['id']))
+    conn.executemany('UPDATE bookings SET expires_at = ? WHERE id = ?', expiries)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_bookings_status_expires ON bookings(status, expires_at)')
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bookings_archive (
+            id INTEGER PRIMARY KEY,
+            event_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL,
+            seats TEXT NOT NULL,
+            status REAL,
+            created_at TEXT NOT NULL,
+            expires_at INTEGER,
+            archived_at INTEGER NOT NULL
+        )
+    """)
+
+def _migration_stripe_webhooks(conn):
+    """Sessione Stripe di ogni prenotazione ed eventi webhook già elaborati"""
+    conn.execute('ALTER TABLE bookings ADD COLUMN stripe_session_id TEXT')
+    conn.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_stripe_session '
+        'ON bookings(stripe_session_id)'
+    )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            id TEXT PRIMARY KEY,          -- id evento Stripe (evt_...)
+            type TEXT NOT NULL,
+            received_at INTEGER NOT NULL  -- epoch in secondi
+        )
+    """)
+
+def _migration_stripe_checkout_url(conn):
+    """URL della sessione di checkout, riusato se il cliente ricarica la pagina"""
+    conn.execute('ALTER TABLE bookings ADD COLUMN stripe_checkout_url TEXT')
+
+def _migration_job_leases(conn):
+    """Lease del leader dei job periodici e storico delle esecuzioni"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,         -- host:pid del processo leader
+            expires_at REAL NOT NULL      -- epoch in secondi
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job TEXT NOT NULL,
+            holder TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            duration REAL NOT NULL,       -- secondi
+            status TEXT NOT NULL,         -- ok, error
+            error TEXT
+        )
+    """)
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_job_runs_job_started '
+        'ON job_runs(job, started_at)'
+    )
+
+def _migration_event_dates(conn):
+    """
+    Data degli eventi da 'gg/mm/aaaa' a 'aaaa-mm-gg' (ordinabile come testo),
+    indice per gli eventi visibili in ordine di data e versione della lista
+    eventi aggiornata da trigger (invalidazione della cache tra processi)
+    """
+    conn.execute("""
+        UPDATE events
+        SET date = substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2)
+        WHERE date GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]'
+    """)
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_events_visible_date '
+        'ON events(visible, date, time)'
+    )
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS events_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL   -- epoch in secondi
+        )
+    """)
+    conn.execute(
+        "INSERT OR IGNORE INTO events_version (id, version, updated_at) VALUES (1, 1, CAST(strftime('%s', 'now') AS INTEGER))"
+    )
+    for operation in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_events_version_{operation.lower()}
+            AFTER {operation} ON events
+            BEGIN
+                UPDATE events_version SET
+                    version = version + 1,
+                    updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+                WHERE id = 1;
+            END
+        """)
+
+def _migration_waiting_rooms(conn):
+    """Stato della sala d'attesa per evento (biglietti emessi e fronte di ammissione)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS waiting_rooms (
+            event_id INTEGER PRIMARY KEY,
+            issued INTEGER NOT NULL,      -- ultimo biglietto emesso
+            admitted REAL NOT NULL,       -- biglietti ammessi fino a updated_at
+            rate REAL NOT NULL,           -- ammissioni al secondo
+            burst INTEGER NOT NULL,       -- ammissioni immediate a coda vuota
+            updated_at REAL NOT NULL      -- epoch in secondi
+        )
+    """)
+
+def _migration_ticket_exports(conn):
+    """Esportazioni ZIP dei biglietti in corso e loro avanzamento, visibili a tutti i worker"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ticket_exports (
+            event_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            finished INTEGER NOT NULL DEFAULT 0,
+            started_at REAL NOT NULL,     -- epoch in secondi
+            updated_at REAL NOT NULL      -- ultimo avanzamento
+        )
+    """)
+
+# Migrazioni in ordine: l'indice+1 corrisponde a PRAGMA user_version
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_booking_seats,
+    _migration_event_stats,
+    _migration_seat_changes,
+    _migration_email_outbox,
+    _migration_iso_timestamps,
+    _migration_hold_expiry,
+    _migration_stripe_webhooks,
+    _migration_stripe_checkout_url,
+    _migration_job_leases,
+    _migration_event_dates,
+    _migration_waiting_rooms,
+    _migration_ticket_exports,
+]
+
+def init_db():
+    """Crea il database se manca e applica le migrazioni non ancora eseguite"""
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    conn = get_db()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+        logger.info(f"Migrazione database {number} ({migration.__name__}) applicata")
+
+def release_expired_holds(now=None):
+    """
+    Libera le prenotazioni in attesa con scadenza passata (chiamata dal motore
+    di scadenza). Ritorna il numero di prenotazioni liberate.
+    """
+    now = time.time() if now is None else now
+    # Lock di scrittura subito: le prenotazioni lette sono quelle effettivamente liberate
+    with write_transaction() as conn:
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM bookings WHERE status = 1 AND expires_at <= ?', (now,)
+        )]
+        if not ids:
+            return 0
+        placeholders = ','.join(['?'] * len(ids))
+        # Si liberano i posti delle righe eliminate, non quelli del testo bookings.seats
+        # (RETURNING richiede SQLite >= 3.35)
+        freed = conn.execute(
+            f'DELETE FROM booking_seats WHERE booking_id IN ({placeholders}) RETURNING event_id, seat', ids
+        ).fetchall()
+        conn.execute(f'UPDATE bookings SET status = 0 WHERE id IN ({placeholders})', ids)
+
+    seats_by_event = {}
+    for row in freed:
+        seats_by_event.setdefault(row['event_id'], []).append(row['seat'])
+    for event_id, seats in seats_by_event.items():
+        occupancy.set_seats(event_id, seats, 0)
+    return len(ids)
+
+def get_next_hold_expiry():
+    """Scadenza più vicina tra le prenotazioni in attesa, oppure None"""
+    return get_read_db().execute(
+        'SELECT MIN(expires_at) FROM bookings WHERE status = 1'
+    ).fetchone()[0]
+
+def archive_released_bookings(retention_seconds=RELEASED_RETENTION_SECONDS, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Sposta in bookings_archive le prenotazioni scadute da più di retention_seconds,
+    a lotti di batch_size per non tenere a lungo il lock di scrittura (chiamata dal scheduler)
+    """
+    cutoff = int(time.time()) - retention_seconds
+    archived = 0
+    while True:
+        with write_transaction() as conn:
+            ids = [row[0] for row in conn.execute(
+                'SELECT id FROM bookings WHERE status = 0 AND expires_at < ? LIMIT ?', (cutoff, batch_size)
+            )]
+            if not ids:
+                break
+            placeholders = ','.join(['?'] * len(ids))
+            conn.execute(f"""
+                INSERT OR REPLACE INTO bookings_archive
+                    (id, event_id, name, email, seats, status, created_at, expires_at, archived_at)
+                SELECT id, event_id, name, email, seats, status, created_at, expires_at, ?
+                FROM bookings WHERE id IN ({placeholders})
+            """, (int(time.time()), *ids))
+            conn.execute(f'DELETE FROM bookings WHERE id IN ({placeholders})', ids)
+        archived += len(ids)
+    if archived:
+        logger.info(f"Archiviate {archived} prenotazioni scadute")
+    return archived
 
 def get_all_events():
     """Ottieni tutti gli eventi visibili"""
-    conn = get_db()
-    events = conn.execute('SELECT * FROM events WHERE visible = 1').fetchall()
-    conn.close()
-    return events
+    return get_read_db().execute('SELECT * FROM events WHERE visible = 1 ORDER BY date, time').fetchall()
+
+def get_upcoming_events(today=None):
+    """Eventi visibili da oggi in poi, in ordine di data (range sull'indice idx_events_visible_date)"""
+    today = today or datetime.now().strftime(EVENT_DATE_FORMAT)
+    return get_read_db().execute(
+        'SELECT * FROM events WHERE visible = 1 AND date >= ? ORDER BY date, time', (today,)
+    ).fetchall()
+
+def get_events_version():
+    """(versione, epoch dell'ultima modifica) della tabella events"""
+    row = get_read_db().execute('SELECT version, updated_at FROM events_version WHERE id = 1').fetchone()
+    return (row['version'], row['updated_at']) if row else (0, 0)
+
+def format_event_date(value):
+    """Data evento ISO nel formato di visualizzazione gg/mm/aaaa"""
+    try:
+        return datetime.strptime(value, EVENT_DATE_FORMAT).strftime(EVENT_DATE_DISPLAY_FORMAT)
+    except (TypeError, ValueError):
+        return value
 
 def get_all_events_admin():
     """Ottieni tutti gli eventi (inclusi quelli nascosti) per admin"""
-    conn = get_db()
-    events = conn.execute('SELECT * FROM events').fetchall()
-    conn.close()
-    return events
+    return get_read_db().execute('SELECT * FROM events').fetchall()
 
 def get_event_by_id(event_id):
     """Ottieni evento per ID"""
-    conn = get_db()
-    event = conn.execute('SELECT * FROM events WHERE id=?', (event_id,)).fetchone()
-    conn.close()
-    return event
+    return get_read_db().execute('SELECT * FROM events WHERE id=?', (event_id,)).fetchone()
 
 def create_event(title, date, time, price, poster_url=None):
-    """Crea nuovo evento"""
-    conn = get_db()
-    conn.execute(
-        "INSERT INTO events (title, date, time, price, poster_url, visible) VALUES (?, ?, ?, ?, ?, ?)",
-        (title, date, time, price, poster_url, 1)
-    )
-    conn.commit()
-    conn.close()
+    """Crea nuovo evento (date in formato aaaa-mm-gg)"""
+    with write_transaction() as conn:
+        conn.execute(
+            "INSERT INTO events (title, date, time, price, poster_url, visible) VALUES (?, ?, ?, ?, ?, ?)",
+            (title, date, time, price, poster_url, 1)
+        )
+    event_cache.invalidate()
 
 def update_event(event_id, title, date, time, price, poster_url, visible=1):
     """Aggiorna evento esistente"""
-    conn = get_db()
-    conn.execute(
-        "UPDATE events SET title=?, date=?, time=?, price=?, poster_url=?, visible=? WHERE id=?",
-        (title, date, time, price, poster_url, visible, event_id)
-    )
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE events SET title=?, date=?, time=?, price=?, poster_url=?, visible=? WHERE id=?",
+            (title, date, time, price, poster_url, visible, event_id)
+        )
+    event_cache.invalidate()
 
 def hide_event(event_id):
     """Nasconde evento impostando visible=0"""
-    conn = get_db()
-    conn.execute('UPDATE events SET visible=0 WHERE id=?', (event_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        conn.execute('UPDATE events SET visible=0 WHERE id=?', (event_id,))
+    event_cache.invalidate()
 
 def show_event(event_id):
     """Rende visibile evento impostando visible=1"""
-    conn = get_db()
-    conn.execute('UPDATE events SET visible=1 WHERE id=?', (event_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        conn.execute('UPDATE events SET visible=1 WHERE id=?', (event_id,))
+    event_cache.invalidate()
 
 def delete_event(event_id):
     """Elimina definitivamente evento e relative prenotazioni (solo per emergenze)"""
-    conn = get_db()
-    conn.execute('DELETE FROM bookings WHERE event_id=?', (event_id,))
-    conn.execute('DELETE FROM events WHERE id=?', (event_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        conn.execute('DELETE FROM booking_seats WHERE event_id=?', (event_id,))
+        conn.execute('DELETE FROM bookings WHERE event_id=?', (event_id,))
+        conn.execute('DELETE FROM events WHERE id=?', (event_id,))
+    occupancy.invalidate(event_id)
+    event_cache.invalidate()
 
 def get_booking_by_id(booking_id):
     """Ottieni prenotazione per ID"""
-    conn = get_db()
-    booking = conn.execute('SELECT * FROM bookings WHERE id=?', (booking_id,)).fetchone()
-    conn.close()
-    return booking
+    return get_read_db().execute('SELECT * FROM bookings WHERE id=?', (booking_id,)).fetchone()
 
 def get_bookings_by_event(event_id, statuses=None):
     """Ottieni prenotazioni per evento"""
-    conn = get_db()
+    conn = get_read_db()
     if statuses:
         placeholders = ','.join(['?'] * len(statuses))
-        bookings = conn.execute(
+        return conn.execute(
             f'SELECT seats FROM bookings WHERE event_id=? AND status IN ({placeholders})', 
             (event_id, *statuses)
         ).fetchall()
-    else:
-        bookings = conn.execute(
-            'SELECT * FROM bookings WHERE event_id=? ORDER BY created_at DESC', 
-            (event_id,)
-        ).fetchall()
-    conn.close()
-    return bookings
+    return conn.execute(
+        'SELECT * FROM bookings WHERE event_id=? ORDER BY created_at DESC, id DESC', 
+        (event_id,)
+    ).fetchall()
 
 def create_booking(event_id, name, email, seats_str, status=1):
-    """Crea nuova prenotazione"""
-    conn = get_db()
-    now = datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-    conn.execute(
-        'INSERT INTO bookings (event_id, name, email, seats, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-        (event_id, name, email, seats_str, status, now)
-    )
-    conn.commit()
-    booking_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
-    conn.close()
+    """
+    Crea nuova prenotazione e riserva i singoli posti.
+    Ritorna None se almeno un posto è già occupato (vincolo UNIQUE su booking_seats).
+    """
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    # Solo le prenotazioni in attesa di pagamento scadono
+    expires_at = math.ceil(time.time() + BOOKING_HOLD_SECONDS) if status == 1 else None
+    try:
+        with write_transaction() as conn:
+            cur = conn.execute(
+                'INSERT INTO bookings (event_id, name, email, seats, status, created_at, expires_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (event_id, name, email, seats_str, status, now, expires_at)
+            )
+            booking_id = cur.lastrowid
+            conn.executemany(
+                'INSERT INTO booking_seats (booking_id, event_id, seat, status) VALUES (?, ?, ?, ?)',
+                [(booking_id, event_id, seat, status) for seat in seats_str.split(',')]
+            )
+    except sqlite3.IntegrityError:
+        # La mappa in memoria non conosceva un posto occupato: va ricaricata
+        occupancy.invalidate(event_id)
+        return None
+    occupancy.set_seats(event_id, seats_str.split(','), status)
+    if expires_at is not None:
+        hold_expiry.schedule(expires_at)
     return booking_id
 
-def update_booking_status(booking_id, status):
-    """Aggiorna status prenotazione"""
-    conn = get_db()
-    conn.execute('UPDATE bookings SET status=? WHERE id=?', (status, booking_id))
-    conn.commit()
-    conn.close()
+def restore_booking(booking_id, status):
+    """
+    Riattiva una prenotazione già liberata (es. pagamento concluso dopo la
+    scadenza) se i suoi posti sono ancora liberi. Ritorna True se riuscita.
+    """
+    booking = get_booking_by_id(booking_id)
+    if booking is None:
+        return False
+    seats = booking['seats'].split(',')
+    try:
+        with write_transaction() as conn:
+            updated = conn.execute(
+                'UPDATE bookings SET status = ? WHERE id = ? AND status = 0', (status, booking_id)
+            ).rowcount
+            if not updated:
+                return False
+            conn.executemany(
+                'INSERT INTO booking_seats (booking_id, event_id, seat, status) VALUES (?, ?, ?, ?)',
+                [(booking_id, booking['event_id'], seat, status) for seat in seats]
+            )
+    except sqlite3.IntegrityError:
+        occupancy.invalidate(booking['event_id'])
+        return False
+    occupancy.set_seats(booking['event_id'], seats, status)
+    return True
+
+def update_booking_status(booking_id, status, from_status=None):
+    """
+    Aggiorna status prenotazione (status 0 libera i posti). Con from_status
+    aggiorna solo se la prenotazione è ancora in quello stato. Una prenotazione
+    già liberata non torna attiva (i suoi posti possono essere di altri): per
+    quella si usa restore_booking. Ritorna True se aggiornata.
+    """
+    with write_transaction() as conn:
+        booking = conn.execute('SELECT event_id, seats, status FROM bookings WHERE id=?', (booking_id,)).fetchone()
+        if booking is None:
+            return False
+        current = booking['status']
+        if from_status is not None and current != from_status:
+            return False
+        if status in ACTIVE_STATUSES and current not in ACTIVE_STATUSES:
+            logger.warning(f"Prenotazione {booking_id} già liberata: stato {status} non applicato")
+            return False
+        conn.execute('UPDATE bookings SET status=? WHERE id=? AND status=?', (status, booking_id, current))
+        if status in ACTIVE_STATUSES:
+            conn.execute('UPDATE booking_seats SET status=? WHERE booking_id=?', (status, booking_id))
+        else:
+            conn.execute('DELETE FROM booking_seats WHERE booking_id=?', (booking_id,))
+    seats_status = status if status in ACTIVE_STATUSES else 0
+    occupancy.set_seats(booking['event_id'], booking['seats'].split(','), seats_status)
+    return True
 
 def get_event_transactions(event_id):
     """Ottiene tutte le transazioni per un evento specifico"""
-    conn = get_db()
+    cursor = get_read_db().cursor()
+    cursor.execute('''
+        SELECT id, event_id, name, email, seats, status, created_at
+        FROM bookings 
+        WHERE event_id = ?
+        ORDER BY created_at DESC, id DESC
+    ''', (event_id,))
+    
+    columns = [description[0] for description in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def get_event_transactions_page(event_id, status=None, search=None, after=None, limit=TRANSACTIONS_PAGE_SIZE):
+    """
+    Pagina di transazioni di un evento, dalla più recente, con paginazione a
+    chiave: after è la coppia (created_at, id) dell'ultima riga della pagina
+    precedente. Ritorna (righe, chiave della pagina successiva o None).
+    """
+    query = 'SELECT * FROM bookings WHERE event_id = ?'
+    params = [event_id]
+    if status is not None:
+        query += ' AND status = ?'
+        params.append(status)
+    if search:
+        pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        query += " AND (name LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\')"
+        params.extend([pattern, pattern])
+    if after is not None:
+        query += ' AND (created_at, id) < (?, ?)'
+        params.extend(after)
+    query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+
+    rows = get_read_db().execute(query, params).fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1]['created_at'], rows[-1]['id'])
+    return rows, None
+
+def iter_event_bookings(event_id, statuses=None, date_from=None, date_to=None, chunk_size=500):
+    """
+    Scorre le prenotazioni di un evento a blocchi di chunk_size righe (dict),
+    senza caricarle tutte in memoria. date_from/date_to ('aaaa-mm-gg') sono inclusi.
+    """
+    query = 'SELECT id, event_id, name, email, seats, status, created_at FROM bookings WHERE event_id = ?'
+    params = [event_id]
+    if statuses:
+        query += f" AND status IN ({','.join(['?'] * len(statuses))})"
+        params.extend(statuses)
+    if date_from:
+        query += ' AND created_at >= ?'
+        params.append(date_from)
+    if date_to:
+        query += ' AND created_at <= ?'
+        params.append(date_to + ' 23:59:59')
+    query += ' ORDER BY id'
+
+    # Cursore dedicato: la connessione del thread resta usabile durante lo scorrimento
+    cursor = get_read_db().cursor()
+    cursor.execute(query, params)
     try:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, event_id, name, email, seats, status, created_at
-            FROM bookings 
-            WHERE event_id = ?
-            ORDER BY created_at DESC
-        ''', (event_id,))
-        
         columns = [description[0] for description in cursor.description]
-        transactions = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        
-        return transactions
-        
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(columns, row))
     finally:
-        conn.close()
+        cursor.close()
+
+def count_event_bookings(event_id, statuses):
+    """Conta le prenotazioni di un evento con gli status indicati"""
+    placeholders = ','.join(['?'] * len(statuses))
+    return get_read_db().execute(
+        f'SELECT COUNT(*) FROM bookings WHERE event_id = ? AND status IN ({placeholders})',
+        (event_id, *statuses)
+    ).fetchone()[0]
+
+def extend_booking_hold(booking_id, expires_at):
+    """
+    Posticipa la scadenza di una prenotazione in attesa (mai anticipata).
+    Ritorna False se la prenotazione non è più in attesa.
+    """
+    with write_transaction() as conn:
+        return conn.execute(
+            'UPDATE bookings SET expires_at = max(expires_at, ?) WHERE id = ? AND status = 1',
+            (expires_at, booking_id)
+        ).rowcount > 0
+
+def set_booking_stripe_session(booking_id, session_id, checkout_url=None):
+    """Associa la sessione di checkout Stripe (e il suo URL) alla prenotazione"""
+    with write_transaction() as conn:
+        conn.execute(
+            'UPDATE bookings SET stripe_session_id=?, stripe_checkout_url=? WHERE id=?',
+            (session_id, checkout_url, booking_id)
+        )
+
+def get_booking_by_stripe_session(session_id):
+    """Prenotazione associata a una sessione di checkout Stripe, oppure None"""
+    return get_read_db().execute(
+        'SELECT * FROM bookings WHERE stripe_session_id=?', (session_id,)
+    ).fetchone()
+
+def claim_stripe_event(stripe_event_id, event_type):
+    """Registra un evento webhook; ritorna False se era già stato ricevuto"""
+    with write_transaction() as conn:
+        return conn.execute(
+            'INSERT OR IGNORE INTO stripe_events (id, type, received_at) VALUES (?, ?, ?)',
+            (stripe_event_id, event_type, int(time.time()))
+        ).rowcount == 1
+
+def release_stripe_event(stripe_event_id):
+    """Annulla la registrazione di un evento non elaborato, perché Stripe lo reinvii"""
+    with write_transaction() as conn:
+        conn.execute('DELETE FROM stripe_events WHERE id=?', (stripe_event_id,))
 
 def delete_booking(booking_id):
     """Elimina prenotazione"""
-    conn = get_db()
-    conn.execute('DELETE FROM bookings WHERE id=?', (booking_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as conn:
+        booking = conn.execute('SELECT event_id, seats FROM bookings WHERE id=?', (booking_id,)).fetchone()
+        conn.execute('DELETE FROM booking_seats WHERE booking_id=?', (booking_id,))
+        conn.execute('DELETE FROM bookings WHERE id=?', (booking_id,))
+    if booking:
+        occupancy.set_seats(booking['event_id'], booking['seats'].split(','), 0)
 
 def get_event_stats(event_id):
     """Ottieni statistiche evento (pending, sold, validated)"""
-    conn = get_db()
-    
-    # Posti pending
-    pending = conn.execute(
-        'SELECT SUM(LENGTH(seats) - LENGTH(REPLACE(seats, ",", "")) + 1) AS pending_count '
-        'FROM bookings WHERE event_id=? AND status=1', (event_id,)
-    ).fetchone()['pending_count'] or 0
-
-    # Posti pagati (venduti)
-    sold = conn.execute(
-        'SELECT SUM(LENGTH(seats) - LENGTH(REPLACE(seats, ",", "")) + 1) AS sold_count '
-        'FROM bookings WHERE event_id=? AND status =2', (event_id,)
-    ).fetchone()['sold_count'] or 0
-
-    # Posti validati
-    validated = conn.execute(
-        'SELECT SUM(LENGTH(seats) - LENGTH(REPLACE(seats, ",", "")) + 1) AS validated_count '
-        'FROM bookings WHERE event_id=? AND status=3', (event_id,)
-    ).fetchone()['validated_count'] or 0
-    
-    conn.close()
-    return {'pending': pending, 'sold': sold, 'validated': validated}
\ No newline at end of file
+    row = get_read_db().execute(
+        'SELECT pending, sold, validated FROM event_stats WHERE event_id=?', (event_id,)
+    ).fetchone()
+    if row is None:
+        return {'pending': 0, 'sold': 0, 'validated': 0}
+    return {'pending': row['pending'], 'sold': row['sold'], 'validated': row['validated']}
+
+def get_all_event_stats():
+    """Ottieni le statistiche (pending, sold, validated) di tutti gli eventi con una sola query"""
+    rows = get_read_db().execute('SELECT event_id, pending, sold, validated FROM event_stats').fetchall()
+    return {
+        row['event_id']: {'pending': row['pending'], 'sold': row['sold'], 'validated': row['validated']}
+        for row in rows
+    }
+
+def get_seat_states(event_id):
+    """Ottieni le coppie (posto, status) dei posti occupati di un evento"""
+    # Tuple semplici al posto di sqlite3.Row: la mappa occupazione le consuma subito
+    cursor = get_read_db().cursor()
+    cursor.row_factory = None
+    return cursor.execute(
+        'SELECT seat, status FROM booking_seats WHERE event_id=?', (event_id,)
+    ).fetchall()
+
+def count_taken_seats(event_id, seats):
+    """Conta quanti dei posti indicati risultano già occupati per l'evento"""
+    if not seats:
+        return 0
+    placeholders = ','.join(['?'] * len(seats))
+    return get_read_db().execute(
+        f'SELECT COUNT(*) FROM booking_seats WHERE event_id=? AND seat IN ({placeholders})',
+        (event_id, *seats)
+    ).fetchone()[0]
+
+def get_seat_changes_since(last_id, limit=1000):
+    """Ottieni le variazioni dei posti successive a last_id come tuple (id, event_id, seat, status)"""
+    cursor = get_read_db().cursor()
+    cursor.row_factory = None
+    return cursor.execute(
+        'SELECT id, event_id, seat, status FROM seat_changes WHERE id > ? ORDER BY id LIMIT ?',
+        (last_id, limit)
+    ).fetchall()
+
+def get_last_seat_change_id():
+    """Ottieni l'id dell'ultima variazione registrata (0 se nessuna)"""
+    return get_read_db().execute('SELECT COALESCE(MAX(id), 0) FROM seat_changes').fetchone()[0]
+
+def prune_seat_changes(max_age_seconds=3600):
+    """Elimina le variazioni dei posti più vecchie di max_age_seconds (chiamata dal scheduler)"""
+    with write_transaction() as conn:
+        conn.execute(
+            "DELETE FROM seat_changes WHERE changed_at < CAST(strftime('%s', 'now') AS INTEGER) - ?",
+            (max_age_seconds,)
+        )
+
+def enqueue_email(booking_id, kind):
+    """Accoda una email da inviare; ritorna l'id in outbox"""
+    now = int(time.time())
+    with write_transaction() as conn:
+        cur = conn.execute(
+            'INSERT INTO email_outbox (booking_id, kind, status, next_attempt_at, created_at) '
+            "VALUES (?, ?, 'pending', ?, ?)",
+            (booking_id, kind, now, now)
+        )
+    return cur.lastrowid
+
+def claim_next_email(lock_timeout=600):
+    """
+    Prende in carico la prossima email pronta (status 'sending').
+    Le email bloccate in 'sending' da più di lock_timeout secondi tornano disponibili.
+    Ritorna la riga oppure None.
+    """
+    now = int(time.time())
+    # Controllo in sola lettura: a coda vuota nessun worker prende il lock di scrittura
+    due = get_read_db().execute(
+        "SELECT 1 FROM email_outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+        "UNION ALL SELECT 1 FROM email_outbox WHERE status = 'sending' AND locked_at < ? LIMIT 1",
+        (now, now - lock_timeout)
+    ).fetchone()
+    if due is None:
+        return None
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE email_outbox SET status = 'pending' WHERE status = 'sending' AND locked_at < ?",
+            (now - lock_timeout,)
+        )
+        row = conn.execute(
+            "SELECT id FROM email_outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+            'ORDER BY next_attempt_at, id LIMIT 1',
+            (now,)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE email_outbox SET status = 'sending', locked_at = ?, attempts = attempts + 1 WHERE id = ?",
+            (now, row['id'])
+        )
+        return conn.execute('SELECT * FROM email_outbox WHERE id = ?', (row['id'],)).fetchone()
+
+def mark_email_sent(email_id):
+    """Registra l'avvenuta consegna di una email"""
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE email_outbox SET status = 'sent', sent_at = ?, locked_at = NULL, last_error = NULL WHERE id = ?",
+            (int(time.time()), email_id)
+        )
+
+def mark_email_retry(email_id, error, next_attempt_at):
+    """Rimette in coda una email fallita per un nuovo tentativo"""
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE email_outbox SET status = 'pending', next_attempt_at = ?, locked_at = NULL, last_error = ? "
+            'WHERE id = ?',
+            (next_attempt_at, error, email_id)
+        )
+
+def mark_email_failed(email_id, error):
+    """Segna una email come non consegnabile"""
+    with write_transaction() as conn:
+        conn.execute(
+            "UPDATE email_outbox SET status = 'failed', locked_at = NULL, last_error = ? WHERE id = ?",
+            (error, email_id)
+        )
+
+def acquire_job_lease(name, holder, ttl):
+    """
+    Acquisisce o rinnova il lease `name` per `holder` fino a ora+ttl.
+    Ritorna True se holder è il leader (lease libero, scaduto o già suo).
+    """
+    now = time.time()
+    with write_transaction() as conn:
+        return conn.execute("""
+            INSERT INTO job_leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE job_leases.holder = excluded.holder OR job_leases.expires_at < ?
+        """, (name, holder, now + ttl, now)).rowcount == 1
+
+def release_job_lease(name, holder):
+    """Rilascia il lease se è ancora di holder (failover immediato)"""
+    with write_transaction() as conn:
+        conn.execute('DELETE FROM job_leases WHERE name = ? AND holder = ?', (name, holder))
+
+def take_waiting_room_ticket(event_id, rate, burst, now=None, count=1):
+    """
+    Emette i prossimi count biglietti della sala d'attesa dell'evento. Il
+    fronte di ammissione avanza di rate biglietti al secondo e al più di burst
+    oltre l'ultimo emesso. Ritorna (issued, admitted, rate, burst, updated_at)
+    dopo l'emissione: i biglietti sono da issued - count + 1 a issued.
+    """
+    now = time.time() if now is None else now
+    with write_transaction() as conn:
+        row = conn.execute(
+            'SELECT issued, admitted, rate, updated_at FROM waiting_rooms WHERE event_id = ?', (event_id,)
+        ).fetchone()
+        if row is None:
+            issued, admitted = 0, float(burst)
+        else:
+            issued = row['issued']
+            elapsed = max(0.0, now - row['updated_at'])
+            admitted = min(issued + burst, row['admitted'] + row['rate'] * elapsed)
+        issued += count
+        conn.execute("""
+            INSERT INTO waiting_rooms (event_id, issued, admitted, rate, burst, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(event_id) DO UPDATE SET
+                issued = excluded.issued, admitted = excluded.admitted, rate = excluded.rate,
+                burst = excluded.burst, updated_at = excluded.updated_at
+        """, (event_id, issued, admitted, rate, burst, now))
+    return issued, admitted, rate, burst, now
+
+def get_waiting_room(event_id):
+    """Stato della sala d'attesa (issued, admitted, rate, burst, updated_at) oppure None"""
+    return get_read_db().execute(
+        'SELECT issued, admitted, rate, burst, updated_at FROM waiting_rooms WHERE event_id = ?', (event_id,)
+    ).fetchone()
+
+def start_ticket_export(event_id, total, max_running, stale_before, now=None):
+    """
+    Registra l'avvio dell'esportazione ZIP dell'evento se le esportazioni in
+    corso (non concluse e aggiornate dopo stale_before) sono meno di
+    max_running e nessuna riguarda lo stesso evento. Ritorna True se avviata.
+    """
+    now = time.time() if now is None else now
+    with write_transaction() as conn:
+        running = [row[0] for row in conn.execute(
+            'SELECT event_id FROM ticket_exports WHERE finished = 0 AND updated_at >= ?', (stale_before,)
+        )]
+        if len(running) >= max_running or event_id in running:
+            return False
+        conn.execute(
+            'INSERT OR REPLACE INTO ticket_exports (event_id, total, started_at, updated_at) VALUES (?, ?, ?, ?)',
+            (event_id, total, now, now)
+        )
+    return True
+
+def update_ticket_export(event_id, done, failed, finished=False):
+    """Aggiorna l'avanzamento di un'esportazione ZIP dei biglietti"""
+    with write_transaction() as conn:
+        conn.execute(
+            'UPDATE ticket_exports SET done = ?, failed = ?, finished = ?, updated_at = ? WHERE event_id = ?',
+            (done, failed, int(finished), time.time(), event_id)
+        )
+
+def get_ticket_export(event_id):
+    """Ultima esportazione ZIP dei biglietti dell'evento oppure None"""
+    return get_read_db().execute('SELECT * FROM ticket_exports WHERE event_id = ?', (event_id,)).fetchone()
+
+def get_job_lease(name):
+    """Lease corrente (holder, expires_at) oppure None"""
+    return get_read_db().execute(
+        'SELECT holder, expires_at FROM job_leases WHERE name = ?', (name,)
+    ).fetchone()
+
+def record_job_run(job, holder, started_at, duration, status, error=None, retention_days=30):
+    """Registra l'esecuzione di un job ed elimina quelle più vecchie di retention_days"""
+    cutoff = datetime.fromtimestamp(time.time() - retention_days * 86400).strftime(TIMESTAMP_FORMAT)
+    with write_transaction() as conn:
+        conn.execute(
+            'INSERT INTO job_runs (job, holder, started_at, duration, status, error) VALUES (?, ?, ?, ?, ?, ?)',
+            (job, holder, started_at, duration, status, error)
+        )
+        conn.execute('DELETE FROM job_runs WHERE job = ? AND started_at < ?', (job, cutoff))
+
+def get_recent_job_runs(limit=50):
+    """Ultime esecuzioni dei job periodici, dalla più recente"""
+    cursor = get_read_db().cursor()
+    cursor.execute(
+        'SELECT job, holder, started_at, duration, status, error FROM job_runs ORDER BY id DESC LIMIT ?', (limit,)
+    )
+    columns = [description[0] for description in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
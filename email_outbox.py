@@ -0,0 +1,182 @@
+"""
+Coda persistente delle email (tabella email_outbox) e thread che la svuotano.
+
+Le route accodano e rispondono subito; i worker generano il PDF, inviano
+riusando una connessione SMTP autenticata e ritentano con backoff esponenziale.
+email_service (e con lui reportlab e smtplib) viene importato dal primo invio.
+Solo prenotazione o evento inesistenti rendono un'email definitivamente non
+inviabile; gli errori di generazione del biglietto si ritentano come quelli SMTP.
+Verifica con un server SMTP locale: tools/outbox_check.py.
+"""
+import logging
+import os
+import threading
+import time
+from config import EMAIL_WORKERS
+from database import enqueue_email, claim_next_email, mark_email_sent, mark_email_retry, mark_email_failed
+from metrics import SMTP_SEND_DURATION
+
+logger = logging.getLogger(__name__)
+
+BOOKING_CONFIRMATION = 'booking_confirmation'
+
+# Tentativi massimi prima di segnare l'email come fallita
+MAX_ATTEMPTS = 6
+# Attesa prima del primo nuovo tentativo, poi raddoppiata (massimo RETRY_MAX_DELAY)
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 3600
+# Attesa massima tra due controlli della coda quando nessuno accoda nulla
+IDLE_POLL_INTERVAL = 10
+# Una connessione SMTP inutilizzata da più di così viene chiusa
+SMTP_IDLE_TIMEOUT = 60
+
+
+class SmtpConnection:
+    """Connessione SMTP autenticata riutilizzata tra più invii dallo stesso worker"""
+
+    def __init__(self):
+        self._server = None
+        self._last_used = 0.0
+
+    def _alive(self):
+        import smtplib
+        if self._server is None:
+            return False
+        if time.monotonic() - self._last_used > SMTP_IDLE_TIMEOUT:
+            self.close()
+            return False
+        try:
+            return self._server.noop()[0] == 250
+        except smtplib.SMTPException:
+            self.close()
+            return False
+        except OSError:
+            self.close()
+            return False
+
+    def send(self, msg):
+        with SMTP_SEND_DURATION.time():
+            self._send(msg)
+
+    def _send(self, msg):
+        import smtplib
+        from email_service import connect_smtp
+        if not self._alive():
+            self._server = connect_smtp()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Il server ha chiuso la connessione: un solo nuovo tentativo
+            self._server = connect_smtp()
+            self._server.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        import smtplib
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+
+def retry_delay(attempts):
+    """Attesa in secondi prima del tentativo successivo a `attempts` tentativi falliti"""
+    return min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+
+
+class OutboxWorkerPool:
+    """Pool di thread che consegnano le email accodate"""
+
+    def __init__(self, size=EMAIL_WORKERS):
+        self.size = size
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Idempotente; dopo un fork i thread vanno ricreati nel nuovo processo
+        with self._lock:
+            if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._run, name=f'email-outbox-{i}', daemon=True)
+                for i in range(self.size)
+            ]
+            for thread in self._threads:
+                thread.start()
+        logger.info(f"Avviati {self.size} worker email outbox")
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        connection = SmtpConnection()
+        while True:
+            try:
+                processed = self.process_one(connection)
+            except Exception as e:
+                logger.error(f"Errore worker email outbox: {e}")
+                processed = False
+            if not processed:
+                self._wakeup.wait(IDLE_POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def process_one(self, connection):
+        """Consegna la prossima email in coda; ritorna False se la coda è vuota"""
+        email = claim_next_email()
+        if email is None:
+            return False
+
+        if email['kind'] != BOOKING_CONFIRMATION:
+            mark_email_failed(email['id'], f"Tipo email sconosciuto: {email['kind']}")
+            return True
+
+        from email_service import build_booking_confirmation
+        try:
+            msg, error = build_booking_confirmation(email['booking_id'])
+        except Exception as e:
+            # Errore temporaneo (PDF, locandina): il biglietto va comunque consegnato
+            self._retry_or_fail(email, f"Errore generazione biglietto: {e}")
+            return True
+        if error:
+            # Prenotazione o evento inesistenti: ritentare non serve
+            mark_email_failed(email['id'], error)
+            logger.error(f"Email {email['id']} (prenotazione {email['booking_id']}) non inviabile: {error}")
+            return True
+
+        start = time.perf_counter()
+        try:
+            connection.send(msg)
+        except Exception as e:
+            connection.close()
+            self._retry_or_fail(email, str(e))
+            return True
+
+        mark_email_sent(email['id'])
+        logger.info(f"Email {email['id']} inviata a {msg['To']} in {time.perf_counter() - start:.2f}s")
+        return True
+
+    @staticmethod
+    def _retry_or_fail(email, error):
+        """Nuovo tentativo con backoff, oppure fallimento definitivo dopo MAX_ATTEMPTS"""
+        if email['attempts'] >= MAX_ATTEMPTS:
+            mark_email_failed(email['id'], error)
+            logger.error(f"Email {email['id']} fallita dopo {email['attempts']} tentativi: {error}")
+        else:
+            next_attempt_at = int(time.time()) + retry_delay(email['attempts'])
+            mark_email_retry(email['id'], error, next_attempt_at)
+            logger.warning(f"Invio email {email['id']} fallito (tentativo {email['attempts']}): {error}")
+
+
+workers = OutboxWorkerPool()
+
+
+def enqueue_booking_confirmation(booking_id):
+    """Accoda l'email di conferma con biglietto PDF e sveglia i worker"""
+    email_id = enqueue_email(booking_id, BOOKING_CONFIRMATION)
+    workers.wake()
+    return email_id
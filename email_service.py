@@ -3,22 +3,37 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 from email.message import EmailMessage
-from config import EMAIL_SENDER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT
-from database import get_booking_by_id, get_event_by_id
+from config import EMAIL_SENDER, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT, SMTP_STARTTLS, SMTP_LOGIN
+from database import get_booking_by_id, get_event_by_id, format_event_date
 from pdf_generator import generate_email_ticket_pdf
+from metrics import SMTP_SEND_DURATION
 
-def send_booking_confirmation_with_pdf(booking_id):
-    """Invia email di conferma con biglietto PDF allegato - testo essenziale"""
+def connect_smtp():
+    """Apre una connessione SMTP autenticata verso il server configurato"""
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+    if SMTP_STARTTLS:
+        server.starttls()
+    if SMTP_LOGIN:
+        server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+    return server
+
+def build_booking_confirmation(booking_id):
+    """
+    Prepara l'email di conferma con biglietto PDF allegato.
+    Ritorna (messaggio, None) oppure (None, errore) se prenotazione o evento
+    non esistono; un errore nella generazione del PDF solleva un'eccezione
+    (temporaneo: la coda email ritenta).
+    """
     booking = get_booking_by_id(booking_id)
     if not booking:
-        return "Prenotazione non trovata"
+        return None, "Prenotazione non trovata"
     
     event = get_event_by_id(booking['event_id'])
     if not event:
-        return "Evento non trovato"
+        return None, "Evento non trovato"
     
     event_title = event['title']
-    event_date = event['date']
+    event_date = format_event_date(event['date'])
     event_time = event['time']
     seats = booking['seats']
     to_email = booking['email']
@@ -48,12 +63,9 @@ def send_booking_confirmation_with_pdf(booking_id):
     """
 
     # Genera PDF del biglietto
-    try:
-        pdf_data = generate_email_ticket_pdf(booking, event)
-        if not pdf_data:
-            return "Errore nella generazione del PDF"
-    except Exception as e:
-        return f"Errore PDF: {e}"
+    pdf_data = generate_email_ticket_pdf(booking, event)
+    if not pdf_data:
+        raise RuntimeError("Errore nella generazione del PDF")
 
     # Prepara email multipart
     msg = MIMEMultipart()
@@ -71,14 +83,21 @@ def send_booking_confirmation_with_pdf(booking_id):
                              filename=f'biglietto_{booking_id}_{event_title.replace(" ", "_")}.pdf')
     msg.attach(pdf_attachment)
 
+    return msg, None
+
+def send_booking_confirmation_with_pdf(booking_id):
+    """Invia email di conferma con biglietto PDF allegato - testo essenziale"""
+    try:
+        msg, error = build_booking_confirmation(booking_id)
+    except Exception as e:
+        return f"Errore PDF: {e}"
+    if error:
+        return error
+
     # Invia email
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        with SMTP_SEND_DURATION.time(), connect_smtp() as server:
             server.send_message(msg)
         return "Email con biglietto PDF inviata con successo!"
     except Exception as e:
         return f"Errore invio email: {e}"
-
-   
\ No newline at end of file
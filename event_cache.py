@@ -0,0 +1,80 @@
+"""
+Lista degli eventi in programma (homepage) in memoria, con la pagina già renderizzata.
+
+Le funzioni di database che modificano gli eventi invalidano la cache del
+processo. Le modifiche fatte da altri processi (worker gunicorn, script)
+vengono rilevate dalla versione in events_version, aggiornata da trigger su
+events e riletta al massimo ogni VERSION_CHECK_INTERVAL secondi: una query
+su chiave primaria invece della lista completa e del rendering del template.
+"""
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+# Ritardo massimo con cui un processo vede le modifiche fatte da un altro
+VERSION_CHECK_INTERVAL = 2
+
+EventList = namedtuple('EventList', 'version updated_at day events')
+# Pagina renderizzata di una EventList, con validatori per le richieste condizionali
+CachedPage = namedtuple('CachedPage', 'event_list body etag last_modified')
+
+
+class EventListCache:
+    """Eventi visibili da oggi in poi, ricaricati quando cambia la versione o il giorno"""
+
+    def __init__(self, check_interval=VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._current = None
+        self._page = None
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def get(self, today=None):
+        """EventList corrente (today in formato aaaa-mm-gg, di default oggi)"""
+        # Import locale: database invalida questa cache a ogni scrittura sugli eventi
+        from database import get_events_version, get_upcoming_events, EVENT_DATE_FORMAT
+        today = today or datetime.now().strftime(EVENT_DATE_FORMAT)
+        current = self._current
+        now = time.monotonic()
+        if current is not None and current.day == today and now - self._checked_at < self.check_interval:
+            return current
+        # Versione letta prima degli eventi: una modifica intermedia causa al più una ricarica in più
+        version, updated_at = get_events_version()
+        if current is None or current.version != version or current.day != today:
+            current = EventList(version, updated_at, today, tuple(get_upcoming_events(today)))
+            with self._lock:
+                self._current = current
+        self._checked_at = now
+        return current
+
+    def page(self, render, today=None):
+        """
+        CachedPage della lista corrente: render(events) viene chiamata solo
+        quando la lista cambia. L'ETag dipende dal contenuto, quindi è lo
+        stesso in tutti i processi.
+        """
+        from database import EVENT_DATE_FORMAT
+        event_list = self.get(today)
+        page = self._page
+        if page is None or page.event_list is not event_list:
+            body = render(event_list.events)
+            etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+            # La lista cambia anche a mezzanotte (eventi passati)
+            day_start = datetime.strptime(event_list.day, EVENT_DATE_FORMAT).timestamp()
+            page = CachedPage(event_list, body, etag, max(event_list.updated_at, int(day_start)))
+            with self._lock:
+                if self._current is event_list:
+                    self._page = page
+        return page
+
+    def invalidate(self):
+        """Scarta lista e pagina: verranno ricaricate alla prossima richiesta"""
+        with self._lock:
+            self._current = None
+            self._page = None
+            self._checked_at = float('-inf')
+
+
+cache = EventListCache()
@@ -0,0 +1,47 @@
+"""
+Configurazione gunicorn: gunicorn -c gunicorn.conf.py
+
+L'applicazione viene caricata una volta nel master (preload_app) e preparata
+da warm_up: i worker nascono con moduli, template e font già pronti e ne
+condividono le pagine di memoria. Ogni worker avvia i propri thread (scadenza
+prenotazioni, job periodici, coda email, metriche) subito dopo il fork.
+
+Thread: ogni pagina di selezione posti apre uno stream SSE che occupa un
+thread del worker finché resta aperto. Gli stream per worker sono limitati a
+SEAT_STREAM_LIMIT (default 16) e durano al massimo SEAT_STREAM_MAX_SECONDS,
+quindi threads deve superare SEAT_STREAM_LIMIT di quanto serve alle pagine
+normali: con i default 16 thread per gli stream e 16 per il resto del sito.
+Spettatori contemporanei della piantina = workers * SEAT_STREAM_LIMIT: per
+centinaia di spettatori si aumentano insieme SEAT_STREAM_LIMIT e
+GUNICORN_THREADS (un thread in attesa costa poca memoria) oppure i worker.
+"""
+import os
+
+wsgi_app = 'wsgi:application'
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+preload_app = True
+
+
+def when_ready(server):
+    from app import warm_up
+    from config import SEAT_STREAM_LIMIT
+    if server.cfg.threads <= SEAT_STREAM_LIMIT:
+        server.log.warning(
+            f"threads={server.cfg.threads} non supera SEAT_STREAM_LIMIT={SEAT_STREAM_LIMIT}: "
+            "gli stream della piantina possono occupare tutti i thread dei worker"
+        )
+    warm_up()
+
+
+def post_fork(server, worker):
+    from app import start_background_services
+    start_background_services()
+
+
+def child_exit(server, worker):
+    # Metriche del worker terminato nel file aggregato (il pid può essere riusato)
+    from metrics import registry
+    registry.mark_process_dead(worker.pid)
@@ -0,0 +1,104 @@
+"""
+Scadenza precisa delle prenotazioni in attesa di pagamento.
+
+Ogni prenotazione pending ha una scadenza (bookings.expires_at). Le scadenze
+note al processo stanno in un heap e un solo thread dorme fino alla prossima:
+i posti tornano liberi allo scadere esatto, senza scansioni periodiche.
+Le prenotazioni create da altri processi vengono recuperate dal database
+(MIN(expires_at) sull'indice) ogni RESYNC_INTERVAL secondi.
+
+Il modulo non dipende dal database: le funzioni di rilascio e di lettura della
+prossima scadenza vengono passate a start().
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Intervallo massimo tra due letture della prossima scadenza dal database
+RESYNC_INTERVAL = 5
+
+
+class HoldExpiryEngine:
+    """Heap delle scadenze con un thread che rilascia le prenotazioni scadute"""
+
+    def __init__(self, resync_interval=RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self._heap = []
+        self._scheduled = set()
+        self._cond = threading.Condition()
+        self._release = None
+        self._next_deadline = None
+        self._thread = None
+        self._pid = None
+
+    def start(self, release, next_deadline):
+        """
+        Avvia il thread (idempotente, ripetuto dopo un fork).
+        release(now) libera le prenotazioni scadute e ritorna quante;
+        next_deadline() ritorna la prossima scadenza nel database o None.
+        """
+        with self._cond:
+            self._release = release
+            self._next_deadline = next_deadline
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='hold-expiry', daemon=True)
+            self._thread.start()
+
+    def schedule(self, deadline):
+        """Registra una scadenza (epoch in secondi)"""
+        with self._cond:
+            if deadline in self._scheduled:
+                return
+            self._scheduled.add(deadline)
+            heapq.heappush(self._heap, deadline)
+            if self._heap[0] == deadline:
+                # Nuova scadenza più vicina: il thread ricalcola l'attesa
+                self._cond.notify()
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _pop_due(self, now):
+        due = False
+        while self._heap and self._heap[0] <= now:
+            self._scheduled.discard(heapq.heappop(self._heap))
+            due = True
+        return due
+
+    def _run(self):
+        resync_at = 0.0
+        while True:
+            now = time.time()
+            if now >= resync_at:
+                try:
+                    deadline = self._next_deadline()
+                except Exception as e:
+                    logger.error(f"Errore lettura prossima scadenza prenotazioni: {e}")
+                    deadline = None
+                if deadline is not None:
+                    self.schedule(deadline)
+                resync_at = now + self.resync_interval
+
+            with self._cond:
+                if not self._pop_due(now):
+                    wake_at = min(self._heap[0], resync_at) if self._heap else resync_at
+                    self._cond.wait(max(0.0, wake_at - now))
+                    continue
+
+            try:
+                released = self._release(now)
+            except Exception as e:
+                logger.error(f"Errore rilascio prenotazioni scadute: {e}")
+                continue
+            if released:
+                logger.info(f"Liberate {released} prenotazioni scadute")
+
+
+engine = HoldExpiryEngine()
@@ -0,0 +1,177 @@
+"""
+Client HTTP in uscita condiviso (Stripe e locandine remote).
+
+Una sola sessione requests per processo con connessioni keep-alive, timeout
+di connessione e lettura su ogni chiamata e un circuit breaker per servizio:
+dopo FAILURE_THRESHOLD errori consecutivi le chiamate falliscono subito per
+RESET_TIMEOUT secondi, invece di bloccare i worker su un servizio lento.
+
+requests e stripe vengono importati al primo uso (get_session, get_stripe):
+l'avvio dei worker non paga il loro caricamento.
+"""
+import logging
+import threading
+import time
+from config import STRIPE_SECRET_KEY, STRIPE_API_BASE
+from metrics import STRIPE_CALL_DURATION
+
+logger = logging.getLogger(__name__)
+
+# Timeout (connessione, lettura) in secondi
+STRIPE_TIMEOUT = (3, 15)
+POSTER_TIMEOUT = (3, 10)
+STRIPE_NETWORK_RETRIES = 1
+# Connessioni keep-alive tenute aperte per host
+POOL_SIZE = 10
+# Errori consecutivi che aprono il circuito e durata dell'apertura
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+USER_AGENT = 'Mozilla/5.0 (compatible; TSR-PDF-Generator/1.0)'
+
+
+class CircuitOpenError(Exception):
+    """Il servizio ha fallito troppe volte di seguito: chiamata non eseguita"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker a tre stati: chiuso, aperto (fallisce subito) e
+    semiaperto (dopo RESET_TIMEOUT passa una sola chiamata di prova)
+    """
+
+    def __init__(self, name, failure_exceptions, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        """failure_exceptions: tupla di eccezioni, o funzione che la ritorna (import ritardati)"""
+        self.name = name
+        self._failure_exceptions = failure_exceptions
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def failure_exceptions(self):
+        if callable(self._failure_exceptions):
+            self._failure_exceptions = self._failure_exceptions()
+        return self._failure_exceptions
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                raise CircuitOpenError(f'Servizio {self.name} non disponibile')
+            self._trial_running = True
+
+    def _record(self, failed):
+        with self._lock:
+            self._trial_running = False
+            if not failed:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Circuito {self.name} aperto dopo {self._failures} errori consecutivi")
+                self._opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        """Esegue func rispettando lo stato del circuito"""
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except self.failure_exceptions:
+            self._record(failed=True)
+            raise
+        except Exception:
+            # Errori applicativi (es. richiesta non valida): il servizio risponde
+            self._record(failed=False)
+            raise
+        self._record(failed=False)
+        return result
+
+
+_session = None
+_stripe = None
+_init_lock = threading.Lock()
+
+
+def get_session():
+    """Sessione requests condivisa del processo, creata al primo uso"""
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        with _init_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['User-Agent'] = USER_AGENT
+                _session = session
+    return _session
+
+
+def get_stripe():
+    """Modulo stripe configurato (chiave, sessione condivisa, timeout stretti), importato al primo uso"""
+    global _stripe
+    if _stripe is None:
+        import stripe
+        try:
+            from stripe import RequestsClient
+        except ImportError:  # stripe < 8
+            from stripe.http_client import RequestsClient
+        session = get_session()
+        with _init_lock:
+            if _stripe is None:
+                stripe.api_key = STRIPE_SECRET_KEY
+                if STRIPE_API_BASE:
+                    stripe.api_base = STRIPE_API_BASE
+                stripe.default_http_client = RequestsClient(timeout=STRIPE_TIMEOUT, session=session)
+                # Un solo nuovo tentativo (con chiave di idempotenza): il resto lo gestisce il circuit breaker
+                stripe.max_network_retries = STRIPE_NETWORK_RETRIES
+                _stripe = stripe
+    return _stripe
+
+
+def _stripe_failures():
+    stripe = get_stripe()
+    return (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError)
+
+
+def _poster_failures():
+    import requests
+    return (requests.ConnectionError, requests.Timeout, requests.HTTPError)
+
+
+stripe_breaker = CircuitBreaker('stripe', _stripe_failures)
+poster_breaker = CircuitBreaker('locandine', _poster_failures)
+
+
+def stripe_call(func, *args, **kwargs):
+    """Esegue una chiamata API Stripe attraverso il circuit breaker"""
+    with STRIPE_CALL_DURATION.time(operation=getattr(func, '__qualname__', 'stripe')):
+        return stripe_breaker.call(func, *args, **kwargs)
+
+
+def get_poster(url, headers=None):
+    """GET di una locandina remota; solleva CircuitOpenError se il circuito è aperto"""
+    def fetch():
+        response = get_session().get(url, timeout=POSTER_TIMEOUT, headers=headers)
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response
+    return poster_breaker.call(fetch)
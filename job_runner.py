@@ -0,0 +1,124 @@
+"""
+Job periodici eseguiti da un solo processo (leader).
+
+Con gunicorn ogni worker importa l'applicazione e avvia il proprio scheduler:
+senza coordinamento ogni job girerebbe N volte, con N transazioni di
+scrittura in competizione. Ogni processo prova a rinnovare un lease nella
+tabella job_leases ogni LEASE_RENEW_INTERVAL secondi; solo chi lo possiede
+esegue i job. Se il leader muore il lease scade dopo LEASE_TTL secondi e un
+altro processo subentra; all'uscita regolare viene rilasciato subito.
+
+Ogni esecuzione viene registrata in job_runs (durata, esito, errore) e nella
+metrica tsr_job_duration_seconds.
+"""
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+from database import acquire_job_lease, release_job_lease, record_job_run, TIMESTAMP_FORMAT
+from metrics import JOB_DURATION
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = 'scheduler'
+# Durata del lease e intervallo di rinnovo (il rinnovo deve essere molto più frequente)
+LEASE_TTL = 30
+LEASE_RENEW_INTERVAL = 10
+
+
+class JobRunner:
+    """Scheduler APScheduler i cui job girano solo nel processo leader"""
+
+    def __init__(self, lease_name=LEASE_NAME, lease_ttl=LEASE_TTL, renew_interval=LEASE_RENEW_INTERVAL):
+        self.lease_name = lease_name
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self._jobs = []
+        self._scheduler = None
+        self._pid = None
+        self._leader = False
+        self._lock = threading.Lock()
+
+    @property
+    def holder(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    @property
+    def is_leader(self):
+        return self._leader and self._pid == os.getpid()
+
+    def add_job(self, func, seconds, name=None):
+        """Registra un job da eseguire ogni `seconds` secondi (prima di start)"""
+        self._jobs.append((name or func.__name__, func, seconds))
+
+    def start(self):
+        """Avvia lo scheduler del processo (idempotente, ripetuto dopo un fork)"""
+        with self._lock:
+            if self._pid == os.getpid() and self._scheduler is not None:
+                return
+            from apscheduler.schedulers.background import BackgroundScheduler
+            self._pid = os.getpid()
+            self._leader = False
+            self._scheduler = BackgroundScheduler()
+            self._scheduler.add_job(self.renew, 'interval', seconds=self.renew_interval)
+            for name, func, seconds in self._jobs:
+                self._scheduler.add_job(
+                    self.run_job, 'interval', seconds=seconds, args=(name, func), id=name,
+                    max_instances=1, coalesce=True
+                )
+            self._scheduler.start()
+        self.renew()
+
+    def renew(self):
+        """Acquisisce o rinnova il lease; ritorna True se questo processo è il leader"""
+        try:
+            leader = acquire_job_lease(self.lease_name, self.holder, self.lease_ttl)
+        except Exception as e:
+            # Senza database non si può garantire un solo leader: meglio fermarsi
+            logger.error(f"Errore rinnovo lease job periodici: {e}")
+            leader = False
+        if leader != self._leader:
+            logger.info(f"Processo {self.holder} {'leader' if leader else 'non più leader'} dei job periodici")
+        self._leader = leader
+        return leader
+
+    def run_job(self, name, func):
+        """Esegue il job se questo processo è il leader e ne registra l'esito"""
+        # Lease verificato subito prima: un leader sospeso e scaduto non esegue
+        if not self.is_leader or not self.renew():
+            return
+        started_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+        started = time.perf_counter()
+        status, error = 'ok', None
+        try:
+            func()
+        except Exception as e:
+            status, error = 'error', str(e)
+            logger.error(f"Errore job {name}: {e}")
+        duration = time.perf_counter() - started
+        JOB_DURATION.observe(duration, job=name, result=status)
+        try:
+            record_job_run(name, self.holder, started_at, duration, status, error)
+        except Exception as e:
+            logger.error(f"Errore registrazione esecuzione job {name}: {e}")
+
+    def stop(self):
+        """Ferma lo scheduler e rilascia il lease se posseduto"""
+        with self._lock:
+            if self._scheduler is None or self._pid != os.getpid():
+                return
+            self._scheduler.shutdown(wait=False)
+            self._scheduler = None
+        if self._leader:
+            self._leader = False
+            try:
+                release_job_lease(self.lease_name, self.holder)
+            except Exception as e:
+                logger.error(f"Errore rilascio lease job periodici: {e}")
+
+
+runner = JobRunner()
+atexit.register(runner.stop)
@@ -0,0 +1,446 @@
+"""
+Metriche dell'applicazione in formato testo Prometheus (/metrics).
+
+Ogni processo accumula contatori e istogrammi in memoria e li scrive
+periodicamente in METRICS_DIR/metrics-<pid>.json; /metrics somma i file di
+tutti i processi (worker gunicorn, processi di esportazione), quindi i
+valori sono aggregati qualunque worker risponda. Le metriche dei processi
+terminati vengono sommate in metrics-aggregate.json e il loro file eliminato
+(hook child_exit di gunicorn, oppure alla lettura di /metrics per i processi
+non più attivi): i contatori restano cumulativi senza che la cartella cresca,
+anche quando un nuovo processo riceve il pid di uno terminato.
+
+Oltre a latenza e conteggio delle richieste per endpoint, le query SQL
+vengono contate e cronometrate da SQLConnection (cursori strumentati) e
+attribuite alla richiesta in corso nel thread.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from config import METRICS_DIR
+
+logger = logging.getLogger(__name__)
+
+# Secondi tra due scritture su file delle metriche del processo
+FLUSH_INTERVAL = 5
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 1000)
+# Metriche sommate dei processi terminati
+AGGREGATE_FILE = 'metrics-aggregate.json'
+
+
+class _Metric:
+    def __init__(self, registry, name, help_text, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.series = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.touch()
+        key = self._key(labels)
+        with self.registry.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.series.items()]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels, buckets):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self.registry.touch()
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            series = self.series.get(key)
+            if series is None:
+                # Conteggi per bucket (l'ultimo è +Inf), somma, numero di osservazioni
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Cronometra il blocco; l'etichetta result vale ok o error se prevista"""
+        started = time.perf_counter()
+        result = 'ok'
+        try:
+            yield
+        except BaseException:
+            result = 'error'
+            raise
+        finally:
+            if 'result' in self.labels:
+                labels['result'] = result
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        return [[list(key), list(counts), total, count] for key, (counts, total, count) in self.series.items()]
+
+
+class Registry:
+    """
+    Metriche del processo, scritte su file da un thread in background
+    (avviato con start) e all'uscita
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self._pid = None
+        self._flusher = None
+        self._claimed = False
+
+    def counter(self, name, help_text, labels=()):
+        metric = self.metrics[name] = Counter(self, name, help_text, labels)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = self.metrics[name] = Histogram(self, name, help_text, labels, buckets)
+        return metric
+
+    def touch(self):
+        """Associa le metriche al processo corrente (azzerate dopo un fork)"""
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+    def _reset(self):
+        if self._pid is not None:
+            # Processo figlio: i valori ereditati appartengono al padre
+            for metric in self.metrics.values():
+                metric.series.clear()
+        self._pid = os.getpid()
+        self._flusher = None
+        self._claimed = False
+
+    def _after_fork(self):
+        # Il lock può essere stato copiato mentre un thread del padre lo teneva
+        self.lock = threading.Lock()
+        self._reset()
+
+    def start(self):
+        """Avvia il thread di scrittura periodica nel processo corrente (idempotente)"""
+        self.touch()
+        with self.lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    @contextmanager
+    def _file_lock(self, exclusive=True):
+        """Lock tra processi sui file della cartella (condiviso per la lettura)"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error(f"Errore lettura metriche {path}: {e}")
+            return None
+
+    def _write(self, path, data):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, f'.metrics-{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        """Scrive le metriche del processo (sostituzione atomica del file)"""
+        if self._pid != os.getpid():
+            return
+        try:
+            if not self._claimed:
+                # Un file con il nostro pid è di un processo terminato con lo stesso pid
+                self.mark_process_dead(self._pid)
+                self._claimed = True
+            with self.lock:
+                data = {
+                    name: {'series': metric.snapshot()}
+                    for name, metric in self.metrics.items() if metric.series
+                }
+            self._write(self._path(self._pid), data)
+        except OSError as e:
+            logger.error(f"Errore scrittura metriche: {e}")
+
+    def mark_process_dead(self, pid):
+        """Somma le metriche del processo terminato pid nel file aggregato ed elimina il suo file"""
+        path = self._path(pid)
+        if not os.path.exists(path):
+            return
+        aggregate_path = os.path.join(self.directory, AGGREGATE_FILE)
+        with self._file_lock():
+            data = self._load(path)
+            if data is None:
+                return
+            totals = {}
+            self._merge(totals, self._load(aggregate_path) or {})
+            self._merge(totals, data)
+            self._write(aggregate_path, self._dump(totals))
+            os.unlink(path)
+
+    def _dead_pids(self, names):
+        pids = []
+        for filename in names:
+            pid = filename[len('metrics-'):-len('.json')]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                pids.append(int(pid))
+            except PermissionError:
+                pass  # processo attivo di un altro utente
+        return pids
+
+    def _file_names(self):
+        try:
+            return [n for n in os.listdir(self.directory) if n.startswith('metrics-') and n.endswith('.json')]
+        except FileNotFoundError:
+            return []
+
+    def collect(self):
+        """Somma le metriche scritte da tutti i processi"""
+        self.flush()
+        # Processi terminati senza hook (server di sviluppo, processi di esportazione)
+        dead_pids = self._dead_pids(self._file_names())
+        for pid in dead_pids:
+            try:
+                self.mark_process_dead(pid)
+            except OSError as e:
+                logger.error(f"Errore aggregazione metriche del processo {pid}: {e}")
+        totals = {}
+        with self._file_lock(exclusive=False):
+            for filename in self._file_names():
+                data = self._load(os.path.join(self.directory, filename))
+                if data is not None:
+                    self._merge(totals, data)
+        return totals
+
+    def _merge(self, totals, data):
+        for name, content in data.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                continue
+            merged = totals.setdefault(name, {})
+            for entry in content['series']:
+                key = tuple(entry[0])
+                if metric.type == 'counter':
+                    merged[key] = merged.get(key, 0) + entry[1]
+                    continue
+                counts, total, count = entry[1:]
+                if len(counts) != len(metric.buckets) + 1:
+                    continue  # bucket cambiati da una versione precedente
+                current = merged.setdefault(key, [[0] * len(counts), 0.0, 0])
+                current[0] = [a + b for a, b in zip(current[0], counts)]
+                current[1] += total
+                current[2] += count
+
+    def _dump(self, totals):
+        """Totali di collect nel formato dei file dei processi"""
+        data = {}
+        for name, merged in totals.items():
+            if self.metrics[name].type == 'counter':
+                series = [[list(key), value] for key, value in merged.items()]
+            else:
+                series = [[list(key), counts, total, count] for key, (counts, total, count) in merged.items()]
+            data[name] = {'series': series}
+        return data
+
+    def render(self):
+        """Testo in formato Prometheus (exposition format 0.0.4)"""
+        totals = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for key, value in sorted(totals.get(name, {}).items()):
+                labels = list(zip(metric.labels, key))
+                if metric.type == 'counter':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    le = bound if bound == '+Inf' else _format_value(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels + [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+atexit.register(registry.flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry._after_fork)
+
+REQUEST_DURATION = registry.histogram(
+    'tsr_http_request_duration_seconds', 'Durata delle richieste HTTP per endpoint', ('endpoint', 'method')
+)
+REQUESTS = registry.counter(
+    'tsr_http_requests_total', 'Richieste HTTP per endpoint e codice di risposta', ('endpoint', 'method', 'status')
+)
+REQUEST_SQL_QUERIES = registry.histogram(
+    'tsr_http_request_sql_queries', 'Query SQL eseguite per richiesta', ('endpoint',), QUERY_COUNT_BUCKETS
+)
+REQUEST_SQL_DURATION = registry.histogram(
+    'tsr_http_request_sql_seconds', 'Tempo speso in query SQL per richiesta', ('endpoint',), SQL_BUCKETS
+)
+SQL_QUERY_DURATION = registry.histogram(
+    'tsr_sql_query_duration_seconds', 'Durata delle singole query SQL per tipo di istruzione',
+    ('statement',), SQL_BUCKETS
+)
+PDF_RENDER_DURATION = registry.histogram(
+    'tsr_pdf_render_seconds', 'Tempo di generazione dei PDF', ('kind', 'result')
+)
+SMTP_SEND_DURATION = registry.histogram(
+    'tsr_smtp_send_seconds', 'Tempo di invio delle email SMTP', ('result',)
+)
+STRIPE_CALL_DURATION = registry.histogram(
+    'tsr_stripe_call_seconds', 'Durata delle chiamate API Stripe', ('operation', 'result')
+)
+JOB_DURATION = registry.histogram(
+    'tsr_job_duration_seconds', 'Durata dei job periodici eseguiti dal leader', ('job', 'result'),
+    (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+)
+RATE_LIMITED = registry.counter(
+    'tsr_rate_limited_requests_total', 'Richieste rifiutate con 429 dal limite di frequenza per client', ('route',)
+)
+RATE_LIMIT_ERRORS = registry.counter(
+    'tsr_rate_limit_errors_total', 'Richieste lasciate passare per errore del limitatore di frequenza', ('route',)
+)
+LATE_PAYMENTS = registry.counter(
+    'tsr_late_payments_total', 'Pagamenti arrivati per posti già rivenduti: rimborsati o da gestire a mano', ('result',)
+)
+WAITING_ROOM_ENTRIES = registry.counter(
+    'tsr_waiting_room_entries_total', 'Ingressi nella sala d\'attesa: ammessi subito o messi in coda', ('result',)
+)
+
+
+# ---------- RICHIESTE HTTP ----------
+
+_request = threading.local()
+
+
+def start_request():
+    """Inizio richiesta: azzera il conteggio delle query del thread"""
+    _request.started = time.perf_counter()
+    _request.sql_queries = 0
+    _request.sql_seconds = 0.0
+
+
+def finish_request(endpoint, method, status):
+    started = getattr(_request, 'started', None)
+    if started is None:
+        return
+    _request.started = None
+    endpoint = endpoint or 'not_found'
+    REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint, method=method)
+    REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+    REQUEST_SQL_QUERIES.observe(_request.sql_queries, endpoint=endpoint)
+    REQUEST_SQL_DURATION.observe(_request.sql_seconds, endpoint=endpoint)
+
+
+# ---------- SQL ----------
+
+def _record_query(sql, elapsed):
+    statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+    SQL_QUERY_DURATION.observe(elapsed, statement=statement)
+    if getattr(_request, 'started', None) is not None:
+        _request.sql_queries += 1
+        _request.sql_seconds += elapsed
+
+
+class SQLCursor(sqlite3.Cursor):
+    """Cursore che misura execute ed executemany (il fetch delle righe non è incluso)"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_query(sql, time.perf_counter() - started)
+
+
+class SQLConnection(sqlite3.Connection):
+    """Connessione i cui cursori (anche quelli di execute) sono strumentati"""
+
+    def cursor(self, factory=SQLCursor):
+        return super().cursor(factory)
+
+    # Le scorciatoie native creano il cursore senza passare da cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,160 @@
+"""
+Mappa di occupazione dei posti in memoria (una bitmap per evento)
+"""
+import threading
+import time
+from collections import namedtuple
+from config import ROW_LETTERS, COLS, UNAVAILABLE_SEATS
+
+# Dopo questo intervallo la mappa viene ricaricata dal database, così le
+# scritture fatte da altri worker gunicorn diventano visibili anche qui
+MAX_AGE_SECONDS = 2.0
+# Caricamenti ripetuti se una scrittura concorrente cambia la versione
+LOAD_ATTEMPTS = 3
+
+Seat = namedtuple('Seat', ['id', 'name', 'row', 'col', 'unavailable'])
+SeatRow = namedtuple('SeatRow', ['index', 'letter', 'seats'])
+
+def _compile_layout():
+    """Compila ROW_LETTERS x COLS in id interi (id = riga * COLS + colonna - 1)"""
+    seat_ids = {}
+    seat_names = []
+    rows = []
+    for row_index, letter in enumerate(ROW_LETTERS):
+        for col in range(1, COLS + 1):
+            name = f'{letter}{col}'
+            seat_ids[name] = len(seat_names)
+            seat_names.append(name)
+        # Ordine di visualizzazione: dalla colonna più alta alla più bassa
+        seats = tuple(
+            Seat(seat_ids[f'{letter}{col}'], f'{letter}{col}', row_index, col,
+                 f'{letter}{col}' in UNAVAILABLE_SEATS)
+            for col in range(COLS, 0, -1)
+        )
+        rows.append(SeatRow(row_index, letter, seats))
+    return seat_ids, tuple(seat_names), tuple(rows)
+
+SEAT_IDS, SEAT_NAMES, SEAT_LAYOUT = _compile_layout()
+SEAT_COUNT = len(SEAT_NAMES)
+
+
+class SeatSnapshot:
+    """Vista immutabile dell'occupazione di un evento a una certa versione"""
+
+    __slots__ = ('event_id', 'version', 'states')
+
+    def __init__(self, event_id, version, states):
+        self.event_id = event_id
+        self.version = version
+        self.states = states  # bytes: stato della prenotazione per ogni id (0 = libero)
+
+    def __contains__(self, seat):
+        seat_id = SEAT_IDS.get(seat)
+        return seat_id is not None and self.states[seat_id] != 0
+
+    def __iter__(self):
+        return (SEAT_NAMES[i] for i, state in enumerate(self.states) if state)
+
+    def __len__(self):
+        return SEAT_COUNT - self.states.count(0)
+
+    def is_taken(self, seat_id):
+        return self.states[seat_id] != 0
+
+
+class _EventMap:
+    __slots__ = ('states', 'version', 'loaded_at', 'snapshot')
+
+    def __init__(self, states):
+        self.states = states
+        self.version = 0
+        self.loaded_at = time.monotonic()
+        self.snapshot = None
+
+
+class OccupancyEngine:
+    """
+    Mantiene una bytearray di SEAT_COUNT byte per evento con un contatore di versione.
+    Le scritture su prenotazioni la aggiornano in modo incrementale.
+    """
+
+    def __init__(self, max_age=MAX_AGE_SECONDS):
+        self.max_age = max_age
+        self._events = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _load(self, event_id):
+        # Import locale: database notifica questo modulo a ogni scrittura
+        from database import get_seat_states
+        states = bytearray(SEAT_COUNT)
+        for seat, status in get_seat_states(event_id):
+            seat_id = SEAT_IDS.get(seat)
+            if seat_id is not None:
+                states[seat_id] = status
+        return _EventMap(states)
+
+    def _get(self, event_id):
+        event_map = self._events.get(event_id)
+        if event_map is None or time.monotonic() - event_map.loaded_at > self.max_age:
+            for _ in range(LOAD_ATTEMPTS):
+                seen_version = self._versions.get(event_id, 0)
+                fresh = self._load(event_id)
+                with self._lock:
+                    if self._versions.get(event_id, 0) == seen_version:
+                        fresh.version = self._bump(event_id)
+                        self._events[event_id] = event_map = fresh
+                        return event_map
+                # Scrittura concorrente durante il caricamento: la lettura può non includerla
+            with self._lock:
+                # Scritture continue: si usa l'ultima lettura, da ricaricare alla prossima
+                fresh.loaded_at = float('-inf')
+                fresh.version = self._bump(event_id)
+                self._events[event_id] = event_map = fresh
+        return event_map
+
+    def _bump(self, event_id):
+        # Il contatore sopravvive alle ricariche: le versioni restano monotone
+        version = self._versions.get(event_id, 0) + 1
+        self._versions[event_id] = version
+        return version
+
+    def snapshot(self, event_id):
+        """Ritorna lo SeatSnapshot corrente dell'evento"""
+        event_map = self._get(event_id)
+        snapshot = event_map.snapshot
+        if snapshot is None or snapshot.version != event_map.version:
+            with self._lock:
+                snapshot = SeatSnapshot(event_id, event_map.version, bytes(event_map.states))
+                event_map.snapshot = snapshot
+        return snapshot
+
+    def set_seats(self, event_id, seats, status):
+        """
+        Imposta lo stato dei posti indicati (0 = libero) se l'evento è in
+        memoria. La versione avanza comunque: un caricamento in corso la
+        confronta per sapere se può aver perso questa scrittura.
+        """
+        with self._lock:
+            version = self._bump(event_id)
+            event_map = self._events.get(event_id)
+            if event_map is None:
+                return
+            for seat in seats:
+                seat_id = SEAT_IDS.get(seat)
+                if seat_id is not None:
+                    event_map.states[seat_id] = status
+            event_map.version = version
+
+    def invalidate(self, event_id):
+        """Scarta la mappa dell'evento: verrà ricaricata alla prossima lettura"""
+        with self._lock:
+            self._events.pop(event_id, None)
+
+    def invalidate_all(self):
+        """Scarta le mappe di tutti gli eventi"""
+        with self._lock:
+            self._events.clear()
+
+
+engine = OccupancyEngine()
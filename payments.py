@@ -0,0 +1,122 @@
+"""
+Conferma dei pagamenti tramite webhook Stripe.
+
+Lo stato delle prenotazioni cambia solo qui, alla ricezione degli eventi
+firmati da Stripe, anche se il browser del cliente non torna sul sito.
+Ogni evento viene elaborato una sola volta (tabella stripe_events).
+
+La prenotazione resta riservata per tutta la durata della sessione di
+checkout; se un pagamento arriva comunque per posti già rivenduti viene
+rimborsato (o segnalato per il rimborso manuale).
+"""
+import json
+import logging
+from config import STRIPE_WEBHOOK_SECRET
+from database import (
+    get_booking_by_id, update_booking_status, restore_booking,
+    claim_stripe_event, release_stripe_event
+)
+from email_outbox import enqueue_booking_confirmation
+from http_client import get_stripe, stripe_call
+from metrics import LATE_PAYMENTS
+
+logger = logging.getLogger(__name__)
+
+PAID_EVENTS = ('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+UNPAID_EVENTS = ('checkout.session.expired', 'checkout.session.async_payment_failed')
+
+
+def construct_event(payload, signature):
+    """
+    Verifica la firma e ritorna l'evento come dict (ValueError se non valido)
+    """
+    if not STRIPE_WEBHOOK_SECRET:
+        raise ValueError('STRIPE_WEBHOOK_SECRET non configurato')
+    stripe = get_stripe()
+    try:
+        stripe.Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
+    except stripe.error.SignatureVerificationError as e:
+        raise ValueError(str(e)) from e
+    return json.loads(payload)
+
+
+def _session_booking_id(checkout_session):
+    booking_id = (checkout_session.get('metadata') or {}).get('booking_id') or checkout_session.get('client_reference_id')
+    return int(booking_id) if booking_id else None
+
+
+def confirm_payment(booking_id, payment_intent=None):
+    """Segna come pagata la prenotazione e accoda il biglietto; ritorna True se confermata"""
+    if get_booking_by_id(booking_id) is None:
+        logger.error(f"Pagamento per prenotazione inesistente {booking_id}")
+        return False
+    # Passaggio 1 -> 2 condizionato nella transazione: la scadenza può liberarla in qualsiasi momento
+    if not update_booking_status(booking_id, 2, from_status=1):  # Status 2 = pagato
+        # Pagamento concluso dopo la scadenza della prenotazione (o già confermato)
+        if not restore_booking(booking_id, 2):
+            booking = get_booking_by_id(booking_id)
+            if booking is not None and booking['status'] == 0:
+                refund_late_payment(booking_id, payment_intent)
+            return False
+    enqueue_booking_confirmation(booking_id)
+    logger.info(f"Pagamento confermato per prenotazione {booking_id}")
+    return True
+
+
+def refund_late_payment(booking_id, payment_intent):
+    """
+    Rimborsa il pagamento di una prenotazione i cui posti non sono più
+    disponibili. Un errore Stripe si propaga: l'evento webhook viene
+    rielaborato al prossimo invio e la chiave di idempotenza evita doppi rimborsi.
+    """
+    if not payment_intent:
+        LATE_PAYMENTS.inc(result='manual')
+        logger.critical(f"Prenotazione {booking_id} pagata dopo la scadenza, posti rivenduti: rimborso manuale necessario")
+        return
+    stripe = get_stripe()
+    try:
+        stripe_call(
+            stripe.Refund.create,
+            payment_intent=payment_intent,
+            metadata={'booking_id': booking_id},
+            idempotency_key=f'late-payment-refund-{booking_id}'
+        )
+    except Exception as e:
+        LATE_PAYMENTS.inc(result='error')
+        logger.critical(f"Rimborso della prenotazione {booking_id} ({payment_intent}) non riuscito: {e}")
+        raise
+    LATE_PAYMENTS.inc(result='refunded')
+    logger.error(f"Prenotazione {booking_id} pagata dopo la scadenza, posti rivenduti: pagamento {payment_intent} rimborsato")
+
+
+def release_unpaid(booking_id):
+    """Libera i posti di una prenotazione il cui checkout è scaduto o fallito"""
+    if update_booking_status(booking_id, 0, from_status=1):
+        logger.info(f"Checkout non concluso: liberata prenotazione {booking_id}")
+
+
+def handle_event(event):
+    """Elabora un evento webhook; ritorna False se ignorato o già elaborato"""
+    event_type = event['type']
+    if event_type not in PAID_EVENTS and event_type not in UNPAID_EVENTS:
+        return False
+    if not claim_stripe_event(event['id'], event_type):
+        logger.info(f"Evento Stripe {event['id']} già elaborato")
+        return False
+
+    try:
+        checkout_session = event['data']['object']
+        booking_id = _session_booking_id(checkout_session)
+        if booking_id is None:
+            logger.error(f"Evento Stripe {event['id']} senza booking_id")
+        elif event_type in PAID_EVENTS:
+            # Con metodi di pagamento asincroni completed arriva prima dell'incasso
+            if checkout_session.get('payment_status') != 'unpaid':
+                confirm_payment(booking_id, checkout_session.get('payment_intent'))
+        else:
+            release_unpaid(booking_id)
+    except Exception:
+        # Evento da rielaborare al prossimo invio di Stripe
+        release_stripe_event(event['id'])
+        raise
+    return True
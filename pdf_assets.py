@@ -0,0 +1,172 @@
+"""
+Cache delle immagini usate nei biglietti PDF (logo e locandine).
+
+Le immagini vengono decodificate una sola volta, ridimensionate alla misura di
+stampa e tenute in memoria con politica LRU e limite in byte.
+"""
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+import requests
+from PIL import Image as PILImage
+import http_client
+
+# Risoluzione di stampa del biglietto
+TICKET_DPI = 200
+# Misure di stampa in pollici (come in generate_email_ticket_pdf)
+LOGO_SIZE = (1.2, 1.2)
+POSTER_SIZE = (1.8, 2.2)
+# Memoria massima occupata dalle immagini in cache
+MAX_CACHE_BYTES = 16 * 1024 * 1024
+# Dopo questo intervallo una locandina remota viene rivalidata (ETag)
+REMOTE_REVALIDATE_SECONDS = 600
+JPEG_QUALITY = 85
+
+
+class ImageCache:
+    """Cache LRU di immagini già pronte per ReportLab, limitata in byte"""
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old['data'])
+            self._entries[key] = entry
+            self.current_bytes += len(entry['data'])
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted['data'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+cache = ImageCache()
+# Percorso locale già risolto per ogni immagine richiesta
+_resolved_paths = {}
+
+
+def _candidate_paths(relative_path):
+    """Percorsi in cui cercare un file statico (stesso ordine storico di pdf_generator)"""
+    base_dir = os.environ.get('APP_BASE_DIR', os.path.dirname(__file__))
+    relative_path = relative_path.lstrip('/')
+    return [
+        os.path.join(base_dir, relative_path),
+        os.path.join(os.path.dirname(__file__), relative_path),
+        os.path.join(os.getcwd(), relative_path),
+        relative_path,
+    ]
+
+
+def _stat_resolved(relative_path):
+    """Ritorna (percorso, stat) del file, cercandolo solo se non è già noto"""
+    path = _resolved_paths.get(relative_path)
+    if path is not None:
+        try:
+            return path, os.stat(path)
+        except OSError:
+            _resolved_paths.pop(relative_path, None)
+    for path in _candidate_paths(relative_path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        _resolved_paths[relative_path] = path
+        return path, st
+    return None, None
+
+
+def _prepare(source, size_inches):
+    """Decodifica e ridimensiona l'immagine alla misura di stampa"""
+    box = (round(size_inches[0] * TICKET_DPI), round(size_inches[1] * TICKET_DPI))
+    with PILImage.open(source) as img:
+        img.load()
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+        # Come in ReportLab, l'immagine riempie esattamente il riquadro di stampa
+        img = img.resize(box, PILImage.LANCZOS)
+        out = io.BytesIO()
+        if has_alpha:
+            img.save(out, format='PNG', optimize=True)
+        else:
+            img.save(out, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def get_local_image(relative_path, size_inches):
+    """Immagine locale pronta per la stampa (bytes) oppure None se il file non esiste"""
+    path, st = _stat_resolved(relative_path)
+    if path is None:
+        return None
+    key = ('file', path, st.st_mtime_ns, st.st_size, size_inches)
+    entry = cache.get(key)
+    if entry is None:
+        entry = {'data': _prepare(path, size_inches)}
+        cache.put(key, entry)
+    return entry['data']
+
+
+def get_remote_image(url, size_inches):
+    """
+    Locandina remota pronta per la stampa oppure None se non scaricabile.
+    Entro REMOTE_REVALIDATE_SECONDS non viene fatta alcuna richiesta; dopo si
+    rivalida con If-None-Match e un 304 riusa l'immagine già pronta.
+    Se il server non risponde si usa la copia in cache, anche se non rivalidata.
+    """
+    key = ('url', url, size_inches)
+    entry = cache.get(key)
+    now = time.monotonic()
+    if entry is not None and now - entry['checked_at'] < REMOTE_REVALIDATE_SECONDS:
+        return entry['data']
+
+    headers = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    try:
+        response = http_client.get_poster(url, headers=headers)
+    except (requests.RequestException, http_client.CircuitOpenError):
+        if entry is not None:
+            return entry['data']
+        raise
+
+    if response.status_code == 304 and entry is not None:
+        entry['checked_at'] = now
+        return entry['data']
+    if response.status_code != 200:
+        return None
+    entry = {
+        'data': _prepare(io.BytesIO(response.content), size_inches),
+        'etag': response.headers.get('ETag'),
+        'checked_at': now,
+    }
+    cache.put(key, entry)
+    return entry['data']
+
+
+def get_logo():
+    """Logo del teatro pronto per la stampa, oppure None"""
+    return get_local_image('static/img/logo.png', LOGO_SIZE)
+
+
+def get_poster(poster_url):
+    """Locandina dell'evento pronta per la stampa, oppure None"""
+    if poster_url.startswith('http'):
+        return get_remote_image(poster_url, POSTER_SIZE)
+    return get_local_image(poster_url, POSTER_SIZE)
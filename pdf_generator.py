@@ -23,29 +23,38 @@ def debug_image_paths(image_path):
     print("==============================")
     return possible_paths
 
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.lib.units import cm, inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-import os
 import io
-import requests
+import logging
 from datetime import datetime
-from reportlab.lib.pagesizes import A4, landscape
-from reportlab.lib.units import cm, inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle, KeepTogether
+from xml.sax.saxutils import escape
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle, KeepTogether, LongTable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-from urllib.parse import urlparse
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.utils import simpleSplit
+import pdf_assets
+import ticket_template
+from database import format_event_date
+from metrics import PDF_RENDER_DURATION
+
+logger = logging.getLogger(__name__)
 
 def generate_email_ticket_pdf(booking, event):
+    """
+    Genera il PDF del biglietto disegnandolo direttamente sul canvas
+    (ticket_template); in caso di errore usa l'impaginazione platypus
+    """
+    with PDF_RENDER_DURATION.time(kind='ticket'):
+        try:
+            return ticket_template.render_ticket(booking, event)
+        except Exception as e:
+            logger.warning(f"Errore rendering rapido biglietto {booking['id']}, uso platypus: {e}")
+            return generate_email_ticket_pdf_flowables(booking, event)
+
+
+def generate_email_ticket_pdf_flowables(booking, event):
     """
     Genera un PDF del biglietto ottimizzato per email con logo e poster
     
@@ -117,37 +126,22 @@ def generate_email_ticket_pdf(booking, event):
     # Lista elementi del documento
     story = []
     
-    # Header con logo se esiste
+    # Header con logo se esiste (immagine già ridimensionata, dalla cache)
     try:
-        import os
-        # Prova diversi percorsi possibili per il logo
-        base_dir = os.environ.get('APP_BASE_DIR', os.path.dirname(__file__))
-        logo_paths = [
-            os.path.join(base_dir, 'static', 'img', 'logo.png'),
-            os.path.join(os.path.dirname(__file__), 'static', 'img', 'logo.png'),
-            os.path.join(os.getcwd(), 'static', 'img', 'logo.png'),
-            'static/img/logo.png',
-            './static/img/logo.png'
-        ]
-        
-        logo_loaded = False
-        for logo_path in logo_paths:
-            if os.path.exists(logo_path):
-                logo = Image(logo_path, width=1.2*inch, height=1.2*inch)
-                logo.hAlign = 'CENTER'
-                story.append(logo)
-                story.append(Spacer(1, 0.1*inch))
-                logo_loaded = True
-                break
-        
-        if not logo_loaded:
+        logo_data = pdf_assets.get_logo()
+        if logo_data:
+            logo = Image(io.BytesIO(logo_data), width=1.2*inch, height=1.2*inch)
+            logo.hAlign = 'CENTER'
+            story.append(logo)
+            story.append(Spacer(1, 0.1*inch))
+        else:
             # Fallback: aggiungi spazio per il logo mancante
-            print("Warning: Logo non trovato in nessun percorso")
+            logger.warning("Logo non trovato in nessun percorso")
             story.append(Spacer(1, 0.3*inch))
             
     except Exception as e:
         # Log dell'errore ma continua
-        print(f"Errore caricamento logo: {e}")
+        logger.error(f"Errore caricamento logo: {e}")
         story.append(Spacer(1, 0.3*inch))
     
     # Titolo principale del teatro
@@ -162,38 +156,14 @@ def generate_email_ticket_pdf(booking, event):
     if event['poster_url']:
         try:
             poster_added = False
-            if event['poster_url'].startswith('http'):
-                # URL esterno
-                import requests
-                response = requests.get(event['poster_url'], timeout=10, headers={
-                    'User-Agent': 'Mozilla/5.0 (compatible; TSR-PDF-Generator/1.0)'
-                })
-                if response.status_code == 200:
-                    img_buffer = io.BytesIO(response.content)
-                    poster = Image(img_buffer, width=1.8*inch, height=2.2*inch)
-                    poster.hAlign = 'CENTER'
-                    story.append(poster)
-                    story.append(Spacer(1, 0.1*inch))
-                    poster_added = True
-            else:
-                # File locale - prova diversi percorsi
-                base_dir = os.environ.get('APP_BASE_DIR', os.path.dirname(__file__))
-                poster_paths = [
-                    os.path.join(base_dir, event['poster_url'].lstrip('/')),
-                    os.path.join(os.path.dirname(__file__), event['poster_url'].lstrip('/')),
-                    os.path.join(os.getcwd(), event['poster_url'].lstrip('/')),
-                    event['poster_url'].lstrip('/'),
-                    os.path.join('static', event['poster_url'].lstrip('/static/'))
-                ]
-                
-                for poster_path in poster_paths:
-                    if os.path.exists(poster_path):
-                        poster = Image(poster_path, width=1.8*inch, height=2.2*inch)
-                        poster.hAlign = 'CENTER'
-                        story.append(poster)
-                        story.append(Spacer(1, 0.1*inch))
-                        poster_added = True
-                        break
+            # Locale o remota, già ridimensionata alla misura di stampa (cache LRU)
+            poster_data = pdf_assets.get_poster(event['poster_url'])
+            if poster_data:
+                poster = Image(io.BytesIO(poster_data), width=1.8*inch, height=2.2*inch)
+                poster.hAlign = 'CENTER'
+                story.append(poster)
+                story.append(Spacer(1, 0.1*inch))
+                poster_added = True
                         
             if not poster_added:
                 # Fallback: placeholder testuale pulito
@@ -211,7 +181,7 @@ def generate_email_ticket_pdf(booking, event):
                 story.append(Spacer(1, 0.1*inch))
                 
         except Exception as e:
-            print(f"Errore caricamento poster: {e}")
+            logger.error(f"Errore caricamento poster {event['poster_url']}: {e}")
             # Aggiungi placeholder pulito in caso di errore
             placeholder_style = ParagraphStyle(
                 'PlaceholderStyle',
@@ -234,7 +204,7 @@ def generate_email_ticket_pdf(booking, event):
     data = [
         ['👤 Intestatario', booking['name']],
         ['📧 Contatto', booking['email']],
-        ['📅 Data Spettacolo', event['date']],
+        ['📅 Data Spettacolo', format_event_date(event['date'])],
         ['⏰ Orario', event['time']],
         ['🎫 Posti Riservati', booking['seats']],
         ['💰 Totale Pagato', f"€ {total_price:.2f}"],
@@ -306,31 +276,89 @@ def generate_email_ticket_pdf(booking, event):
     return buffer.getvalue()
 
 #PEPPE
+# Riepilogo evento: colonne a larghezza fissa (pollici) e righe per blocco
+SUMMARY_COLUMNS = (
+    ('ID', 0.6),
+    ('Nome', 1.6),
+    ('Email', 2.0),
+    ('Posti', 1.3),
+    ('Stato', 0.8),
+    ('Totale €', 0.9),
+)
+SUMMARY_CHUNK_ROWS = 200
+SUMMARY_STATUS_LABELS = {
+    0: 'Annullato',
+    1: 'Pending',
+    2: 'Pagato',
+    3: 'Cassa'
+}
+SUMMARY_FONT_SIZE = 9
+SUMMARY_PADDING = 4
+SUMMARY_HEADER_BG = colors.HexColor('#2d3748')
+SUMMARY_TOTAL_BG = colors.HexColor('#f7fafc')
+SUMMARY_GRID = colors.HexColor('#e2e8f0')
+
+
+def _summary_cell(text, width, font='Helvetica'):
+    """Testo della cella spezzato su più righe entro la larghezza della colonna"""
+    lines = simpleSplit(str(text), font, SUMMARY_FONT_SIZE, width - 2 * SUMMARY_PADDING)
+    return '\n'.join(lines) or ''
+
+
+def _summary_table(rows, col_widths, total_row=False):
+    table = LongTable(rows, colWidths=col_widths, repeatRows=1)
+    style = [
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), SUMMARY_FONT_SIZE),
+        ('LEADING', (0, 0), (-1, -1), SUMMARY_FONT_SIZE + 2),
+        ('BACKGROUND', (0, 0), (-1, 0), SUMMARY_HEADER_BG),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('GRID', (0, 0), (-1, -1), 0.5, SUMMARY_GRID),
+        ('PADDING', (0, 0), (-1, -1), SUMMARY_PADDING),
+    ]
+    if total_row:
+        style += [
+            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+            ('BACKGROUND', (0, -1), (-1, -1), SUMMARY_TOTAL_BG),
+        ]
+    table.setStyle(TableStyle(style))
+    return table
+
+
 def generate_tickets_summary_pdf(bookings, event):
     """
     Genera un PDF riassuntivo con tutti i biglietti di un evento
-    
+
+    Le righe vengono consumate una alla volta (anche da un cursore) e
+    impaginate in LongTable a colonne fisse di SUMMARY_CHUNK_ROWS righe,
+    con intestazione ripetuta su ogni pagina e subtotali per stato.
+    A parità di dati il PDF prodotto è identico byte per byte.
+
     Args:
-        bookings: Lista di prenotazioni
+        bookings: Iterabile di prenotazioni (dict)
         event: Dict con i dati dell'evento
-    
+
     Returns:
-        BytesIO: Buffer contenente il PDF generato
+        bytes: Contenuto del PDF generato
     """
-    
     buffer = io.BytesIO()
-    
+
     doc = SimpleDocTemplate(
         buffer,
         pagesize=A4,
         rightMargin=0.5*inch,
         leftMargin=0.5*inch,
         topMargin=0.5*inch,
-        bottomMargin=0.5*inch
+        bottomMargin=0.5*inch,
+        title=f"Riepilogo Prenotazioni - {event['title']}",
+        invariant=1
     )
-    
+
     styles = getSampleStyleSheet()
-    
+
     title_style = ParagraphStyle(
         'CustomTitle',
         parent=styles['Title'],
@@ -340,63 +368,59 @@ def generate_tickets_summary_pdf(bookings, event):
         spaceAfter=20,
         fontName='Helvetica-Bold'
     )
-    
+
     story = []
-    
+
     # Header
-    story.append(Paragraph("🎭 TEATRO SAN RAFFAELE", title_style))
-    story.append(Paragraph(f"<b>Riepilogo Prenotazioni - {event['title']}</b>", title_style))
-    story.append(Paragraph(f"Data: {event['date']} - Ore: {event['time']}", styles['Normal']))
+    story.append(Paragraph("TEATRO SAN RAFFAELE", title_style))
+    story.append(Paragraph(f"<b>Riepilogo Prenotazioni - {escape(event['title'])}</b>", title_style))
+    story.append(Paragraph(f"Data: {format_event_date(event['date'])} - Ore: {event['time']}", styles['Normal']))
     story.append(Spacer(1, 0.3*inch))
-    
-    # Tabella riassuntiva
-    headers = ['ID', 'Nome', 'Email', 'Posti', 'Stato', 'Totale €']
-    data = [headers]
-    
-    total_revenue = 0
-    total_tickets = 0
-    
+
+    # Tabella prenotazioni a blocchi
+    col_widths = [width * inch for _, width in SUMMARY_COLUMNS]
+    headers = [label for label, _ in SUMMARY_COLUMNS]
+    subtotals = {}  # status -> [prenotazioni, posti, totale]
+    rows = [headers]
+
     for booking in bookings:
         seats_count = len(booking['seats'].split(','))
         booking_total = event['price'] * seats_count
-        total_revenue += booking_total
-        total_tickets += seats_count
-        
-        status_map = {
-            1: 'Pending',
-            2: 'Pagato',
-            3: 'Cassa'
-        }
-        
-        data.append([
+        subtotal = subtotals.setdefault(booking['status'], [0, 0, 0.0])
+        subtotal[0] += 1
+        subtotal[1] += seats_count
+        subtotal[2] += booking_total
+
+        rows.append([
             str(booking['id']),
-            booking['name'],
-            booking['email'],
-            booking['seats'],
-            status_map.get(booking['status'], 'Sconosciuto'),
+            _summary_cell(booking['name'], col_widths[1]),
+            _summary_cell(booking['email'], col_widths[2]),
+            _summary_cell(booking['seats'].replace(',', ', '), col_widths[3]),
+            SUMMARY_STATUS_LABELS.get(booking['status'], 'Sconosciuto'),
             f"€ {booking_total:.2f}"
         ])
-    
-    # Riga totale
-    data.append(['', '', '', f'Tot. {total_tickets} posti', '', f'€ {total_revenue:.2f}'])
-    
-    table = Table(data)
-    table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),  # Header
-        ('FONTNAME', (0, 1), (-1, -2), 'Helvetica'),     # Dati
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'), # Totale
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#2d3748')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#f7fafc')),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('GRID', (0, 0), (-1, -1), 1, colors.HexColor('#e2e8f0')),
-        ('PADDING', (0, 0), (-1, -1), 6),
-    ]))
-    
-    story.append(table)
-    
-    doc.build(story)
-    buffer.seek(0)
-    return buffer.getvalue()
\ No newline at end of file
+        if len(rows) > SUMMARY_CHUNK_ROWS:
+            story.append(_summary_table(rows, col_widths))
+            rows = [headers]
+
+    if len(rows) > 1:
+        story.append(_summary_table(rows, col_widths))
+
+    # Subtotali per stato e totale
+    totals_widths = [2.2 * inch, 1.5 * inch, 1.5 * inch, 1.5 * inch]
+    totals = [['Stato', 'Prenotazioni', 'Posti', 'Totale €']]
+    for status in sorted(subtotals):
+        count, seats, amount = subtotals[status]
+        totals.append([SUMMARY_STATUS_LABELS.get(status, 'Sconosciuto'), str(count), str(seats), f"€ {amount:.2f}"])
+    totals.append([
+        'Totale',
+        str(sum(s[0] for s in subtotals.values())),
+        str(sum(s[1] for s in subtotals.values())),
+        f"€ {sum(s[2] for s in subtotals.values()):.2f}"
+    ])
+    story.append(Spacer(1, 0.3*inch))
+    story.append(KeepTogether(_summary_table(totals, totals_widths, total_row=True)))
+
+    with PDF_RENDER_DURATION.time(kind='summary'):
+        doc.build(story)
+    return buffer.getvalue()
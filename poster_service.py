@@ -0,0 +1,125 @@
+"""
+Elaborazione delle locandine caricate: varianti ridimensionate con nome basato
+sul contenuto (servibili con cache permanente) e originale conservato per la stampa.
+"""
+import hashlib
+import io
+import os
+import re
+from PIL import Image as PILImage, ImageOps, features
+from config import UPLOAD_FOLDER
+
+# Larghezza massima in pixel di ogni variante
+POSTER_VARIANTS = {
+    'thumb': 320,
+    'card': 640,
+    'full': 1280,
+}
+# Variante usata come src di default nelle pagine
+DEFAULT_VARIANT = 'card'
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+HASH_LENGTH = 16
+
+ORIGINALS_FOLDER = os.path.join(UPLOAD_FOLDER, 'originals')
+POSTERS_URL = '/static/posters'
+
+WEBP_SUPPORTED = features.check('webp')
+
+# Nome delle varianti generate: <hash>-<variante>.<jpg|webp>
+VARIANT_FILENAME_RE = re.compile(r'^[0-9a-f]{%d}-(%s)\.(jpg|webp)$' % (HASH_LENGTH, '|'.join(POSTER_VARIANTS)))
+ORIGINAL_URL_RE = re.compile(r'^%s/originals/([0-9a-f]{%d})\.\w+$' % (POSTERS_URL, HASH_LENGTH))
+
+
+def _variant_filename(content_hash, variant, ext):
+    return f'{content_hash}-{variant}.{ext}'
+
+
+def save_poster_upload(file_storage):
+    """
+    Salva una locandina caricata: originale in posters/originals, varianti JPEG
+    (e WebP se disponibile) in posters. Ritorna l'URL dell'originale, oppure
+    None se il file non è un'immagine valida.
+    """
+    data = file_storage.read()
+    try:
+        with PILImage.open(io.BytesIO(data)) as probe:
+            probe.verify()
+    except Exception:
+        return None
+
+    content_hash = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    ext = os.path.splitext(file_storage.filename)[1].lower().lstrip('.') or 'png'
+
+    os.makedirs(ORIGINALS_FOLDER, exist_ok=True)
+    original_path = os.path.join(ORIGINALS_FOLDER, f'{content_hash}.{ext}')
+    if not os.path.exists(original_path):
+        with open(original_path, 'wb') as f:
+            f.write(data)
+
+    with PILImage.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        for variant, max_width in POSTER_VARIANTS.items():
+            jpeg_path = os.path.join(UPLOAD_FOLDER, _variant_filename(content_hash, variant, 'jpg'))
+            if os.path.exists(jpeg_path):
+                # Stesso contenuto già elaborato
+                continue
+            resized = img
+            if img.width > max_width:
+                height = round(img.height * max_width / img.width)
+                resized = img.resize((max_width, height), PILImage.LANCZOS)
+            resized.save(jpeg_path, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            if WEBP_SUPPORTED:
+                webp_path = os.path.join(UPLOAD_FOLDER, _variant_filename(content_hash, variant, 'webp'))
+                resized.save(webp_path, format='WEBP', quality=WEBP_QUALITY, method=6)
+
+    return f'{POSTERS_URL}/originals/{content_hash}.{ext}'
+
+
+# Sorgenti già calcolate per hash: le varianti non cambiano mai
+_sources_cache = {}
+
+
+def poster_sources(poster_url):
+    """
+    URL delle varianti di una locandina per src/srcset nei template.
+    Ritorna None per le locandine caricate prima della generazione delle varianti.
+    """
+    match = ORIGINAL_URL_RE.match(poster_url or '')
+    if not match:
+        return None
+    content_hash = match.group(1)
+    sources = _sources_cache.get(content_hash)
+    if sources is not None:
+        return sources
+
+    # Larghezza reale di ogni variante (le immagini piccole non vengono ingrandite)
+    widths = {}
+    for variant in POSTER_VARIANTS:
+        try:
+            with PILImage.open(os.path.join(UPLOAD_FOLDER, _variant_filename(content_hash, variant, 'jpg'))) as img:
+                widths[variant] = img.width
+        except OSError:
+            return None
+
+    def srcset(ext):
+        seen = set()
+        entries = []
+        for variant, width in widths.items():
+            if width not in seen:
+                seen.add(width)
+                entries.append(f'{POSTERS_URL}/{_variant_filename(content_hash, variant, ext)} {width}w')
+        return ', '.join(entries)
+
+    sources = {
+        'src': f'{POSTERS_URL}/{_variant_filename(content_hash, DEFAULT_VARIANT, "jpg")}',
+        'jpeg_srcset': srcset('jpg'),
+        'webp_srcset': srcset('webp') if WEBP_SUPPORTED else None,
+    }
+    _sources_cache[content_hash] = sources
+    return sources
+
+
+def is_immutable_poster(filename):
+    """True se il file è una variante con nome basato sul contenuto (mai sovrascritta)"""
+    return VARIANT_FILENAME_RE.match(filename) is not None
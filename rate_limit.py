@@ -0,0 +1,219 @@
+"""
+Limiti di frequenza per client sulle route costose: prenotazione posti
+(scritture sul database), creazione del checkout (una sessione Stripe per
+chiamata) e login admin (tentativi di password).
+
+Ogni route ha due token bucket: uno per client (IP + biglietto della sala
+d'attesa o id di sessione) con `burst` richieste di fila e poi `per_minute`
+al minuto, e uno per IP IP_LIMIT_FACTOR volte più largo, che limita chi
+scarta i cookie senza penalizzare gli utenti dietro lo stesso NAT. Oltre il
+limite la richiesta viene rifiutata con 429 e Retry-After prima di toccare
+database o Stripe. L'IP è quello del client dietro il reverse proxy
+(ProxyFix in app.py, TRUSTED_PROXIES).
+
+Due backend:
+- memory: bucket nel processo, per il server di sviluppo o un solo worker;
+- sqlite (default): bucket in un file SQLite separato dal database principale,
+  condiviso dai worker gunicorn. Un controllo è un solo UPSERT atomico e non
+  contende il lock di scrittura del database delle prenotazioni. Richiede
+  SQLite >= 3.35 (RETURNING): con versioni precedenti si usa memory.
+
+Se il backend fallisce la richiesta passa (le vendite non si bloccano), con
+log e contatore tsr_rate_limit_errors_total.
+"""
+import logging
+import math
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from flask import request, session
+from werkzeug.exceptions import TooManyRequests
+from config import RATE_LIMIT_ENABLED, RATE_LIMIT_BACKEND, RATE_LIMIT_DB_PATH
+from metrics import RATE_LIMITED, RATE_LIMIT_ERRORS
+
+logger = logging.getLogger(__name__)
+
+Limit = namedtuple('Limit', 'per_minute burst')
+
+# Budget per route e per client
+LIMITS = {
+    'booking': Limit(per_minute=10, burst=5),
+    'checkout': Limit(per_minute=10, burst=5),
+    'login': Limit(per_minute=5, burst=5),
+}
+# Il bucket per IP consente IP_LIMIT_FACTOR client dietro lo stesso indirizzo
+IP_LIMIT_FACTOR = 20
+# Versione minima di SQLite per il backend condiviso (INSERT ... RETURNING)
+SQLITE_MIN_VERSION = (3, 35, 0)
+# I bucket inutilizzati da più di questo tempo sono pieni e vengono eliminati
+IDLE_SECONDS = 3600
+
+
+def _refill(tokens, updated_at, limit, now):
+    return min(limit.burst, tokens + (now - updated_at) * limit.per_minute / 60)
+
+
+def _retry_after(tokens, limit):
+    """Secondi prima che il bucket abbia di nuovo un token"""
+    return max(1, math.ceil((1 - tokens) * 60 / limit.per_minute))
+
+
+class MemoryBackend:
+    """Bucket nel processo corrente"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._pruned_at = time.time()
+
+    def take(self, key, limit, now):
+        """Consuma un token: ritorna 0 se concesso, altrimenti i secondi di Retry-After"""
+        # Ogni processo ha i suoi bucket: la pulizia avviene qui, non nel job del leader
+        if now - self._pruned_at > IDLE_SECONDS:
+            self.prune(now)
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (limit.burst, now))
+            tokens = _refill(tokens, updated_at, limit, now)
+            if tokens < 1:
+                # Il rifiuto non consuma: il bucket continua a ricaricarsi
+                self._buckets[key] = (tokens, now)
+                return _retry_after(tokens, limit)
+            self._buckets[key] = (tokens - 1, now)
+            return 0
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        self._pruned_at = now
+        with self._lock:
+            for key in [key for key, (_, updated_at) in self._buckets.items() if now - updated_at > IDLE_SECONDS]:
+                del self._buckets[key]
+
+
+class SQLiteBackend:
+    """Bucket condivisi tra processi in un file SQLite dedicato"""
+
+    def __init__(self, path=RATE_LIMIT_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        # Connessione per thread, ricreata dopo un fork (gunicorn)
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Perdere i bucket in un crash non fa danni: nessun fsync
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL      -- epoch in secondi
+                ) WITHOUT ROWID
+            """)
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def take(self, key, limit, now):
+        """Consuma un token: ritorna 0 se concesso, altrimenti i secondi di Retry-After"""
+        conn = self._connect()
+        rate = limit.per_minute / 60
+        # Refill e consumo in un solo statement: atomico anche tra processi
+        granted = conn.execute("""
+            INSERT INTO rate_limits (key, tokens, updated_at) VALUES (:key, :burst - 1, :now)
+            ON CONFLICT(key) DO UPDATE SET
+                tokens = min(:burst, tokens + (:now - updated_at) * :rate) - 1,
+                updated_at = :now
+            WHERE min(:burst, tokens + (:now - updated_at) * :rate) >= 1
+            RETURNING tokens
+        """, {'key': key, 'burst': limit.burst, 'now': now, 'rate': rate}).fetchall()
+        if granted:
+            return 0
+        row = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?', (key,)).fetchone()
+        return _retry_after(_refill(row[0], row[1], limit, now), limit)
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        self._connect().execute('DELETE FROM rate_limits WHERE updated_at < ?', (now - IDLE_SECONDS,))
+
+
+class RateLimiter:
+    def __init__(self, backend, enabled=RATE_LIMIT_ENABLED):
+        self.backend = backend
+        self.enabled = enabled
+
+    def check(self, route, ip, client, now=None):
+        """
+        Consuma un token del client e uno dell'IP per la route; oltre uno dei
+        due limiti solleva TooManyRequests
+        """
+        if not self.enabled:
+            return
+        now = time.time() if now is None else now
+        limit = LIMITS[route]
+        ip_limit = Limit(limit.per_minute * IP_LIMIT_FACTOR, limit.burst * IP_LIMIT_FACTOR)
+        try:
+            retry_after = (
+                self.backend.take(f'{route}:{ip}:{client}', limit, now)
+                or self.backend.take(f'{route}:{ip}', ip_limit, now)
+            )
+        except sqlite3.Error as e:
+            # Un problema del limitatore non deve bloccare le vendite: la richiesta passa
+            RATE_LIMIT_ERRORS.inc(route=route)
+            logger.error(f"Limitatore richieste non disponibile, richiesta {route} da {ip} lasciata passare: {e}")
+            return
+        if retry_after:
+            RATE_LIMITED.inc(route=route)
+            logger.warning(f"Limite richieste superato: {route} da {ip} ({client})")
+            raise TooManyRequests(retry_after=retry_after)
+
+    def prune(self):
+        """Elimina i bucket inutilizzati (job periodico)"""
+        self.backend.prune()
+
+    def limit(self, route, methods=('GET', 'POST')):
+        """Decoratore: applica il budget della route alle richieste con i metodi indicati"""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method in methods:
+                    self.check(route, request.remote_addr, _client_id(kwargs.get('event_id')))
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+
+def _client_id(event_id=None):
+    """
+    Identificativo del client oltre all'IP: il biglietto della sala d'attesa
+    per l'evento (costa un posto in coda), altrimenti un id casuale in sessione
+    """
+    if event_id is not None:
+        from waiting_room import room as waiting_room
+        ticket = waiting_room.admission_ticket(event_id, request.cookies.get(waiting_room.admission_cookie(event_id)))
+        if ticket is not None:
+            return f'ticket-{ticket}'
+    if 'client_id' not in session:
+        session['client_id'] = secrets.token_urlsafe(8)
+    return session['client_id']
+
+
+def _create_backend():
+    if RATE_LIMIT_BACKEND != 'sqlite':
+        return MemoryBackend()
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        logger.warning(
+            f"SQLite {sqlite3.sqlite_version} non supporta RETURNING: limiti di frequenza "
+            "in memoria, non condivisi tra i worker"
+        )
+        return MemoryBackend()
+    return SQLiteBackend()
+
+
+limiter = RateLimiter(_create_backend())
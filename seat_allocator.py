@@ -0,0 +1,181 @@
+"""
+Assegnazione automatica del miglior blocco di posti contigui disponibili.
+
+La sala è divisa in segmenti statici (posti consecutivi della stessa fila,
+senza posti non disponibili e senza attraversare il corridoio verticale),
+calcolati una volta all'import. Per ogni evento vengono tenute le sequenze
+di posti liberi di ogni segmento; quando la mappa di occupazione cambia
+versione si ricalcolano solo le file i cui byte sono cambiati. Una richiesta
+valuta ogni sequenza in tempo costante (posizione migliore del blocco al
+suo interno) e la risposta resta valida finché la mappa non cambia versione,
+quindi risponde in pochi microsecondi.
+
+I blocchi sono ordinati per distanza dal centro del palcoscenico: la fila
+di indice 0 è la più vicina, il corridoio orizzontale e quello verticale
+contano come una fila / un posto di distanza in più.
+"""
+import math
+import threading
+from config import COLS
+from occupancy import SEAT_LAYOUT, engine as occupancy
+
+# Corridoio verticale tra le colonne AISLE_COL e AISLE_COL + 1 (come nella piantina)
+AISLE_COL = 14
+# Corridoio orizzontale prima della fila di indice CORRIDOR_ROW (come nella piantina)
+CORRIDOR_ROW = 7
+# Posti massimi per acquisto (come nei form di prenotazione)
+MAX_PARTY_SIZE = 10
+
+
+def _x(col):
+    """Ascissa del posto in larghezze di poltrona, corridoio verticale incluso"""
+    return col + (1 if col > AISLE_COL else 0)
+
+
+def _y(row_index):
+    """Distanza della fila dal palcoscenico in file, corridoio orizzontale incluso"""
+    return row_index + 1 + (1 if row_index >= CORRIDOR_ROW else 0)
+
+
+# Centro del palcoscenico sull'asse delle colonne
+STAGE_CENTER_X = (_x(1) + _x(COLS)) / 2
+
+
+class _Segment:
+    """Posti consecutivi disponibili di una fila, da sinistra a destra (colonne crescenti)"""
+
+    __slots__ = ('row', 'y', 'x0', 'seat_ids', 'names')
+
+    def __init__(self, row, seats):
+        self.row = row
+        self.y = _y(row)
+        self.x0 = _x(seats[0].col)
+        self.seat_ids = tuple(seat.id for seat in seats)
+        self.names = tuple(seat.name for seat in seats)
+
+
+def _compile_segments():
+    """Segmenti di ogni fila: interrotti da posti non disponibili e dal corridoio"""
+    rows = []
+    for row in SEAT_LAYOUT:
+        segments = []
+        current = []
+        for seat in sorted(row.seats, key=lambda s: s.col):
+            if seat.unavailable or (current and seat.col == AISLE_COL + 1):
+                if current:
+                    segments.append(_Segment(row.index, current))
+                current = []
+            if not seat.unavailable:
+                current.append(seat)
+        if current:
+            segments.append(_Segment(row.index, current))
+        rows.append(tuple(segments))
+    return tuple(rows)
+
+
+ROW_SEGMENTS = _compile_segments()
+
+
+def _row_runs(segments, states):
+    """Sequenze di posti liberi della fila: (segmento, indice iniziale, lunghezza)"""
+    runs = []
+    for segment in segments:
+        start = None
+        for i, seat_id in enumerate(segment.seat_ids):
+            if states[seat_id] == 0:
+                if start is None:
+                    start = i
+            elif start is not None:
+                runs.append((segment, start, i - start))
+                start = None
+        if start is not None:
+            runs.append((segment, start, len(segment.seat_ids) - start))
+    return tuple(runs)
+
+
+def _best_in_run(segment, start, length, count):
+    """(distanza, indice iniziale) del blocco di count posti più centrale nella sequenza"""
+    # Posizione ideale: centro del blocco sul centro del palcoscenico, poi limitata alla sequenza
+    ideal = math.floor(STAGE_CENTER_X - (count - 1) / 2 - segment.x0 + 0.5)
+    first = min(max(ideal, start), start + length - count)
+    dx = segment.x0 + first + (count - 1) / 2 - STAGE_CENTER_X
+    return math.hypot(dx, segment.y), first
+
+
+class _EventRuns:
+    __slots__ = ('version', 'row_states', 'rows', 'max_run', 'answers')
+
+    def __init__(self):
+        self.version = None
+        self.answers = {}
+        self.row_states = [None] * len(ROW_SEGMENTS)
+        self.rows = [()] * len(ROW_SEGMENTS)
+        self.max_run = [0] * len(ROW_SEGMENTS)
+
+
+class SeatAllocator:
+    """Sequenze di posti liberi per evento, aggiornate dalla mappa di occupazione"""
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def _runs(self, event_id):
+        snapshot = occupancy.snapshot(event_id)
+        with self._lock:
+            runs = self._events.get(event_id)
+            if runs is None:
+                runs = self._events[event_id] = _EventRuns()
+            if runs.version == snapshot.version:
+                return runs
+            states = snapshot.states
+            for row, segments in enumerate(ROW_SEGMENTS):
+                row_states = states[row * COLS:(row + 1) * COLS]
+                if row_states == runs.row_states[row]:
+                    continue
+                runs.row_states[row] = row_states
+                runs.rows[row] = _row_runs(segments, states)
+                runs.max_run[row] = max((length for _, _, length in runs.rows[row]), default=0)
+            runs.version = snapshot.version
+            runs.answers = {}
+            return runs
+
+    def best_block(self, event_id, count):
+        """
+        Nomi dei count posti contigui più vicini al centro del palcoscenico,
+        oppure None se nessuna fila ha un blocco libero abbastanza lungo
+        """
+        if count < 1:
+            return None
+        runs = self._runs(event_id)
+        # Stessa versione della mappa, stessa risposta
+        answers = runs.answers
+        if count in answers:
+            return list(answers[count]) if answers[count] else None
+        best = None
+        for row, row_runs in enumerate(runs.rows):
+            if best is not None and best[0][0] <= _y(row):
+                break  # le file seguenti sono tutte più lontane
+            if runs.max_run[row] < count:
+                continue
+            for segment, start, length in row_runs:
+                if length < count:
+                    continue
+                distance, first = _best_in_run(segment, start, length, count)
+                key = (distance, row, segment.x0 + first)
+                if best is None or key < best[0]:
+                    best = (key, segment, first)
+        seats = None
+        if best is not None:
+            _, segment, first = best
+            seats = segment.names[first:first + count]
+        answers[count] = seats
+        return list(seats) if seats else None
+
+    def invalidate(self, event_id):
+        """Scarta le sequenze dell'evento"""
+        with self._lock:
+            self._events.pop(event_id, None)
+
+
+allocator = SeatAllocator()
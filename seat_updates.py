@@ -0,0 +1,177 @@
+"""
+Aggiornamenti live della piantina posti tramite Server-Sent Events.
+
+Un solo thread per processo legge il registro seat_changes (alimentato da trigger
+su booking_seats) e smista le variazioni alle code dei client collegati: i client
+non tengono aperte connessioni al database.
+
+Con worker gthread ogni stream aperto occupa un thread per tutta la sua durata:
+gli stream per processo sono limitati a SEAT_STREAM_LIMIT (oltre si risponde
+503 e il browser riprova più tardi, la piantina resta comunque usabile) e
+ognuno si chiude dopo SEAT_STREAM_MAX_SECONDS, così il browser si riconnette
+e i thread si ridistribuiscono tra i worker. Il dimensionamento dei thread è
+in gunicorn.conf.py.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from config import SEAT_STREAM_LIMIT, SEAT_STREAM_MAX_SECONDS
+from database import get_seat_changes_since, get_last_seat_change_id, close_db
+from occupancy import engine as occupancy
+
+logger = logging.getLogger(__name__)
+
+# Intervallo di lettura del registro variazioni
+POLL_INTERVAL = 0.5
+# Righe lette per ciclo; se il lotto è pieno si rilegge subito
+POLL_BATCH = 1000
+# Commento SSE periodico per mantenere viva la connessione
+HEARTBEAT_INTERVAL = 15
+# Lotti in coda per client lento prima di forzare una risincronizzazione
+SUBSCRIBER_QUEUE_SIZE = 64
+# Attesa del browser prima di riconnettersi a uno stream chiuso (ms, con jitter)
+RECONNECT_MIN_MS = 2000
+RECONNECT_MAX_MS = 5000
+
+
+class _Subscriber:
+    __slots__ = ('queue', 'resync')
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.resync = False
+
+
+class SeatChangeBroadcaster:
+    """Distribuisce le variazioni dei posti ai client iscritti, raggruppati per evento"""
+
+    def __init__(self, poll_interval=POLL_INTERVAL, max_subscribers=SEAT_STREAM_LIMIT):
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # Avvio pigro, e di nuovo dopo un fork: i thread non sopravvivono al fork
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            # Il cursore parte prima di qualsiasi snapshot inviato ai client;
+            # le mappe in memoria si ricaricano e da qui in poi le aggiorna il thread
+            last_id = get_last_seat_change_id()
+            occupancy.invalidate_all()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, args=(last_id,), name='seat-changes', daemon=True
+            )
+            self._thread.start()
+
+    def subscribe(self, event_id):
+        self._ensure_started()
+        subscriber = _Subscriber()
+        with self._lock:
+            self._subscribers.setdefault(event_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, event_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(event_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[event_id]
+
+    def at_capacity(self):
+        """True se il processo ha già max_subscribers stream aperti (limite indicativo)"""
+        return self.subscriber_count() >= self.max_subscribers
+
+    def subscriber_count(self, event_id=None):
+        with self._lock:
+            if event_id is not None:
+                return len(self._subscribers.get(event_id, ()))
+            return sum(len(s) for s in self._subscribers.values())
+
+    def _run(self, last_id):
+        while True:
+            try:
+                changes = get_seat_changes_since(last_id, POLL_BATCH)
+            except Exception as e:
+                logger.error(f"Errore lettura variazioni posti: {e}")
+                time.sleep(self.poll_interval)
+                continue
+            if changes:
+                last_id = changes[-1][0]
+                self._dispatch(changes)
+            if len(changes) < POLL_BATCH:
+                time.sleep(self.poll_interval)
+
+    def _dispatch(self, changes):
+        by_event = {}
+        for _, event_id, seat, status in changes:
+            by_event.setdefault(event_id, []).append((seat, status))
+
+        for event_id, seat_changes in by_event.items():
+            # Le scritture di altri worker aggiornano anche la mappa in memoria
+            for seat, status in seat_changes:
+                occupancy.set_seats(event_id, (seat,), status)
+
+            with self._lock:
+                subscribers = list(self._subscribers.get(event_id, ()))
+            for subscriber in subscribers:
+                try:
+                    subscriber.queue.put_nowait(seat_changes)
+                except queue.Full:
+                    subscriber.resync = True
+
+
+broadcaster = SeatChangeBroadcaster()
+
+
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def _snapshot_event(event_id, retry_ms=None):
+    snapshot = occupancy.snapshot(event_id)
+    message = _sse('snapshot', {'version': snapshot.version, 'taken': list(snapshot)})
+    return f'retry: {retry_ms}\n{message}' if retry_ms else message
+
+
+def stream_seat_updates(event_id, max_seconds=SEAT_STREAM_MAX_SECONDS):
+    """
+    Generatore SSE: stato completo iniziale, poi solo le variazioni dell'evento.
+    Termina dopo max_seconds: il browser si riconnette da solo dopo il retry indicato.
+    """
+    subscriber = broadcaster.subscribe(event_id)
+    deadline = time.monotonic() + max_seconds
+    try:
+        # Jitter sul retry: le riconnessioni dopo la chiusura non arrivano tutte insieme
+        yield _snapshot_event(event_id, random.randint(RECONNECT_MIN_MS, RECONNECT_MAX_MS))
+        # Lo stream resta aperto a lungo: la connessione del thread non va trattenuta
+        close_db()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                changes = subscriber.queue.get(timeout=min(HEARTBEAT_INTERVAL, remaining))
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            if subscriber.resync:
+                # Client troppo lento: si scarta la coda e si reinvia lo stato completo
+                subscriber.resync = False
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                yield _snapshot_event(event_id)
+                close_db()
+                continue
+            yield _sse('seats', {'changes': changes})
+    finally:
+        broadcaster.unsubscribe(event_id, subscriber)
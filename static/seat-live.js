@@ -0,0 +1,109 @@
+// Aggiornamento live della piantina posti (Server-Sent Events)
+(function () {
+    const seatmap = document.querySelector('.seatmap[data-stream-url]');
+    if (!seatmap || !window.EventSource) {
+        return;
+    }
+
+    function refreshSelection() {
+        if (typeof updateSelectedSeats === 'function') {
+            updateSelectedSeats();
+        }
+    }
+
+    function notify(message) {
+        const box = document.createElement('div');
+        box.className = 'flash-message flash-warning';
+        box.innerHTML = '<strong>⚡</strong> ';
+        box.appendChild(document.createTextNode(message));
+        const container = document.querySelector('.main-content') || document.body;
+        container.insertBefore(box, container.firstChild);
+    }
+
+    function findSeat(seat) {
+        return seatmap.querySelector(`[data-seat="${CSS.escape(seat)}"]`);
+    }
+
+    function markTaken(seat) {
+        const el = findSeat(seat);
+        if (!el || el.classList.contains('booked')) {
+            return false;
+        }
+        const input = el.querySelector('input');
+        const wasChecked = input && input.checked;
+        const span = document.createElement('span');
+        span.className = 'seat booked';
+        span.title = seat;
+        span.dataset.seat = seat;
+        el.replaceWith(span);
+        if (wasChecked) {
+            notify(`Il posto ${seat} è appena stato prenotato da un altro utente.`);
+        }
+        return true;
+    }
+
+    function markFree(seat) {
+        const el = findSeat(seat);
+        if (!el || !el.classList.contains('booked')) {
+            return false;
+        }
+        const label = document.createElement('label');
+        label.className = 'seat';
+        label.title = seat;
+        label.dataset.seat = seat;
+        const input = document.createElement('input');
+        input.type = 'checkbox';
+        input.name = 'seats';
+        input.value = seat;
+        input.addEventListener('change', refreshSelection);
+        label.appendChild(input);
+        el.replaceWith(label);
+        return true;
+    }
+
+    // Stato completo: inviato alla connessione e dopo ogni risincronizzazione
+    function onSnapshot(e) {
+        const taken = new Set(JSON.parse(e.data).taken);
+        let changed = false;
+        seatmap.querySelectorAll('[data-seat]').forEach(el => {
+            const seat = el.dataset.seat;
+            changed = (taken.has(seat) ? markTaken(seat) : markFree(seat)) || changed;
+        });
+        if (changed) {
+            refreshSelection();
+        }
+    }
+
+    // Variazioni: coppie [posto, status] con status 0 = posto liberato
+    function onSeats(e) {
+        let changed = false;
+        JSON.parse(e.data).changes.forEach(([seat, status]) => {
+            changed = (status ? markTaken(seat) : markFree(seat)) || changed;
+        });
+        if (changed) {
+            refreshSelection();
+        }
+    }
+
+    // Lo stream chiuso dal server (durata massima) si riconnette da solo; una
+    // risposta di errore (503: troppi stream aperti) chiude l'EventSource e si
+    // riprova con attesa crescente
+    let retryDelay = 5000;
+
+    function connect() {
+        const source = new EventSource(seatmap.dataset.streamUrl);
+        source.addEventListener('snapshot', function (e) {
+            retryDelay = 5000;
+            onSnapshot(e);
+        });
+        source.addEventListener('seats', onSeats);
+        source.addEventListener('error', function () {
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(connect, retryDelay + Math.random() * 2000);
+                retryDelay = Math.min(retryDelay * 2, 60000);
+            }
+        });
+    }
+
+    connect();
+})();
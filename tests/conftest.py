@@ -0,0 +1,32 @@
+"""
+Configurazione dei test: database, metriche e limitatore in una cartella
+temporanea, impostati prima che config venga importato.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix='tsr-tests-')
+os.environ.update(
+    DB_PATH=os.path.join(DATA_DIR, 'cinema.db'),
+    METRICS_DIR=os.path.join(DATA_DIR, 'metrics'),
+    RATE_LIMIT_DB_PATH=os.path.join(DATA_DIR, 'rate_limits.db'),
+)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def db():
+    import database
+    database.init_db()
+    return database
+
+
+@pytest.fixture
+def event_id(db):
+    """Nuovo evento per ogni test: tutti i posti liberi"""
+    db.create_event('Evento di prova', '2030-01-01', '21:00', 10.0)
+    return db.get_read_db().execute('SELECT MAX(id) FROM events').fetchone()[0]
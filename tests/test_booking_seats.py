@@ -0,0 +1,14 @@
+"""Unicità dei posti prenotati (booking_seats, indice unico evento/posto)"""
+
+
+def test_seat_booked_once(db, event_id):
+    assert db.create_booking(event_id, 'Anna', 'anna@example.com', 'A1,A2', 1) is not None
+    assert db.create_booking(event_id, 'Bruno', 'bruno@example.com', 'A2,A3', 1) is None
+    # La prenotazione rifiutata non lascia posti occupati
+    assert db.create_booking(event_id, 'Bruno', 'bruno@example.com', 'A3', 1) is not None
+
+
+def test_released_seat_can_be_booked_again(db, event_id):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'A4', 1)
+    assert db.update_booking_status(booking_id, 0)
+    assert db.create_booking(event_id, 'Bruno', 'bruno@example.com', 'A4', 1) is not None
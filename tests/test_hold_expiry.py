@@ -0,0 +1,43 @@
+"""Scadenza delle prenotazioni in attesa"""
+import sqlite3
+import time
+
+from occupancy import engine, SEAT_IDS
+
+
+def test_expired_hold_frees_seats(db, event_id):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'B1,B2', 1)
+    paid_id = db.create_booking(event_id, 'Carla', 'carla@example.com', 'B3', 2)
+    engine.snapshot(event_id)
+
+    assert db.release_expired_holds(now=time.time() + 24 * 3600) >= 1
+    assert db.get_booking_by_id(booking_id)['status'] == 0
+    assert db.get_booking_by_id(paid_id)['status'] == 2
+    states = engine.snapshot(event_id).states
+    assert states[SEAT_IDS['B1']] == 0 and states[SEAT_IDS['B2']] == 0
+    assert states[SEAT_IDS['B3']] != 0
+    assert db.create_booking(event_id, 'Bruno', 'bruno@example.com', 'B1', 1) is not None
+
+
+def test_next_expiry_is_earliest_pending(db, event_id):
+    db.release_expired_holds(now=time.time() + 24 * 3600)
+    assert db.get_next_hold_expiry() is None
+    db.create_booking(event_id, 'Anna', 'anna@example.com', 'B4', 1)
+    db.create_booking(event_id, 'Carla', 'carla@example.com', 'B5', 2)
+    assert db.get_next_hold_expiry() <= time.time() + db.BOOKING_HOLD_SECONDS + 1
+
+
+def test_migration_skips_unparseable_created_at(db):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE bookings (id INTEGER PRIMARY KEY, status REAL, created_at TEXT NOT NULL)')
+    conn.executemany('INSERT INTO bookings (id, status, created_at) VALUES (?, ?, ?)', [
+        (1, 1, '2026-10-01 10:00:00'),
+        (2, 1, '01/10/2026 10:00'),
+    ])
+    before = int(time.time())
+    db._migration_hold_expiry(conn)
+    expiries = dict(conn.execute('SELECT id, expires_at FROM bookings').fetchall())
+    assert expiries[1] < before
+    # Data non riconosciuta: scade subito invece di interrompere la migrazione
+    assert before <= expiries[2] <= int(time.time())
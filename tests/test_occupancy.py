@@ -0,0 +1,48 @@
+"""Mappa di occupazione in memoria allineata alle scritture"""
+import time
+
+from occupancy import engine, SEAT_IDS
+
+
+def test_map_follows_bookings(db, event_id):
+    snapshot = engine.snapshot(event_id)
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'F1,F2', 1)
+    updated = engine.snapshot(event_id)
+    assert updated.version > snapshot.version
+    assert updated.states[SEAT_IDS['F1']] == 1 and updated.states[SEAT_IDS['F2']] == 1
+
+    db.update_booking_status(booking_id, 2)
+    assert engine.snapshot(event_id).states[SEAT_IDS['F1']] == 2
+    db.update_booking_status(booking_id, 0)
+    assert engine.snapshot(event_id).states[SEAT_IDS['F1']] == 0
+
+
+def test_load_racing_a_write_is_retried(db, event_id, monkeypatch):
+    engine.invalidate(event_id)
+    load = engine._load
+    loads = []
+
+    def racing_load(load_event_id):
+        event_map = load(load_event_id)
+        loads.append(load_event_id)
+        if len(loads) == 1:
+            # Scrittura di un altro thread dopo la lettura dal database
+            db.create_booking(load_event_id, 'Anna', 'anna@example.com', 'F3', 1)
+        return event_map
+
+    monkeypatch.setattr(engine, '_load', racing_load)
+    snapshot = engine.snapshot(event_id)
+    assert len(loads) == 2
+    assert snapshot.states[SEAT_IDS['F3']] == 1
+
+
+def test_expiry_frees_reserved_rows(db, event_id):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'F4,F5', 1)
+    # Testo dei posti non allineato alle righe di booking_seats
+    with db.write_transaction() as conn:
+        conn.execute("UPDATE bookings SET seats = 'Z99' WHERE id = ?", (booking_id,))
+    engine.snapshot(event_id)
+
+    db.release_expired_holds(now=time.time() + 24 * 3600)
+    states = engine.snapshot(event_id).states
+    assert states[SEAT_IDS['F4']] == 0 and states[SEAT_IDS['F5']] == 0
@@ -0,0 +1,84 @@
+"""Conferma dei pagamenti da webhook: idempotenza e pagamenti dopo la scadenza"""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import payments
+
+
+@pytest.fixture
+def refunds(monkeypatch):
+    """Rimborsi richiesti a Stripe (nessuna chiamata reale)"""
+    calls = []
+    monkeypatch.setattr(payments, 'get_stripe', lambda: SimpleNamespace(Refund=SimpleNamespace(create=None)))
+    monkeypatch.setattr(payments, 'stripe_call', lambda func, **kwargs: calls.append(kwargs))
+    return calls
+
+
+def _paid_event(event_id, booking_id, payment_intent='pi_test'):
+    return {
+        'id': event_id,
+        'type': 'checkout.session.completed',
+        'data': {'object': {
+            'metadata': {'booking_id': str(booking_id)},
+            'payment_status': 'paid',
+            'payment_intent': payment_intent,
+        }},
+    }
+
+
+def test_confirm_payment_idempotent(db, event_id):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'C1', 1)
+
+    assert payments.confirm_payment(booking_id)
+    assert db.get_booking_by_id(booking_id)['status'] == 2
+    # Webhook ripetuto: la prenotazione resta pagata e i posti non cambiano
+    payments.confirm_payment(booking_id)
+    assert db.get_booking_by_id(booking_id)['status'] == 2
+    assert db.create_booking(event_id, 'Bruno', 'bruno@example.com', 'C1', 1) is None
+
+
+def test_webhook_event_processed_once(db, event_id):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'C2', 1)
+    event = _paid_event(f'evt_{booking_id}', booking_id)
+
+    assert payments.handle_event(event)
+    assert not payments.handle_event(event)
+    assert db.get_booking_by_id(booking_id)['status'] == 2
+
+
+def test_checkout_extends_hold(db, event_id):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'C3', 1)
+    session_end = time.time() + 1800
+
+    assert db.extend_booking_hold(booking_id, session_end)
+    db.release_expired_holds(now=session_end - 1)
+    assert db.get_booking_by_id(booking_id)['status'] == 1
+    db.release_expired_holds(now=session_end + 1)
+    assert not db.extend_booking_hold(booking_id, session_end + 3600)
+
+
+def test_confirm_after_expiry_never_double_sells(db, event_id, refunds):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'D1', 1)
+    db.release_expired_holds(now=time.time() + 24 * 3600)
+    other_id = db.create_booking(event_id, 'Bruno', 'bruno@example.com', 'D1', 2)
+    assert other_id is not None
+
+    assert not payments.confirm_payment(booking_id, 'pi_late')
+    assert db.get_booking_by_id(booking_id)['status'] == 0
+    assert db.get_booking_by_id(other_id)['status'] == 2
+    assert [call['payment_intent'] for call in refunds] == ['pi_late']
+    # Checkout scaduto dopo il pagamento: la prenotazione pagata non viene liberata
+    payments.release_unpaid(other_id)
+    assert db.get_booking_by_id(other_id)['status'] == 2
+
+
+def test_confirm_after_expiry_restores_free_seats(db, event_id, refunds):
+    booking_id = db.create_booking(event_id, 'Anna', 'anna@example.com', 'E1', 1)
+    db.release_expired_holds(now=time.time() + 24 * 3600)
+
+    assert payments.confirm_payment(booking_id, 'pi_test')
+    assert db.get_booking_by_id(booking_id)['status'] == 2
+    assert db.create_booking(event_id, 'Bruno', 'bruno@example.com', 'E1', 1) is None
+    assert refunds == []
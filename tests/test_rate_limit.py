@@ -0,0 +1,70 @@
+"""Token bucket del limitatore con entrambi i backend e identificazione del client"""
+import sqlite3
+
+import pytest
+from flask import Flask
+from werkzeug.exceptions import TooManyRequests
+
+from rate_limit import LIMITS, IP_LIMIT_FACTOR, MemoryBackend, RateLimiter, SQLiteBackend, _client_id
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limiter(request, tmp_path):
+    if request.param == 'memory':
+        backend = MemoryBackend()
+    else:
+        backend = SQLiteBackend(str(tmp_path / 'rate_limits.db'))
+    return RateLimiter(backend, enabled=True)
+
+
+def test_burst_then_429(limiter):
+    now = 1000.0
+    for _ in range(LIMITS['booking'].burst):
+        limiter.check('booking', '10.0.0.1', 'c1', now=now)
+    with pytest.raises(TooManyRequests) as exc:
+        limiter.check('booking', '10.0.0.1', 'c1', now=now)
+    assert exc.value.retry_after >= 1
+    # Altri client e altre route hanno bucket propri
+    limiter.check('booking', '10.0.0.1', 'c2', now=now)
+    limiter.check('checkout', '10.0.0.1', 'c1', now=now)
+
+
+def test_bucket_refills(limiter):
+    limit = LIMITS['login']
+    for _ in range(limit.burst):
+        limiter.check('login', '10.0.0.2', 'c1', now=0.0)
+    with pytest.raises(TooManyRequests):
+        limiter.check('login', '10.0.0.2', 'c1', now=0.0)
+    limiter.check('login', '10.0.0.2', 'c1', now=60 / limit.per_minute)
+
+
+def test_ip_bucket_limits_cookie_rotation(limiter):
+    limit = LIMITS['checkout']
+    ip_burst = limit.burst * IP_LIMIT_FACTOR
+    # Un client nuovo per richiesta (cookie scartati): vale il bucket dell'IP
+    for i in range(ip_burst):
+        limiter.check('checkout', '10.0.0.3', f'c{i}', now=0.0)
+    with pytest.raises(TooManyRequests):
+        limiter.check('checkout', '10.0.0.3', 'nuovo', now=0.0)
+
+
+class _BrokenBackend:
+    def take(self, key, limit, now):
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_backend_error_lets_request_through():
+    # Un limitatore guasto non blocca le vendite
+    RateLimiter(_BrokenBackend(), enabled=True).check('booking', '10.0.0.4', 'c1')
+
+
+def test_client_id_from_admission_or_session():
+    from waiting_room import room as waiting_room
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    cookie = f'{waiting_room.admission_cookie(7)}={waiting_room.admission_token(7, 42)}'
+    with app.test_request_context(headers={'Cookie': cookie}):
+        assert _client_id(7) == 'ticket-42'
+        # Ammissione di un altro evento: id casuale in sessione, stabile
+        client = _client_id(8)
+        assert client != 'ticket-42' and _client_id(8) == client
@@ -0,0 +1,29 @@
+"""Sala d'attesa: numeri di coda riservati a blocchi"""
+import database
+from waiting_room import WaitingRoom, MAX_BLOCK
+
+
+def test_tickets_unique_with_few_writes(db, event_id, monkeypatch):
+    room = WaitingRoom(secret_key='test', enabled=True)
+    writes = []
+    take = database.take_waiting_room_ticket
+
+    def counted(*args, **kwargs):
+        writes.append(kwargs.get('count', 1))
+        return take(*args, **kwargs)
+
+    monkeypatch.setattr(database, 'take_waiting_room_ticket', counted)
+    tickets = [room.enter(event_id).ticket for _ in range(500)]
+
+    assert sorted(tickets) == list(range(1, 501))
+    # Blocchi che raddoppiano fino a MAX_BLOCK: poche scritture per molti arrivi
+    assert len(writes) <= 6 + 500 // MAX_BLOCK
+    assert max(writes) == MAX_BLOCK
+
+
+def test_first_arrivals_admitted_then_queued(db, event_id):
+    room = WaitingRoom(secret_key='test', enabled=True)
+    statuses = [room.enter(event_id, now=1000.0) for _ in range(100)]
+    admitted = [status for status in statuses if status.position == 0]
+    assert 0 < len(admitted) < 100
+    assert all(status.wait_seconds > 0 for status in statuses if status.position)
@@ -0,0 +1,177 @@
+"""
+Esportazione di tutti i biglietti di un evento in un unico ZIP.
+
+I PDF vengono generati in parallelo da un pool di processi e scritti nello ZIP
+man mano che sono pronti; lo ZIP viene inviato in streaming, quindi in memoria
+restano solo i biglietti in lavorazione.
+
+Le esportazioni in corso e il loro avanzamento sono nel database (tabella
+ticket_exports): al più EXPORT_CONCURRENCY esportazioni alla volta su tutti i
+worker gunicorn, quindi al più EXPORT_CONCURRENCY * EXPORT_WORKERS processi di
+rendering sull'host.
+"""
+import io
+import logging
+import multiprocessing
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from werkzeug.utils import secure_filename
+from config import EXPORT_WORKERS, EXPORT_WORKER_MEMORY_MB, EXPORT_CONCURRENCY
+from database import (
+    iter_event_bookings, count_event_bookings, start_ticket_export, update_ticket_export, get_ticket_export
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Prenotazioni con biglietto: pagate online (2) o in cassa (3)
+EXPORT_STATUSES = (2, 3)
+# Biglietti renderizzati da un processo prima di essere sostituito
+TASKS_PER_CHILD = 100
+# Biglietti in lavorazione per processo: limita la memoria del processo web
+IN_FLIGHT_PER_WORKER = 2
+# Un'esportazione senza avanzamento da più di questo tempo è considerata interrotta
+# (processo terminato) e non occupa più il suo posto
+STALE_SECONDS = 300
+# Intervallo minimo tra due scritture dell'avanzamento
+PROGRESS_INTERVAL = 1.0
+
+
+def _init_worker(limit_mb):
+    """Inizializzatore dei processi: metriche su file e limite di memoria"""
+    metrics.registry.start()
+    _limit_worker_memory(limit_mb)
+
+
+def _limit_worker_memory(limit_mb):
+    """Limita lo spazio di indirizzamento del processo (solo Unix)"""
+    if not limit_mb:
+        return
+    try:
+        import resource
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def _render_ticket(booking, event):
+    """Eseguita nei processi del pool: ritorna (id prenotazione, PDF)"""
+    from pdf_generator import generate_email_ticket_pdf
+    return booking['id'], generate_email_ticket_pdf(booking, event)
+
+
+def ticket_filename(booking):
+    name = secure_filename(booking['name']) or 'cliente'
+    return f"biglietto_{booking['id']:05d}_{name}.pdf"
+
+
+class _ZipStream(io.RawIOBase):
+    """Destinazione non ricercabile per zipfile: accumula i byte da inviare"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def get_export_progress(event_id):
+    """Avanzamento dell'ultima esportazione dell'evento, da qualsiasi worker"""
+    export = get_ticket_export(event_id)
+    if export is None:
+        return None
+    progress = {key: export[key] for key in ('total', 'done', 'failed', 'started_at')}
+    progress['finished'] = bool(export['finished'])
+    progress['interrupted'] = not export['finished'] and export['updated_at'] < time.time() - STALE_SECONDS
+    return progress
+
+
+def start_event_tickets_zip(event):
+    """
+    Riserva un posto tra le esportazioni contemporanee e ritorna il generatore
+    dello ZIP, oppure None se i posti sono occupati o l'evento è già in esportazione
+    """
+    total = count_event_bookings(event['id'], EXPORT_STATUSES)
+    if not start_ticket_export(event['id'], total, EXPORT_CONCURRENCY, time.time() - STALE_SECONDS):
+        return None
+    return _stream_event_tickets_zip(event)
+
+
+def _stream_event_tickets_zip(event):
+    """Generatore dei byte dello ZIP con i biglietti pagati/cassa dell'evento"""
+    event_id = event['id']
+    event_data = dict(event)
+    bookings = iter_event_bookings(event_id, statuses=EXPORT_STATUSES)
+    filenames = {}
+    failed = []
+    done = 0
+    started = time.perf_counter()
+    reported_at = started
+
+    out = _ZipStream()
+    archive = zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED)
+    executor = ProcessPoolExecutor(
+        max_workers=EXPORT_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(EXPORT_WORKER_MEMORY_MB,),
+        max_tasks_per_child=TASKS_PER_CHILD,
+    )
+    try:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            # Finestra limitata di biglietti in lavorazione
+            while not exhausted and len(pending) < EXPORT_WORKERS * IN_FLIGHT_PER_WORKER:
+                booking = next(bookings, None)
+                if booking is None:
+                    exhausted = True
+                    break
+                filenames[booking['id']] = ticket_filename(booking)
+                pending[executor.submit(_render_ticket, booking, event_data)] = booking['id']
+            if not pending:
+                break
+
+            completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                booking_id = pending.pop(future)
+                try:
+                    _, pdf_data = future.result()
+                except Exception as e:
+                    logger.error(f"Errore rendering biglietto {booking_id}: {e}")
+                    failed.append(booking_id)
+                else:
+                    archive.writestr(filenames.pop(booking_id), pdf_data)
+                    done += 1
+            if time.perf_counter() - reported_at >= PROGRESS_INTERVAL:
+                # Scritture diradate: l'avanzamento non contende il lock con le prenotazioni
+                update_ticket_export(event_id, done, len(failed))
+                reported_at = time.perf_counter()
+            yield out.drain()
+
+        if failed:
+            archive.writestr(
+                'ERRORI.txt',
+                'Biglietti non generati (ID prenotazione):\n' + '\n'.join(str(i) for i in sorted(failed)) + '\n'
+            )
+        archive.close()
+        yield out.drain()
+        logger.info(
+            f"Esportati {done} biglietti evento {event_id} in {time.perf_counter() - started:.1f}s"
+            f" ({len(failed)} errori)"
+        )
+    finally:
+        update_ticket_export(event_id, done, len(failed), finished=True)
+        bookings.close()
+        executor.shutdown(wait=False, cancel_futures=True)
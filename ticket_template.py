@@ -0,0 +1,251 @@
+"""
+Rendering veloce del biglietto PDF direttamente su canvas ReportLab.
+
+Il biglietto è una pagina a layout fisso: tutto ciò che dipende solo
+dall'evento (sfondi, titolo già spezzato su più righe, etichette, logo,
+locandina, data e ora) viene calcolato una volta per evento in un
+TicketTemplate; per ogni prenotazione si disegnano solo i campi variabili a
+coordinate fisse, senza stili e senza impaginazione platypus.
+
+Logo e locandina vengono decodificati una volta per evento (ImageReader nel
+modello) e disegnati con Canvas.drawImage.
+"""
+import io
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader, simpleSplit
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+import pdf_assets
+from database import format_event_date
+
+logger = logging.getLogger(__name__)
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+
+BLUE = colors.HexColor('#2B4C8C')
+DARK_RED = colors.HexColor('#8B0000')
+LIGHT_GREY = colors.HexColor('#F8F9FA')
+GREY = colors.HexColor('#F0F0F0')
+LINE_GREY = colors.HexColor('#E0E0E0')
+FOOTER_GREY = colors.HexColor('#718096')
+
+BOLD = 'Helvetica-Bold'
+# Tabella dettagli: colonne da 2.5 e 3.5 pollici centrate
+TABLE_LEFT = (PAGE_WIDTH - 6 * inch) / 2
+LABEL_WIDTH = 2.5 * inch
+VALUE_WIDTH = 3.5 * inch
+ROW_HEIGHT = 24
+CELL_PADDING = 6
+VALUE_FONT_SIZE = 14
+MIN_VALUE_FONT_SIZE = 8
+
+# Righe della tabella: (etichetta, campo); i campi dell'evento sono statici
+TABLE_ROWS = (
+    ('Intestatario', 'name'),
+    ('Contatto', 'email'),
+    ('Data Spettacolo', 'event_date'),
+    ('Orario', 'event_time'),
+    ('Posti Riservati', 'seats'),
+    ('Totale Pagato', 'total'),
+    ('Codice Biglietto', 'code'),
+)
+STATIC_FIELDS = ('event_date', 'event_time')
+
+# Modelli tenuti in memoria (uno per evento)
+MAX_TEMPLATES = 32
+
+
+def _fit_font_size(text, font, size, max_width, min_size=MIN_VALUE_FONT_SIZE):
+    """Riduce la dimensione del font finché il testo entra in max_width"""
+    while size > min_size and stringWidth(text, font, size) > max_width:
+        size -= 1
+    return size
+
+
+def _image_reader(data):
+    """ImageReader con pixel e trasparenza già estratti: condiviso tra i thread"""
+    reader = ImageReader(io.BytesIO(data))
+    reader.getRGBData()
+    return reader
+
+
+class TicketTemplate:
+    """Parte statica del biglietto di un evento, con le posizioni dei campi variabili"""
+
+    def __init__(self, event, logo_data, poster_data, poster_error=False):
+        self.event_key = _event_key(event)
+        self.logo_data = logo_data
+        self.poster_data = poster_data
+        self.price = event['price']
+        # Operazioni di disegno precalcolate: (metodo, argomenti)
+        self._ops = []
+        self._images = []
+        # Campo variabile -> (x, y baseline, larghezza massima)
+        self.slots = {}
+        self._build(event, poster_error)
+
+    def _fill_rect(self, color, x, top, width, height, stroke_color=None):
+        self._ops.append(('setFillColor', (color,)))
+        if stroke_color is not None:
+            self._ops.append(('setStrokeColor', (stroke_color,)))
+            self._ops.append(('setLineWidth', (1,)))
+        self._ops.append(('rect', (x, PAGE_HEIGHT - top - height, width, height, int(stroke_color is not None), 1)))
+
+    def _text(self, text, font, size, color, x, baseline, centered=False):
+        self._ops.append(('setFont', (font, size)))
+        self._ops.append(('setFillColor', (color,)))
+        if centered:
+            self._ops.append(('drawCentredString', (x, PAGE_HEIGHT - baseline, text)))
+        else:
+            self._ops.append(('drawString', (x, PAGE_HEIGHT - baseline, text)))
+
+    def _image(self, data, x, top, width, height):
+        self._images.append((_image_reader(data), (x, PAGE_HEIGHT - top - height, width, height)))
+
+    def _build(self, event, poster_error):
+        center = PAGE_WIDTH / 2
+        y = 0.4 * inch
+
+        # Logo
+        logo_size = 1.2 * inch
+        if self.logo_data:
+            self._image(self.logo_data, center - logo_size / 2, y, logo_size, logo_size)
+        y += logo_size + 8
+
+        # Intestazione
+        self._fill_rect(LIGHT_GREY, 0.4 * inch, y, PAGE_WIDTH - 0.8 * inch, 42)
+        self._text("BIGLIETTO D'INGRESSO", BOLD, 28, BLUE, center, y + 31, centered=True)
+        y += 48
+
+        # Titolo evento, su più righe se lungo
+        lines = simpleSplit(event['title'], BOLD, 24, PAGE_WIDTH - 1.2 * inch)
+        band_height = 18 + 28 * len(lines)
+        self._fill_rect(GREY, 0.4 * inch, y, PAGE_WIDTH - 0.8 * inch, band_height)
+        for i, line in enumerate(lines):
+            self._text(line, BOLD, 24, DARK_RED, center, y + 33 + 28 * i, centered=True)
+        y += band_height + 14
+
+        # Locandina o segnaposto
+        if event['poster_url']:
+            width, height = pdf_assets.POSTER_SIZE[0] * inch, pdf_assets.POSTER_SIZE[1] * inch
+            if self.poster_data:
+                self._image(self.poster_data, center - width / 2, y, width, height)
+            else:
+                message = 'ERRORE CARICAMENTO POSTER' if poster_error else 'POSTER NON DISPONIBILE'
+                self._fill_rect(LIGHT_GREY, center - width / 2, y, width, height)
+                self._text(message, BOLD, 10, DARK_RED if poster_error else BLUE, center, y + height / 2, centered=True)
+            y += height + 14
+
+        # Tabella dettagli
+        for i, (label, field) in enumerate(TABLE_ROWS):
+            top = y + i * ROW_HEIGHT
+            baseline = top + ROW_HEIGHT / 2 + 5
+            self._fill_rect(LIGHT_GREY, TABLE_LEFT, top, LABEL_WIDTH, ROW_HEIGHT)
+            self._fill_rect(GREY if i % 2 else colors.white, TABLE_LEFT + LABEL_WIDTH, top, VALUE_WIDTH, ROW_HEIGHT)
+            self._text(label, BOLD, 14, BLUE, TABLE_LEFT + CELL_PADDING, baseline)
+            value_x = TABLE_LEFT + LABEL_WIDTH + CELL_PADDING
+            if field in STATIC_FIELDS:
+                value = format_event_date(event['date']) if field == 'event_date' else event['time']
+                size = _fit_font_size(str(value), BOLD, VALUE_FONT_SIZE, VALUE_WIDTH - 2 * CELL_PADDING)
+                self._text(str(value), BOLD, size, DARK_RED, value_x, baseline)
+            else:
+                self.slots[field] = (value_x, PAGE_HEIGHT - baseline, VALUE_WIDTH - 2 * CELL_PADDING)
+            if i < len(TABLE_ROWS) - 1:
+                self._ops.append(('setStrokeColor', (LINE_GREY,)))
+                self._ops.append(('setLineWidth', (1,)))
+                self._ops.append(('line', (TABLE_LEFT, PAGE_HEIGHT - top - ROW_HEIGHT,
+                                           TABLE_LEFT + LABEL_WIDTH + VALUE_WIDTH, PAGE_HEIGHT - top - ROW_HEIGHT)))
+        y += ROW_HEIGHT * len(TABLE_ROWS) + 14
+
+        # Istruzioni
+        instructions = "Presentare questo biglietto all'ingresso • Arrivare 20 minuti prima"
+        size = _fit_font_size(instructions, BOLD, 14, PAGE_WIDTH - 1.0 * inch)
+        self._fill_rect(LIGHT_GREY, 0.4 * inch, y, PAGE_WIDTH - 0.8 * inch, 48)
+        self._text('ISTRUZIONI IMPORTANTI', BOLD, 14, DARK_RED, center, y + 19, centered=True)
+        self._text(instructions, BOLD, size, DARK_RED, center, y + 38, centered=True)
+        y += 56
+
+        # Footer
+        self._fill_rect(LIGHT_GREY, 0.4 * inch + 4, y, PAGE_WIDTH - 0.8 * inch - 8, 38, stroke_color=BLUE)
+        self._text('TEATRO SAN RAFFAELE', 'Helvetica-Oblique', 11, BLUE, center, y + 15, centered=True)
+        self._text('info@teatrosanraffaele.it', 'Helvetica-Oblique', 11, BLUE, center, y + 29, centered=True)
+        self.generated_at_y = PAGE_HEIGHT - (y + 50)
+
+    def draw(self, c, booking, generated_at):
+        """Disegna il biglietto di una prenotazione sul canvas"""
+        for image, position in self._images:
+            c.drawImage(image, *position, mask='auto')
+        for method, args in self._ops:
+            getattr(c, method)(*args)
+
+        seats_count = len(booking['seats'].split(','))
+        values = {
+            'name': booking['name'],
+            'email': booking['email'],
+            'seats': booking['seats'],
+            'total': f"€ {self.price * seats_count:.2f}",
+            'code': f"#{booking['id']:05d}",
+        }
+        c.setFillColor(DARK_RED)
+        for field, (x, y, max_width) in self.slots.items():
+            text = str(values[field])
+            c.setFont(BOLD, _fit_font_size(text, BOLD, VALUE_FONT_SIZE, max_width))
+            c.drawString(x, y, text)
+
+        c.setFont('Helvetica', 8)
+        c.setFillColor(FOOTER_GREY)
+        c.drawCentredString(PAGE_WIDTH / 2, self.generated_at_y,
+                            f"Biglietto generato il {generated_at.strftime('%d/%m/%Y alle %H:%M')}")
+
+
+def _event_key(event):
+    return (event['id'], event['title'], event['date'], event['time'], event['price'], event['poster_url'])
+
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def get_template(event):
+    """Modello dell'evento, ricostruito se cambiano evento, logo o locandina"""
+    logo_data = pdf_assets.get_logo()
+    poster_data, poster_error = None, False
+    if event['poster_url']:
+        try:
+            poster_data = pdf_assets.get_poster(event['poster_url'])
+        except Exception as e:
+            logger.error(f"Errore caricamento poster {event['poster_url']}: {e}")
+            poster_error = True
+
+    key = _event_key(event)
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is not None and template.logo_data is logo_data and template.poster_data is poster_data:
+            _templates.move_to_end(key)
+            return template
+
+    template = TicketTemplate(event, logo_data, poster_data, poster_error)
+    with _templates_lock:
+        _templates[key] = template
+        _templates.move_to_end(key)
+        while len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+    return template
+
+
+def render_ticket(booking, event):
+    """PDF (bytes) del biglietto di una prenotazione"""
+    template = get_template(event)
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4)
+    c.setTitle(f"Biglietto #{booking['id']:05d}")
+    template.draw(c, booking, datetime.now())
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
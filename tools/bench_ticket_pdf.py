@@ -0,0 +1,58 @@
+"""
+Confronta i tempi di generazione del biglietto PDF: rendering su canvas
+(ticket_template) e impaginazione platypus originale.
+
+Esempi:
+    python tools/bench_ticket_pdf.py
+    python tools/bench_ticket_pdf.py --count 200 --poster static/posters/locandina.jpg
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_generator import generate_email_ticket_pdf_flowables  # noqa: E402
+from ticket_template import render_ticket  # noqa: E402
+
+
+def _event(poster_url):
+    return {
+        'id': 1, 'title': 'Amleto - Principe di Danimarca', 'date': '2026-11-01',
+        'time': '21:00', 'price': 12.5, 'poster_url': poster_url,
+    }
+
+
+def _booking(i):
+    return {'id': i, 'name': 'Mario Rossi', 'email': 'mario.rossi@example.com', 'seats': 'F1,F2'}
+
+
+def measure(render, event, count):
+    """Millisecondi medi per biglietto (il primo, che riempie le cache, è escluso)"""
+    render(_booking(0), event)
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        render(_booking(i), event)
+    return (time.perf_counter() - start) / count * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark generazione biglietti PDF')
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--poster', default=None, help='percorso locale o URL della locandina')
+    args = parser.parse_args()
+
+    cases = [('senza locandina', _event(None))]
+    if args.poster:
+        cases.append(('con locandina', _event(args.poster)))
+
+    for label, event in cases:
+        canvas_ms = measure(render_ticket, event, args.count)
+        flowables_ms = measure(generate_email_ticket_pdf_flowables, event, args.count)
+        print(f"{label}: canvas {canvas_ms:.1f} ms, platypus {flowables_ms:.1f} ms "
+              f"(x{flowables_ms / canvas_ms:.1f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+Micro-benchmark delle funzioni più usate di database.py, booking_service.py
+e pdf_generator.py su database sintetici di varie dimensioni.
+
+Per ogni dimensione (prenotazioni per evento) viene creato un database
+temporaneo in un processo separato; ogni funzione viene eseguita con
+riscaldamento e ripetizioni, poi una volta sotto tracemalloc per misurare
+le allocazioni. I risultati sono salvati in JSON e possono essere confrontati
+con una baseline: sono regressioni i peggioramenti oltre la soglia.
+
+Esempi:
+    python tools/benchmarks.py --output baseline.json
+    python tools/benchmarks.py --sizes 10 1000 --compare baseline.json
+    python tools/benchmarks.py --compare baseline.json --current nuovo.json --threshold 0.2
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = (10, 1000, 100000)
+DEFAULT_REPEAT = 20
+DEFAULT_WARMUP = 3
+# Soglia di regressione: +25% sul tempo mediano o sul picco di memoria
+DEFAULT_THRESHOLD = 0.25
+# Durata minima di un campione per le funzioni molto veloci
+MIN_SAMPLE_SECONDS = 0.005
+# Differenze sotto questa soglia assoluta non sono regressioni (rumore)
+MIN_DELTA_MS = 0.005
+# Posti lasciati liberi per il benchmark di create_booking
+FREE_SEATS = 60
+COLS = 27
+
+
+def _hall_seats():
+    with open(os.path.join(ROOT, 'config.json')) as f:
+        config = json.load(f)
+    unavailable = set(config['unavailable_seats'])
+    return [
+        f'{row}{col}' for row in config['row_letters'] for col in range(1, COLS + 1)
+        if f'{row}{col}' not in unavailable
+    ]
+
+
+def build_database(database, size, seed=1):
+    """
+    Evento con `size` prenotazioni: le prime occupano la sala (in attesa,
+    pagate o in cassa) lasciando FREE_SEATS posti liberi, le altre sono
+    prenotazioni scadute (status 0) come nello storico reale.
+    """
+    rng = random.Random(seed)
+    database.init_db()
+    database.create_event('Benchmark', '2030-01-01', '21:00', 12.5)
+    event_id = database.get_read_db().execute('SELECT MAX(id) FROM events').fetchone()[0]
+
+    seats = _hall_seats()
+    free_seats = seats[-FREE_SEATS:]
+    available = seats[:-FREE_SEATS]
+    now = int(time.time())
+    created_at = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    with database.write_transaction() as conn:
+        for i in range(size):
+            count = rng.randint(1, 4)
+            if len(available) >= count:
+                booking_seats, available = available[:count], available[count:]
+                status = rng.choice((1, 2, 3))
+            else:
+                booking_seats = rng.sample(seats, count)
+                status = 0
+            expires_at = now + 3600 if status == 1 else (now - 86400 if status == 0 else None)
+            booking_id = conn.execute(
+                'INSERT INTO bookings (event_id, name, email, seats, status, created_at, expires_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (event_id, f'Cliente {i}', f'cliente{i}@example.com', ','.join(booking_seats),
+                 status, created_at, expires_at)
+            ).lastrowid
+            if status:
+                conn.executemany(
+                    'INSERT INTO booking_seats (booking_id, event_id, seat, status) VALUES (?, ?, ?, ?)',
+                    [(booking_id, event_id, seat, status) for seat in booking_seats]
+                )
+    return event_id, free_seats
+
+
+def measure(func, repeat, warmup, before=None, after=None):
+    """
+    Tempi per chiamata di func: repeat campioni dopo warmup esecuzioni non
+    misurate. Senza before/after ogni campione ripete func finché dura almeno
+    MIN_SAMPLE_SECONDS, per non misurare solo il rumore del timer.
+    """
+    def run_once(number):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        for _ in range(number):
+            result = func()
+        elapsed = time.perf_counter() - started
+        if after is not None:
+            after(result)
+        return elapsed / number
+
+    for _ in range(warmup):
+        run_once(1)
+    number = 1
+    if before is None and after is None:
+        while run_once(number) * number < MIN_SAMPLE_SECONDS:
+            number *= 2
+    timings = sorted(run_once(number) for _ in range(repeat))
+
+    # Allocazioni in un passaggio separato: tracemalloc rallenta l'esecuzione
+    if before is not None:
+        before()
+    tracemalloc.start()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if after is not None:
+        after(result)
+
+    return {
+        'repeat': repeat,
+        'number': number,
+        'min_ms': round(timings[0] * 1000, 4),
+        'median_ms': round(statistics.median(timings) * 1000, 4),
+        'mean_ms': round(statistics.fmean(timings) * 1000, 4),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 4),
+        'stdev_ms': round(statistics.pstdev(timings) * 1000, 4),
+        'alloc_peak_kb': round(peak / 1024, 1),
+        'alloc_retained_kb': round(current / 1024, 1),
+    }
+
+
+def run_size(size, repeat, warmup):
+    """Esegue tutti i benchmark su un database di `size` prenotazioni (nel processo corrente)"""
+    sys.path.insert(0, ROOT)
+    with contextlib.redirect_stdout(sys.stderr):
+        import database
+        import booking_service
+        import pdf_generator
+        from occupancy import engine as occupancy
+
+    event_id, free_seats = build_database(database, size)
+    event = database.get_event_by_id(event_id)
+    booking = database.get_read_db().execute(
+        'SELECT * FROM bookings WHERE event_id = ? AND status = 2 LIMIT 1', (event_id,)
+    ).fetchone()
+    taken = booking['seats'].split(',')
+    free_iter = iter(free_seats * (repeat + warmup + 2))
+
+    def new_booking():
+        seat = next(free_iter)
+        return database.create_booking(event_id, 'Benchmark', 'bench@example.com', seat, status=1)
+
+    def release(booking_id):
+        # Posto di nuovo libero per la ripetizione successiva (fuori misura)
+        database.update_booking_status(booking_id, 0)
+
+    # Benchmark: (nome, funzione, opzioni)
+    benchmarks = [
+        ('get_booked_seats', lambda: booking_service.get_booked_seats(event_id), {}),
+        ('get_booked_seats_cold', lambda: booking_service.get_booked_seats(event_id),
+         {'before': lambda: occupancy.invalidate(event_id)}),
+        ('check_seats_available_free', lambda: booking_service.check_seats_available(event_id, free_seats[:4]), {}),
+        ('check_seats_available_taken', lambda: booking_service.check_seats_available(event_id, taken), {}),
+        ('get_event_stats', lambda: database.get_event_stats(event_id), {}),
+        ('create_booking', new_booking, {'after': release}),
+        ('generate_email_ticket_pdf', lambda: pdf_generator.generate_email_ticket_pdf(booking, event), {}),
+        ('generate_tickets_summary_pdf', lambda: pdf_generator.generate_tickets_summary_pdf(
+            database.iter_event_bookings(event_id, database.ACTIVE_STATUSES), event
+        ), {'repeat': max(3, repeat // 4)}),
+    ]
+
+    results = {}
+    for name, func, options in benchmarks:
+        results[name] = measure(
+            func, options.get('repeat', repeat), warmup,
+            before=options.get('before'), after=options.get('after')
+        )
+        print(f"  {size:>7} {name:<30} {results[name]['median_ms']:>10.3f} ms", file=sys.stderr)
+    database.close_db()
+    return results
+
+
+def run_all(sizes, repeat, warmup):
+    """Ogni dimensione in un processo separato, su un database temporaneo"""
+    results = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix='tsr-bench-') as workdir:
+            result_path = os.path.join(workdir, 'result.json')
+            env = dict(
+                os.environ, DB_PATH=os.path.join(workdir, 'bench.db'), METRICS_DIR=os.path.join(workdir, 'metrics')
+            )
+            subprocess.run([
+                sys.executable, os.path.abspath(__file__), '--run-size', str(size),
+                '--repeat', str(repeat), '--warmup', str(warmup), '--result-file', result_path,
+            ], cwd=ROOT, env=env, check=True)
+            with open(result_path) as f:
+                results[str(size)] = json.load(f)
+    return results
+
+
+def _metadata(repeat, warmup):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'warmup': warmup,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Righe di confronto e numero di regressioni (tempo mediano e picco di memoria)"""
+    lines = []
+    regressions = 0
+    for size, benchmarks in current['results'].items():
+        for name, result in benchmarks.items():
+            base = baseline['results'].get(size, {}).get(name)
+            if base is None:
+                lines.append(f'{size:>7} {name:<30} nuovo')
+                continue
+            flags = []
+            for metric in ('median_ms', 'alloc_peak_kb'):
+                if base[metric] > 0 and result[metric] > base[metric] * (1 + threshold):
+                    if metric != 'median_ms' or result[metric] - base[metric] > MIN_DELTA_MS:
+                        flags.append(metric)
+            time_change = (result['median_ms'] / base['median_ms'] - 1) * 100 if base['median_ms'] else 0.0
+            peak_change = (result['alloc_peak_kb'] / base['alloc_peak_kb'] - 1) * 100 if base['alloc_peak_kb'] else 0.0
+            status = 'REGRESSIONE ' + ','.join(flags) if flags else 'ok'
+            regressions += bool(flags)
+            lines.append(
+                f"{size:>7} {name:<30} {base['median_ms']:>10.3f} -> {result['median_ms']:>10.3f} ms "
+                f"({time_change:+6.1f}%)  mem {peak_change:+6.1f}%  {status}"
+            )
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark database, prenotazioni e PDF')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='prenotazioni per evento dei database sintetici')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP)
+    parser.add_argument('--output', default=None, help='salva i risultati (es. nuova baseline)')
+    parser.add_argument('--compare', default=None, metavar='BASELINE', help='baseline JSON da confrontare')
+    parser.add_argument('--current', default=None, help='risultati JSON già misurati invece di una nuova esecuzione')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--run-size', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size is not None:
+        # Processo figlio: una sola dimensione
+        with open(args.result_file, 'w') as f:
+            json.dump(run_size(args.run_size, args.repeat, args.warmup), f)
+        return
+
+    if args.current:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        current = {'meta': _metadata(args.repeat, args.warmup), 'results': run_all(args.sizes, args.repeat, args.warmup)}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+            f.write('\n')
+    elif not args.compare:
+        print(json.dumps(current, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, current, args.threshold)
+        print(f"Baseline {baseline['meta'].get('commit')} -> {current['meta'].get('commit')} "
+              f"(soglia +{args.threshold:.0%})")
+        print('\n'.join(lines))
+        if regressions:
+            print(f'{regressions} regressioni')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,523 @@
+"""
+Prova di carico del flusso di acquisto: select_seats (con eventuale attesa
+in coda) -> createcheckoutsession -> pagamento (webhook) -> payment_success.
+
+Avvia l'applicazione (server Flask o gunicorn) su un database temporaneo,
+con un server Stripe finto e un server SMTP finto su localhost, e simula
+centinaia di acquirenti concorrenti che si contendono gli stessi posti.
+Alla fine controlla il database: posti venduti due volte, prenotazioni in
+attesa rimaste oltre la scadenza, pagamenti non confermati, email inviate.
+
+Il risultato è un JSON (throughput e latenze p50/p95/p99 per route) da
+confrontare tra commit diversi. Esce con codice 1 se un invariante è violato.
+
+Esempi:
+    python tools/loadtest.py --buyers 300 --concurrency 100
+    python tools/loadtest.py --gunicorn --workers 4 --output risultati.json
+    python tools/loadtest.py --no-waiting-room --output senza_coda.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import socket
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import requests
+
+from stripe_webhook_sender import build_event, sign
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_SECRET = 'whsec_loadtest'
+COLS = 27
+ACTIVE_STATUSES = (1, 2, 3)
+# Margine oltre la scadenza delle prenotazioni prima di considerarle orfane
+EXPIRY_GRACE = 7
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _local_path(location):
+    url = urlparse(location)
+    return f'{url.path}?{url.query}' if url.query else url.path
+
+
+def percentile(values, p):
+    """Percentile nearest-rank di una lista ordinata"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+# ---------- STRIPE FINTO ----------
+
+class FakeStripe(ThreadingHTTPServer):
+    """Risponde a POST /v1/checkout/sessions come l'API Stripe"""
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        super().__init__(('127.0.0.1', _free_port()), _FakeStripeHandler)
+        self.base_url = f'http://127.0.0.1:{self.server_port}'
+        self.latency = latency
+        self.error_rate = error_rate
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+
+class _FakeStripeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode())
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if urlparse(self.path).path != '/v1/checkout/sessions':
+            return self._reply(404, {'error': {'type': 'invalid_request_error', 'message': 'Not found'}})
+        if random.random() < self.server.error_rate:
+            return self._reply(500, {'error': {'type': 'api_error', 'message': 'Errore simulato'}})
+
+        session_id = f'cs_load_{uuid.uuid4().hex[:24]}'
+        booking_id = form.get('client_reference_id', [''])[0]
+        session = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'url': f'{self.server.base_url}/pay/{session_id}',
+            'client_reference_id': booking_id,
+            'metadata': {'booking_id': form.get('metadata[booking_id]', [booking_id])[0]},
+            'mode': 'payment',
+            'payment_status': 'unpaid',
+            'status': 'open',
+        }
+        with self.server.lock:
+            self.server.sessions[session_id] = session
+        self._reply(200, session)
+
+
+# ---------- SMTP FINTO ----------
+
+class FakeSMTP(socketserver.ThreadingTCPServer):
+    """Server SMTP minimo che accetta e conta i messaggi"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', _free_port()), _FakeSMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = 0
+        self.lock = threading.Lock()
+
+
+class _FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def _send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self._send('220 localhost ESMTP loadtest')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('EHLO'):
+                self._send('250-localhost')
+                self._send('250 8BITMIME')
+            elif command.startswith('DATA'):
+                self._send('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+                self._send('250 OK')
+            elif command.startswith('QUIT'):
+                self._send('221 Bye')
+                return
+            else:
+                self._send('250 OK')
+
+
+# ---------- APPLICAZIONE ----------
+
+def prepare_database(db_path):
+    """Crea il database temporaneo con un evento e ritorna l'id dell'evento"""
+    os.environ['DB_PATH'] = db_path
+    os.environ['METRICS_DIR'] = os.path.join(os.path.dirname(db_path), 'metrics')
+    sys.path.insert(0, ROOT)
+    # config stampa le impostazioni all'import: stdout resta riservato al JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        import database
+    database.init_db()
+    database.create_event('Prova di carico', '2030-01-01', '21:00', 10.0)
+    event_id = database.get_read_db().execute('SELECT MAX(id) FROM events').fetchone()[0]
+    database.close_db()
+    return event_id
+
+
+def start_app(args, env, log_file):
+    if args.gunicorn:
+        command = [
+            sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{args.port}',
+            '--workers', str(args.workers), '--threads', str(args.threads),
+            '--config', 'gunicorn.conf.py',
+        ]
+    else:
+        command = [
+            sys.executable, '-c',
+            'from app import create_app, start_background_services; '
+            'app = create_app(); start_background_services(); '
+            f"app.run(host='127.0.0.1', port={args.port}, threaded=True, debug=False, use_reloader=False)",
+        ]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Applicazione terminata in avvio (codice {process.returncode})')
+        try:
+            requests.get(f'http://127.0.0.1:{args.port}/', timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Applicazione non raggiungibile dopo 30 secondi')
+
+
+def all_seats():
+    with open(os.path.join(ROOT, 'config.json')) as f:
+        config = json.load(f)
+    unavailable = set(config['unavailable_seats'])
+    return [
+        f'{row}{col}' for row in config['row_letters'] for col in range(1, COLS + 1)
+        if f'{row}{col}' not in unavailable
+    ]
+
+
+# ---------- ACQUIRENTI ----------
+
+class LoadTest:
+    def __init__(self, args, base_url, event_id):
+        self.args = args
+        self.base_url = base_url
+        self.event_id = event_id
+        self.hot_seats = all_seats()[:args.hot_seats]
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.outcomes = Counter()
+        self.queue_waits = []
+        self.paid_sessions = []
+        self.lock = threading.Lock()
+        self.start = threading.Event()
+
+    def _request(self, http, route, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = http.request(method, self.base_url + path, allow_redirects=False, timeout=30, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.latencies[route].append(time.perf_counter() - started)
+                self.errors[route] += 1
+            return None
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            if response.status_code >= 500:
+                self.errors[route] += 1
+        return response
+
+    def _outcome(self, name):
+        with self.lock:
+            self.outcomes[name] += 1
+
+    def buyer(self, number):
+        rng = random.Random(self.args.seed * 100003 + number)
+        self.start.wait()
+        with requests.Session() as http:
+            path = f'/select_seats/{self.event_id}'
+            response = self._request(http, 'select_seats GET', 'GET', path)
+            if response is None:
+                return self._outcome('error')
+            if response.status_code == 302 and '/queue/' in response.headers.get('Location', ''):
+                if not self.wait_in_queue(http, _local_path(response.headers['Location'])):
+                    return self._outcome('error')
+                if self._request(http, 'select_seats GET', 'GET', path) is None:
+                    return self._outcome('error')
+
+            seats = rng.sample(self.hot_seats, rng.randint(1, self.args.max_seats))
+            response = self._request(http, 'select_seats POST', 'POST', path, data={
+                'name': f'Acquirente {number}', 'email': f'acquirente{number}@example.com', 'seats': seats,
+            })
+            if response is None:
+                return self._outcome('error')
+            location = response.headers.get('Location', '')
+            if response.status_code != 302 or 'createcheckoutsession' not in location:
+                return self._outcome('rejected')
+
+            response = self._request(http, 'createcheckoutsession', 'GET', _local_path(location))
+            if response is None:
+                return self._outcome('error')
+            location = response.headers.get('Location', '')
+            if response.status_code != 303 or '/pay/' not in location:
+                return self._outcome('checkout_failed')
+            session_id = location.rsplit('/', 1)[-1]
+
+            choice = rng.random()
+            if choice < self.args.pay_ratio:
+                self.pay(http, session_id)
+                self._request(http, 'payment_success', 'GET', f'/payment/success?session_id={session_id}')
+                self._outcome('paid')
+            elif choice < self.args.pay_ratio + self.args.cancel_ratio:
+                self._request(http, 'payment_cancel', 'GET', f'/payment/cancel?session_id={session_id}')
+                self._outcome('cancelled')
+            else:
+                # Il cliente chiude la pagina: la prenotazione deve scadere da sola
+                self._outcome('abandoned')
+
+    def wait_in_queue(self, http, path):
+        """Sala d'attesa: ricarica la pagina come il browser (header Refresh) fino all'ammissione"""
+        started = time.perf_counter()
+        while True:
+            response = self._request(http, 'waiting_room', 'GET', path)
+            if response is None or response.status_code not in (200, 302):
+                return False
+            if response.status_code == 302:
+                with self.lock:
+                    self.queue_waits.append(time.perf_counter() - started)
+                return 'select_seats' in response.headers.get('Location', '')
+            time.sleep(float(response.headers.get('Refresh', 3)))
+
+    def pay(self, http, session_id):
+        """Webhook checkout.session.completed firmato, come lo invierebbe Stripe"""
+        session = self.stripe.sessions[session_id]
+        event = build_event('checkout.session.completed', session['client_reference_id'], session_id)
+        payload = json.dumps(event)
+        self._request(http, 'stripe_webhook', 'POST', '/stripe/webhook', data=payload, headers={
+            'Content-Type': 'application/json', 'Stripe-Signature': sign(payload, WEBHOOK_SECRET),
+        })
+        with self.lock:
+            self.paid_sessions.append(session_id)
+
+    def run(self, stripe_server):
+        self.stripe = stripe_server
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            futures = [pool.submit(self.buyer, n) for n in range(self.args.buyers)]
+            started = time.perf_counter()
+            self.start.set()
+            for future in futures:
+                future.result()
+        return time.perf_counter() - started
+
+
+# ---------- CONTROLLI ----------
+
+def check_database(db_path, paid_sessions, now):
+    """Invarianti sul database al termine della prova"""
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        placeholders = ','.join(['?'] * len(ACTIVE_STATUSES))
+        seat_owners = Counter()
+        for event_id, seats in conn.execute(
+            f'SELECT event_id, seats FROM bookings WHERE status IN ({placeholders})', ACTIVE_STATUSES
+        ):
+            for seat in seats.split(','):
+                seat_owners[(event_id, seat)] += 1
+        double_booked = sum(1 for owners in seat_owners.values() if owners > 1)
+
+        # Prenotazioni in attesa oltre la scadenza: nessuno le ha liberate
+        orphaned = conn.execute(
+            'SELECT COUNT(*) FROM bookings WHERE status = 1 AND (expires_at IS NULL OR expires_at <= ?)',
+            (now - EXPIRY_GRACE,)
+        ).fetchone()[0]
+        pending = conn.execute('SELECT COUNT(*) FROM bookings WHERE status = 1').fetchone()[0]
+
+        unconfirmed = 0
+        for session_id in paid_sessions:
+            row = conn.execute('SELECT status FROM bookings WHERE stripe_session_id = ?', (session_id,)).fetchone()
+            if row is None or row[0] != 2:
+                unconfirmed += 1
+        paid = conn.execute('SELECT COUNT(*) FROM bookings WHERE status = 2').fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'double_booked_seats': double_booked,
+        'orphaned_holds': orphaned,
+        'pending_holds': pending,
+        'unconfirmed_payments': unconfirmed,
+        'paid_bookings': paid,
+    }
+
+
+def wait_for_emails(smtp, expected, timeout):
+    deadline = time.time() + timeout
+    while smtp.messages < expected and time.time() < deadline:
+        time.sleep(0.5)
+    return smtp.messages
+
+
+def route_stats(latencies, errors, duration):
+    stats = {}
+    for route in sorted(latencies):
+        values = sorted(latencies[route])
+        stats[route] = {
+            'count': len(values),
+            'errors': errors[route],
+            'rps': round(len(values) / duration, 2),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2),
+        }
+    return stats
+
+
+def queue_stats(waits):
+    """Acquirenti passati dalla sala d'attesa e tempo di attesa fino all'ammissione"""
+    values = sorted(waits)
+    if not values:
+        return {'queued': 0}
+    return {
+        'queued': len(values),
+        'wait_p50_s': round(percentile(values, 50), 2),
+        'wait_p95_s': round(percentile(values, 95), 2),
+        'wait_max_s': round(values[-1], 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prova di carico del flusso di acquisto')
+    parser.add_argument('--buyers', type=int, default=200, help='acquirenti totali')
+    parser.add_argument('--concurrency', type=int, default=50, help='acquirenti contemporanei')
+    parser.add_argument('--hot-seats', type=int, default=100, help='posti contesi (i primi della sala)')
+    parser.add_argument('--max-seats', type=int, default=4, help='posti massimi per acquirente')
+    parser.add_argument('--pay-ratio', type=float, default=0.7)
+    parser.add_argument('--cancel-ratio', type=float, default=0.1)
+    parser.add_argument('--hold-seconds', type=int, default=10, help='BOOKING_HOLD_SECONDS dell\'applicazione')
+    parser.add_argument('--stripe-latency', type=float, default=0.05, help='latenza Stripe finta in secondi')
+    parser.add_argument('--stripe-error-rate', type=float, default=0.0)
+    parser.add_argument('--gunicorn', action='store_true', help='avvia l\'applicazione con gunicorn')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-waiting-room', action='store_true', help='disattiva la sala d\'attesa (confronto)')
+    parser.add_argument('--waiting-room-rate', type=float, default=0,
+                        help='WAITING_ROOM_RATE dell\'applicazione (0 = dalla capacità di scrittura)')
+    parser.add_argument('--waiting-room-burst', type=int, default=20, help='WAITING_ROOM_BURST dell\'applicazione')
+    parser.add_argument('--output', default=None, help='file JSON dei risultati (default: stdout)')
+    parser.add_argument('--keep', action='store_true', help='non cancellare database e log')
+    args = parser.parse_args()
+    args.port = args.port or _free_port()
+
+    workdir = tempfile.mkdtemp(prefix='tsr-loadtest-')
+    db_path = os.path.join(workdir, 'loadtest.db')
+    log_path = os.path.join(workdir, 'app.log')
+
+    stripe_server = FakeStripe(args.stripe_latency, args.stripe_error_rate)
+    smtp = FakeSMTP()
+    for server in (stripe_server, smtp):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    env = dict(
+        os.environ,
+        DB_PATH=db_path,
+        METRICS_DIR=os.path.join(workdir, 'metrics'),
+        BOOKING_HOLD_SECONDS=str(args.hold_seconds),
+        STRIPE_SECRET_KEY='sk_test_loadtest',
+        STRIPE_API_BASE=stripe_server.base_url,
+        STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+        STRIPE_SUCCESS_URL=f'{base_url}/payment/success?session_id={{CHECKOUT_SESSION_ID}}',
+        STRIPE_CANCEL_URL=f'{base_url}/payment/cancel?session_id={{CHECKOUT_SESSION_ID}}',
+        SMTP_SERVER='127.0.0.1',
+        SMTP_PORT=str(smtp.port),
+        SMTP_STARTTLS='0',
+        SMTP_LOGIN='0',
+        WAITING_ROOM_ENABLED='0' if args.no_waiting_room else '1',
+        WAITING_ROOM_RATE=str(args.waiting_room_rate),
+        WAITING_ROOM_BURST=str(args.waiting_room_burst),
+        # Tutti gli acquirenti simulati hanno lo stesso IP: limiti per client disattivati
+        RATE_LIMIT_ENABLED='0',
+        RATE_LIMIT_DB_PATH=os.path.join(workdir, 'rate_limits.db'),
+    )
+
+    event_id = prepare_database(db_path)
+    with open(log_path, 'w') as log_file:
+        app_process = start_app(args, env, log_file)
+        try:
+            test = LoadTest(args, base_url, event_id)
+            duration = test.run(stripe_server)
+
+            # Attesa della scadenza delle prenotazioni abbandonate e delle email
+            time.sleep(args.hold_seconds + EXPIRY_GRACE)
+            invariants = check_database(db_path, test.paid_sessions, time.time())
+            invariants['emails_expected'] = invariants['paid_bookings']
+            invariants['emails_sent'] = wait_for_emails(smtp, invariants['paid_bookings'], timeout=30)
+        finally:
+            app_process.terminate()
+            app_process.wait(timeout=10)
+
+    requests_total = sum(len(values) for values in test.latencies.values())
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'keep', 'port')},
+        'duration_s': round(duration, 3),
+        'requests': requests_total,
+        'throughput_rps': round(requests_total / duration, 2),
+        'buyers_per_s': round(args.buyers / duration, 2),
+        'outcomes': dict(sorted(test.outcomes.items())),
+        'routes': route_stats(test.latencies, test.errors, duration),
+        'waiting_room': queue_stats(test.queue_waits),
+        'invariants': invariants,
+    }
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.keep:
+        print(f'Database e log in {workdir}', file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    violated = invariants['double_booked_seats'] or invariants['orphaned_holds'] or invariants['unconfirmed_payments']
+    sys.exit(1 if violated else 0)
+
+
+if __name__ == '__main__':
+    main()
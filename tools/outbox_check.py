@@ -0,0 +1,184 @@
+"""
+Verifica della coda email (email_outbox) contro un server SMTP locale.
+
+Crea un database temporaneo con un evento e delle prenotazioni pagate,
+accoda le email di conferma e avvia i worker della coda verso un server SMTP
+finto su localhost che rifiuta temporaneamente (451) i primi messaggi. Si
+possono simulare anche errori temporanei nella generazione del PDF e una
+prenotazione inesistente (errore definitivo).
+
+Controlla che ogni biglietto venga consegnato una sola volta dopo i nuovi
+tentativi e che solo l'email senza prenotazione risulti fallita. Stampa un
+JSON con il risultato ed esce con codice 1 se qualcosa non torna.
+
+Esempi:
+    python tools/outbox_check.py
+    python tools/outbox_check.py --emails 50 --smtp-failures 5 --pdf-failures 3
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalSMTP(socketserver.ThreadingTCPServer):
+    """Server SMTP minimo: i primi `failures` messaggi ricevono un rifiuto temporaneo"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, failures):
+        super().__init__(('127.0.0.1', _free_port()), _LocalSMTPHandler)
+        self.port = self.server_address[1]
+        self.failures = failures
+        self.rejected = 0
+        self.recipients = []
+        self.lock = threading.Lock()
+
+
+class _LocalSMTPHandler(socketserver.StreamRequestHandler):
+    def _send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self._send('220 localhost ESMTP outbox_check')
+        recipient = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            upper = command.upper()
+            if upper.startswith('EHLO'):
+                self._send('250-localhost')
+                self._send('250 8BITMIME')
+            elif upper.startswith('RCPT TO:'):
+                recipient = command[8:].strip(' <>')
+                self._send('250 OK')
+            elif upper.startswith('DATA'):
+                self._send('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                with self.server.lock:
+                    if self.server.rejected < self.server.failures:
+                        self.server.rejected += 1
+                        self._send('451 Riprovare piu tardi')
+                        continue
+                    self.server.recipients.append(recipient)
+                self._send('250 OK')
+            elif upper.startswith('QUIT'):
+                self._send('221 Bye')
+                return
+            else:
+                self._send('250 OK')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=20, help='prenotazioni pagate da confermare')
+    parser.add_argument('--smtp-failures', type=int, default=3, help='messaggi rifiutati con 451')
+    parser.add_argument('--pdf-failures', type=int, default=2, help='generazioni PDF fallite')
+    parser.add_argument('--workers', type=int, default=2, help='EMAIL_WORKERS')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--keep', action='store_true', help='non cancellare il database')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='tsr-outbox-')
+    smtp = LocalSMTP(args.smtp_failures)
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+    os.environ.update(
+        DB_PATH=os.path.join(workdir, 'outbox.db'),
+        METRICS_DIR=os.path.join(workdir, 'metrics'),
+        SMTP_SERVER='127.0.0.1',
+        SMTP_PORT=str(smtp.port),
+        SMTP_STARTTLS='0',
+        SMTP_LOGIN='0',
+        EMAIL_WORKERS=str(args.workers),
+    )
+    sys.path.insert(0, ROOT)
+    # config stampa le impostazioni all'import: stdout resta riservato al JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        import database
+        from config import ROW_LETTERS, COLS
+        import email_outbox
+        import email_service
+
+    # Nuovi tentativi ravvicinati: la prova non aspetta il backoff di produzione
+    email_outbox.RETRY_BASE_DELAY = 1
+
+    pdf_failures = [args.pdf_failures]
+    generate_pdf = email_service.generate_email_ticket_pdf
+
+    def flaky_pdf(booking, event):
+        if pdf_failures[0] > 0:
+            pdf_failures[0] -= 1
+            raise OSError('locandina non raggiungibile')
+        return generate_pdf(booking, event)
+
+    email_service.generate_email_ticket_pdf = flaky_pdf
+
+    database.init_db()
+    database.create_event('Prova coda email', '2030-01-01', '21:00', 10.0)
+    event_id = database.get_read_db().execute('SELECT MAX(id) FROM events').fetchone()[0]
+    for i in range(args.emails):
+        seat = f'{ROW_LETTERS[i // COLS]}{i % COLS + 1}'
+        booking_id = database.create_booking(event_id, f'Cliente {i}', f'cliente{i}@example.com', seat, 2)
+        email_outbox.enqueue_booking_confirmation(booking_id)
+    missing_id = email_outbox.enqueue_email(999999999, email_outbox.BOOKING_CONFIRMATION)
+
+    started = time.time()
+    email_outbox.workers.start()
+    while time.time() - started < args.timeout:
+        pending = database.get_read_db().execute(
+            "SELECT COUNT(*) FROM email_outbox WHERE status IN ('pending', 'sending')"
+        ).fetchone()[0]
+        if not pending:
+            break
+        time.sleep(0.5)
+
+    rows = database.get_read_db().execute('SELECT id, status, attempts FROM email_outbox').fetchall()
+    statuses = {}
+    for row in rows:
+        statuses[row['status']] = statuses.get(row['status'], 0) + 1
+    failed_ids = [row['id'] for row in rows if row['status'] == 'failed']
+    duplicates = len(smtp.recipients) - len(set(smtp.recipients))
+    result = {
+        'duration_s': round(time.time() - started, 2),
+        'outbox': statuses,
+        'retried': sum(1 for row in rows if row['attempts'] > 1),
+        'smtp_rejected': smtp.rejected,
+        'smtp_delivered': len(smtp.recipients),
+        'duplicate_deliveries': duplicates,
+    }
+    ok = (
+        statuses.get('sent') == args.emails
+        and failed_ids == [missing_id]
+        and len(smtp.recipients) == args.emails
+        and duplicates == 0
+    )
+    result['ok'] = ok
+    print(json.dumps(result, indent=2))
+
+    if args.keep:
+        print(f'Database in {workdir}', file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
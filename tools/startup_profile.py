@@ -0,0 +1,157 @@
+"""
+Misura l'avvio dell'applicazione come con gunicorn --preload: tempo di
+import di app, create_app e warm_up nel processo master, poi fork di alcuni
+worker che servono la prima richiesta e riportano memoria residente (RSS) e
+privata (non più condivisa con il master, da /proc/self/smaps_rollup).
+
+Ogni misura gira in un processo nuovo, su un database temporaneo. Con --repo
+si misura un altro albero (es. un checkout di un commit precedente, a cui
+mancano create_app e warm_up).
+
+Esempi:
+    python tools/startup_profile.py
+    python tools/startup_profile.py --repo /tmp/tsrbooking-vecchio --runs 5
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RUNS = 3
+DEFAULT_WORKERS = 2
+FIRST_PATH = '/'
+
+
+def _memory_kb():
+    """(RSS, memoria privata) del processo corrente in kB"""
+    values = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Rss', 'Private_Clean', 'Private_Dirty'):
+                    values[key] = int(rest.split()[0])
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, None
+    return values['Rss'], values['Private_Clean'] + values['Private_Dirty']
+
+
+def _worker(app_module, write_fd):
+    """Processo worker: avvia i servizi e serve la prima richiesta"""
+    started = time.perf_counter()
+    start_services = getattr(app_module, 'start_background_services', None)
+    if start_services is not None:
+        start_services()
+    response = app_module.app.test_client().get(FIRST_PATH)
+    first_request_ms = (time.perf_counter() - started) * 1000
+    rss, private = _memory_kb()
+    os.write(write_fd, json.dumps({
+        'status': response.status_code, 'first_request_ms': first_request_ms,
+        'rss_kb': rss, 'private_kb': private,
+    }).encode())
+    os._exit(0)
+
+
+def profile_once(workers):
+    """Una misura completa nel processo corrente (master simulato)"""
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        import app as app_module
+    import_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    create_app = getattr(app_module, 'create_app', None)
+    if create_app is not None:
+        create_app()
+    create_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    warm_up = getattr(app_module, 'warm_up', None)
+    if warm_up is not None:
+        warm_up()
+    warm_up_ms = (time.perf_counter() - started) * 1000
+    master_rss, _ = _memory_kb()
+
+    results = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            _worker(app_module, write_fd)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            results.append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+
+    return {
+        'import_ms': import_ms,
+        'create_app_ms': create_ms,
+        'warm_up_ms': warm_up_ms,
+        'master_rss_kb': master_rss,
+        'master_threads': len(os.listdir('/proc/self/task')) if os.path.isdir('/proc/self/task') else None,
+        'workers': results,
+    }
+
+
+def run(repo, runs, workers):
+    """Ogni misura in un processo nuovo (import a freddo, cache del disco calda)"""
+    samples = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory(prefix='tsr-startup-') as workdir:
+            env = dict(
+                os.environ, DB_PATH=os.path.join(workdir, 'startup.db'),
+                METRICS_DIR=os.path.join(workdir, 'metrics'), PYTHONPATH=repo,
+            )
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-once', '--workers', str(workers)],
+                cwd=repo, env=env, check=True, capture_output=True, text=True,
+            ).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+    return summarize(samples)
+
+
+def summarize(samples):
+    def median(values):
+        values = [v for v in values if v is not None]
+        return round(statistics.median(values), 1) if values else None
+
+    workers = [w for s in samples for w in s['workers']]
+    return {
+        'runs': len(samples),
+        'import_ms': median(s['import_ms'] for s in samples),
+        'create_app_ms': median(s['create_app_ms'] for s in samples),
+        'warm_up_ms': median(s['warm_up_ms'] for s in samples),
+        'master_rss_mb': median(s['master_rss_kb'] / 1024 for s in samples),
+        'master_threads': median(s['master_threads'] for s in samples),
+        'worker_first_request_ms': median(w['first_request_ms'] for w in workers),
+        'worker_rss_mb': median(w['rss_kb'] / 1024 for w in workers),
+        'worker_private_mb': median(w['private_kb'] / 1024 for w in workers if w['private_kb'] is not None),
+        'statuses': sorted({w['status'] for w in workers}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempo di avvio e memoria per worker dell'applicazione")
+    parser.add_argument('--repo', default=ROOT, help="albero dell'applicazione da misurare")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--run-once', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_once:
+        sys.path.insert(0, os.getcwd())
+        print(json.dumps(profile_once(args.workers)))
+        return
+    print(json.dumps(run(os.path.abspath(args.repo), args.runs, args.workers), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Invia eventi webhook Stripe finti, firmati come quelli reali, all'endpoint
+/stripe/webhook di un'istanza locale (sviluppo e prove).
+
+Esempi:
+    python tools/stripe_webhook_sender.py --booking-id 12 --session-id cs_test_1
+    python tools/stripe_webhook_sender.py --type checkout.session.expired --booking-id 12
+    python tools/stripe_webhook_sender.py --booking-id 12 --event-id evt_dup --repeat 3
+    python tools/stripe_webhook_sender.py --booking-id 12 --bad-signature
+
+Il segreto è lo stesso STRIPE_WEBHOOK_SECRET configurato nell'applicazione.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import uuid
+import requests
+
+
+def build_event(event_type, booking_id, session_id, event_id=None, payment_status='paid'):
+    """Evento nel formato inviato da Stripe per una sessione di checkout"""
+    return {
+        'id': event_id or f'evt_test_{uuid.uuid4().hex[:24]}',
+        'object': 'event',
+        'api_version': '2024-06-20',
+        'created': int(time.time()),
+        'livemode': False,
+        'type': event_type,
+        'data': {
+            'object': {
+                'id': session_id,
+                'object': 'checkout.session',
+                'client_reference_id': str(booking_id),
+                'metadata': {'booking_id': str(booking_id)},
+                'mode': 'payment',
+                'payment_status': payment_status,
+                'status': 'complete' if event_type == 'checkout.session.completed' else 'expired',
+            }
+        },
+    }
+
+
+def sign(payload, secret, timestamp=None):
+    """Intestazione Stripe-Signature: t=<timestamp>,v1=<HMAC-SHA256 di "t.payload">"""
+    timestamp = timestamp or int(time.time())
+    signed = f'{timestamp}.{payload}'.encode()
+    signature = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def send(url, event, secret, bad_signature=False):
+    payload = json.dumps(event)
+    signature = sign(payload, 'whsec_sbagliato' if bad_signature else secret)
+    return requests.post(
+        url, data=payload, timeout=10,
+        headers={'Content-Type': 'application/json', 'Stripe-Signature': signature}
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Invia eventi webhook Stripe finti')
+    parser.add_argument('--url', default='http://127.0.0.1:5000/stripe/webhook')
+    parser.add_argument('--secret', default=os.getenv('STRIPE_WEBHOOK_SECRET'))
+    parser.add_argument('--type', default='checkout.session.completed')
+    parser.add_argument('--booking-id', type=int, required=True)
+    parser.add_argument('--session-id', default=None)
+    parser.add_argument('--event-id', default=None, help='id fisso per provare gli invii duplicati')
+    parser.add_argument('--payment-status', default='paid')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--bad-signature', action='store_true')
+    args = parser.parse_args()
+
+    if not args.secret:
+        sys.exit('Segreto mancante: usa --secret o STRIPE_WEBHOOK_SECRET')
+
+    session_id = args.session_id or f'cs_test_{uuid.uuid4().hex[:24]}'
+    event = build_event(args.type, args.booking_id, session_id, args.event_id, args.payment_status)
+    for _ in range(args.repeat):
+        response = send(args.url, event, args.secret, args.bad_signature)
+        print(f"{event['id']} {args.type} -> {response.status_code} {response.text.strip()}")
+
+
+if __name__ == '__main__':
+    main()
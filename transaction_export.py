@@ -0,0 +1,107 @@
+"""
+Esportazione delle transazioni di un evento in CSV o XLSX per la contabilità.
+
+Le righe vengono lette dal database a blocchi e scritte una alla volta nella
+risposta: la memoria usata non dipende dal numero di prenotazioni.
+I testi che inizierebbero una formula vengono preceduti da un apostrofo.
+XLSX richiede il pacchetto opzionale openpyxl.
+"""
+import csv
+import importlib.util
+import tempfile
+from database import iter_event_bookings
+
+STATUS_LABELS = {
+    0: 'Annullato',
+    1: 'In attesa',
+    2: 'Pagato',
+    3: 'Cassa',
+}
+
+# Colonne esportabili: chiave -> (intestazione, valore dalla riga)
+EXPORT_COLUMNS = {
+    'id': ('Id', lambda b: b['id']),
+    'created_at': ('Data', lambda b: b['created_at']),
+    'name': ('Nome', lambda b: b['name']),
+    'email': ('Email', lambda b: b['email']),
+    'seats': ('Posti', lambda b: b['seats']),
+    'seat_count': ('N. posti', lambda b: len([s for s in b['seats'].split(',') if s.strip()])),
+    'status': ('Stato', lambda b: STATUS_LABELS.get(b['status'], 'Sconosciuto')),
+}
+DEFAULT_COLUMNS = tuple(EXPORT_COLUMNS)
+EXPORT_FORMATS = ('csv', 'xlsx')
+
+# Separatore e BOM per l'apertura diretta in Excel con impostazioni italiane
+CSV_DELIMITER = ';'
+CSV_BOM = '﻿'
+# Dimensione dei blocchi inviati al client per l'XLSX
+XLSX_CHUNK_SIZE = 64 * 1024
+# Caratteri iniziali che Excel/LibreOffice interpretano come formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def xlsx_available():
+    # Verifica senza importare openpyxl (caricato solo alla prima esportazione)
+    return importlib.util.find_spec('openpyxl') is not None
+
+
+def parse_columns(value):
+    """Colonne richieste ('id,name,...') validate; None se ne contiene di sconosciute"""
+    if not value:
+        return DEFAULT_COLUMNS
+    columns = tuple(c.strip() for c in value.split(',') if c.strip())
+    if not columns or any(c not in EXPORT_COLUMNS for c in columns):
+        return None
+    return columns
+
+
+class _Echo:
+    """Pseudo-file per csv.writer: ritorna la riga invece di accumularla"""
+
+    def write(self, value):
+        return value
+
+
+def _safe_cell(value):
+    """Neutralizza le formule nei testi inseriti dagli utenti (nome, email)"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _project(bookings, columns):
+    getters = [EXPORT_COLUMNS[c][1] for c in columns]
+    for booking in bookings:
+        yield [_safe_cell(get(booking)) for get in getters]
+
+
+def stream_csv(event_id, columns=DEFAULT_COLUMNS, statuses=None, date_from=None, date_to=None):
+    """Generatore delle righe CSV delle transazioni"""
+    writer = csv.writer(_Echo(), delimiter=CSV_DELIMITER)
+    yield CSV_BOM + writer.writerow([EXPORT_COLUMNS[c][0] for c in columns])
+    bookings = iter_event_bookings(event_id, statuses=statuses, date_from=date_from, date_to=date_to)
+    for row in _project(bookings, columns):
+        yield writer.writerow(row)
+
+
+def stream_xlsx(event_id, columns=DEFAULT_COLUMNS, statuses=None, date_from=None, date_to=None):
+    """
+    Generatore dei byte del file XLSX. Il foglio è scritto riga per riga in
+    modalità write_only (su file temporaneo) e poi inviato a blocchi.
+    """
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Transazioni')
+    sheet.append([EXPORT_COLUMNS[c][0] for c in columns])
+    bookings = iter_event_bookings(event_id, statuses=statuses, date_from=date_from, date_to=date_to)
+    for row in _project(bookings, columns):
+        sheet.append(row)
+
+    with tempfile.TemporaryFile() as tmp:
+        workbook.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(XLSX_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
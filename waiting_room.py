@@ -0,0 +1,219 @@
+"""
+Sala d'attesa virtuale per le aperture vendite ad alta richiesta.
+
+Chi apre la selezione posti senza un'ammissione valida riceve un biglietto
+di coda numerato (una sola scrittura, tabella waiting_rooms). Il fronte di
+ammissione avanza come un token bucket: `rate` acquirenti al secondo, con al
+più `burst` ingressi immediati quando la coda è vuota. Con poca richiesta
+l'ammissione è immediata; durante un'apertura vendite i posti vengono scelti
+da un numero di acquirenti sostenibile per il database e la latenza degli
+ammessi resta stabile.
+
+Il rate, se non configurato, deriva dalla capacità di scrittura misurata:
+SQLite ha un solo scrittore alla volta, quindi la durata media con cui una
+transazione tiene il lock di scrittura fissa le transazioni al secondo.
+
+Biglietto e ammissione sono token firmati (itsdangerous, SECRET_KEY) in
+cookie per evento: la verifica non richiede il database. La posizione in
+coda usa la riga della sala letta al massimo ogni ROOM_CACHE_SECONDS.
+
+I numeri di coda non costano una scrittura per arrivo: ogni processo
+riserva un blocco di numeri consecutivi (una transazione) e li assegna in
+memoria per al più BLOCK_SECONDS. Il blocco si adatta agli arrivi del
+processo: raddoppia se esaurito prima della scadenza, altrimenti scende ai
+numeri usati. Durante un'apertura vendite le scritture restano circa una al
+secondo per processo; i numeri non assegnati di un blocco scaduto vengono
+ammessi a vuoto.
+"""
+import math
+import threading
+import time
+from collections import namedtuple
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from config import (
+    SECRET_KEY, WAITING_ROOM_ENABLED, WAITING_ROOM_RATE, WAITING_ROOM_BURST, WAITING_ROOM_ADMISSION_SECONDS
+)
+from metrics import WAITING_ROOM_ENTRIES
+
+# Durata di validità di un biglietto di coda
+QUEUE_TOKEN_SECONDS = 6 * 3600
+# Ogni processo rilegge lo stato della sala al massimo con questa frequenza
+ROOM_CACHE_SECONDS = 1.0
+# Capacità di scrittura usata dagli acquirenti ammessi e transazioni di scrittura per acquisto
+# (prenotazione, conferma del pagamento, coda email, invio)
+TARGET_WRITE_UTILIZATION = 0.5
+WRITES_PER_BUYER = 4
+# Limiti del rate automatico (acquirenti al secondo) e valore prima delle prime misure
+MIN_RATE = 1.0
+MAX_RATE = 200.0
+DEFAULT_RATE = 10.0
+# Peso delle nuove misure nella media mobile esponenziale
+EWMA_ALPHA = 0.05
+# Durata e dimensione massima dei blocchi di numeri riservati da un processo
+BLOCK_SECONDS = 1.0
+MAX_BLOCK = 64
+# Intervallo di aggiornamento della pagina di attesa (secondi)
+MIN_REFRESH = 3
+MAX_REFRESH = 15
+
+Room = namedtuple('Room', 'issued admitted rate burst updated_at')
+QueueStatus = namedtuple('QueueStatus', 'ticket position wait_seconds refresh')
+
+
+class WriteCapacity:
+    """Media mobile della durata di possesso del lock di scrittura nel processo"""
+
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self.hold_seconds = None
+
+    def observe(self, seconds):
+        # Aggiornamento non protetto da lock: una misura persa non cambia la media
+        if self.hold_seconds is None:
+            self.hold_seconds = seconds
+        else:
+            self.hold_seconds += self.alpha * (seconds - self.hold_seconds)
+
+    def admission_rate(self):
+        """Acquirenti al secondo sostenibili con la capacità di scrittura misurata"""
+        if WAITING_ROOM_RATE > 0:
+            return WAITING_ROOM_RATE
+        if not self.hold_seconds:
+            return DEFAULT_RATE
+        writes_per_second = 1 / self.hold_seconds
+        rate = writes_per_second * TARGET_WRITE_UTILIZATION / WRITES_PER_BUYER
+        return min(max(rate, MIN_RATE), MAX_RATE)
+
+
+def admitted_until(room, now):
+    """Numero dell'ultimo biglietto ammesso all'istante now"""
+    elapsed = max(0.0, now - room.updated_at)
+    return math.floor(min(room.issued + room.burst, room.admitted + room.rate * elapsed))
+
+
+class WaitingRoom:
+    """Biglietti di coda e ammissioni per evento"""
+
+    def __init__(self, secret_key=SECRET_KEY, enabled=WAITING_ROOM_ENABLED):
+        self.enabled = enabled
+        self._queue_tokens = URLSafeTimedSerializer(secret_key, salt='waiting-room-queue')
+        self._admission_tokens = URLSafeTimedSerializer(secret_key, salt='waiting-room-admission')
+        self._rooms = {}
+        # event_id -> [prossimo numero, ultimo numero, scadenza (monotonic), dimensione]
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    # ---------- TOKEN ----------
+
+    @staticmethod
+    def queue_cookie(event_id):
+        return f'queue_{event_id}'
+
+    @staticmethod
+    def admission_cookie(event_id):
+        return f'admission_{event_id}'
+
+    def queue_token(self, event_id, ticket):
+        return self._queue_tokens.dumps([event_id, ticket])
+
+    def admission_token(self, event_id, ticket):
+        return self._admission_tokens.dumps([event_id, ticket])
+
+    def read_queue_token(self, event_id, token):
+        """Numero del biglietto se il token è valido per l'evento, altrimenti None"""
+        return self._read(self._queue_tokens, event_id, token, QUEUE_TOKEN_SECONDS)
+
+    def admission_ticket(self, event_id, token):
+        """Numero del biglietto dell'ammissione se valida per l'evento, altrimenti None"""
+        return self._read(self._admission_tokens, event_id, token, WAITING_ROOM_ADMISSION_SECONDS)
+
+    def is_admitted(self, event_id, token):
+        """Verifica firma e scadenza dell'ammissione (nessun accesso al database)"""
+        if not self.enabled:
+            return True
+        return self.admission_ticket(event_id, token) is not None
+
+    @staticmethod
+    def _read(serializer, event_id, token, max_age):
+        if not token:
+            return None
+        try:
+            token_event_id, ticket = serializer.loads(token, max_age=max_age)
+        except (BadSignature, TypeError, ValueError):
+            return None
+        return ticket if token_event_id == event_id else None
+
+    # ---------- CODA ----------
+
+    def enter(self, event_id, now=None):
+        """Assegna un nuovo biglietto di coda: ritorna QueueStatus (position 0 = ammesso)"""
+        now = time.time() if now is None else now
+        ticket = self._take_reserved(event_id)
+        if ticket is None:
+            ticket = self._reserve(event_id, now)
+        status = self.status(event_id, ticket, now)
+        WAITING_ROOM_ENTRIES.inc(result='admitted' if status.position == 0 else 'queued')
+        return status
+
+    def _take_reserved(self, event_id):
+        """Prossimo numero del blocco riservato dal processo, senza database"""
+        with self._lock:
+            block = self._blocks.get(event_id)
+            if block is None or block[0] > block[1] or time.monotonic() > block[2]:
+                return None
+            ticket = block[0]
+            block[0] += 1
+            return ticket
+
+    def _reserve(self, event_id, now):
+        """Riserva un nuovo blocco di numeri (una scrittura) e ritorna il primo"""
+        from database import take_waiting_room_ticket
+        with self._lock:
+            size = self._next_block_size(self._blocks.get(event_id))
+        row = take_waiting_room_ticket(event_id, capacity.admission_rate(), WAITING_ROOM_BURST, now, count=size)
+        room = Room(*row)
+        first = room.issued - size + 1
+        with self._lock:
+            self._rooms[event_id] = (room, time.monotonic())
+            self._blocks[event_id] = [first + 1, room.issued, time.monotonic() + BLOCK_SECONDS, size]
+        return first
+
+    @staticmethod
+    def _next_block_size(block):
+        if block is None:
+            return 1
+        used = block[0] - (block[1] - block[3] + 1)
+        if used >= block[3]:
+            return min(block[3] * 2, MAX_BLOCK)
+        return max(used, 1)
+
+    def status(self, event_id, ticket, now=None):
+        """Posizione del biglietto in coda (0 = ammesso) e attesa stimata"""
+        now = time.time() if now is None else now
+        room = self._room(event_id)
+        if room is None:
+            # Sala mai aperta (database ricreato): il biglietto è trattato come ammesso
+            return QueueStatus(ticket, 0, 0, MIN_REFRESH)
+        return self._status(room, ticket, now)
+
+    def _room(self, event_id):
+        cached = self._rooms.get(event_id)
+        if cached is not None and time.monotonic() - cached[1] < ROOM_CACHE_SECONDS:
+            return cached[0]
+        from database import get_waiting_room
+        row = get_waiting_room(event_id)
+        room = Room(*row) if row else None
+        with self._lock:
+            self._rooms[event_id] = (room, time.monotonic())
+        return room
+
+    @staticmethod
+    def _status(room, ticket, now):
+        position = max(0, ticket - admitted_until(room, now))
+        wait_seconds = math.ceil(position / room.rate) if position else 0
+        refresh = min(max(wait_seconds // 2, MIN_REFRESH), MAX_REFRESH)
+        return QueueStatus(ticket, position, wait_seconds, refresh)
+
+
+capacity = WriteCapacity()
+room = WaitingRoom()
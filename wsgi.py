@@ -1,4 +1,7 @@
 import sys
 import os
 sys.path.insert(0, '/var/www/tsrbooking')
-from app import app as application
+from app import create_app
+
+# Nessun thread avviato qui: con preload_app il modulo viene caricato nel master
+application = create_app()